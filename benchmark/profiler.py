@@ -0,0 +1,108 @@
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class CProfileAnnounceProfiler:
+    """
+    Deterministic profiler of the announce handler, every request
+    runs under its own cProfile.Profile merged into one pstats.Stats
+    """
+    def __init__(self):
+        self.stats = None
+        self.lock = threading.Lock()
+
+
+    def runcall(self, function, *args):
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function, *args)
+        finally:
+            profiler.create_stats()
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profiler)
+                else:
+                    self.stats.add(profiler)
+
+
+    def report(self, path=None, top=25):
+        with self.lock:
+            if self.stats is None:
+                return 'No announce profiled'
+            if path:
+                self.stats.dump_stats(path)
+            output = io.StringIO()
+            self.stats.stream = output
+            self.stats.sort_stats('cumulative').print_stats(top)
+            return output.getvalue()
+
+
+class SamplingAnnounceProfiler:
+    """
+    Statistical profiler, samples the stacks of every thread and
+    keeps the ones running inside the announce handler
+    """
+    def __init__(self, function_name='announce_handler', sampling_interval=0.001):
+        self.function_name = function_name
+        self.sampling_interval = sampling_interval
+        self.self_samples = Counter()
+        self.total_samples = Counter()
+        self.samples = 0
+        self.running = False
+
+
+    def runcall(self, function, *args):
+        return function(*args)
+
+
+    def start(self):
+        self.running = True
+        # short handlers never give up the GIL on their own, a small
+        # switch interval lets the sampler see inside them
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(self.sampling_interval / 20)
+        threading.Thread(target=self.sample, daemon=True).start()
+
+
+    def stop(self):
+        self.running = False
+        sys.setswitchinterval(self.switch_interval)
+
+
+    def sample(self):
+        own_thread = threading.get_ident()
+        while self.running:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                if not any(entry[2] == self.function_name for entry in stack):
+                    continue
+                self.samples += 1
+                self.self_samples[stack[0]] += 1
+                for entry in set(stack):
+                    self.total_samples[entry] += 1
+            time.sleep(self.sampling_interval)
+
+
+    def report(self, path=None, top=25):
+        lines = [f'{self.samples} samples inside {self.function_name}',
+                 f'{"self %":>8} {"total %":>8}  function']
+        for entry, count in self.self_samples.most_common(top):
+            filename, line, name = entry
+            lines.append(f'{100 * count / self.samples:8.2f} {100 * self.total_samples[entry] / self.samples:8.2f}  '
+                         f'{name} ({filename}:{line})')
+        report = '\n'.join(lines)
+        if path:
+            with open(path, 'w') as f:
+                f.write(report + '\n')
+        return report
@@ -0,0 +1,130 @@
+import io
+import json
+import os
+import socket
+import threading
+import time
+import click
+from benchmark.util import RESULTS_DIRECTORY, save_result, resource_usage
+from simple_peer.wire import Connection, REQUEST, PIECE, DONE, BLOCK_REQUEST, PIECE_HEADER, encode_frame_header
+
+
+class BufferSocket:
+    """
+    Socket-like reader over bytes, feeds the parser without the network
+    """
+    def __init__(self, data, chunk_length):
+        self.stream = io.BytesIO(data)
+        self.chunk_length = chunk_length
+
+
+    def recv_into(self, view):
+        return self.stream.readinto(view[:self.chunk_length])
+
+
+def piece_server(server_socket, data, piece_length):
+    """
+    Answer the REQUEST messages of one connection with pieces of data
+    """
+    client_socket, _ = server_socket.accept()
+    connection = Connection(client_socket)
+    try:
+        while True:
+            message_id, payload = connection.receive()
+            if message_id == DONE:
+                connection.send(DONE)
+                return
+            i, begin, length = BLOCK_REQUEST.unpack(payload)
+            offset = i * piece_length + begin
+            connection.send(PIECE, PIECE_HEADER.pack(i, begin), memoryview(data)[offset:offset + length])
+    finally:
+        client_socket.close()
+
+
+def transfer(data, piece_length, pipeline):
+    """
+    Download data from a piece server on loopback, keeping pipeline requests in flight
+    :return: dictionary of the seconds, the throughput and the pieces per second
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(1)
+    server_thread = threading.Thread(target=piece_server, args=(server_socket, data, piece_length), daemon=True)
+    server_thread.start()
+
+    connection = Connection(socket.create_connection(server_socket.getsockname()))
+    piece_number = len(data) // piece_length
+    requested, received = 0, 0
+    start = time.perf_counter()
+    while received < piece_number:
+        while requested < piece_number and requested - received < pipeline:
+            connection.send(REQUEST, BLOCK_REQUEST.pack(requested, 0, piece_length))
+            requested += 1
+        message_id, payload = connection.receive()
+        if message_id != PIECE or len(payload) != PIECE_HEADER.size + piece_length:
+            raise ValueError('Unexpected reply')
+        received += 1
+    seconds = time.perf_counter() - start
+    connection.send(DONE)
+    connection.expect(DONE)
+    connection.sock.close()
+    server_thread.join()
+    server_socket.close()
+    return {
+        'pipeline': pipeline,
+        'seconds': seconds,
+        'throughput': len(data) / seconds,
+        'pieces_per_second': piece_number / seconds
+    }
+
+
+def parse(messages, chunk_length):
+    """
+    Parse small REQUEST frames from memory, the cost of the framing alone
+    :return: dictionary of the seconds and the messages per second
+    """
+    frame = encode_frame_header(REQUEST, BLOCK_REQUEST.size) + BLOCK_REQUEST.pack(1, 0, 16384)
+    connection = Connection(BufferSocket(frame * messages, chunk_length))
+    parsed = 0
+    start = time.perf_counter()
+    while connection.fill(connection.needed()):
+        for message_id, payload in connection.messages():
+            BLOCK_REQUEST.unpack(payload)
+            parsed += 1
+    seconds = time.perf_counter() - start
+    if parsed != messages:
+        raise ValueError(f'Parsed {parsed} messages instead of {messages}')
+    return {'seconds': seconds, 'messages_per_second': messages / seconds}
+
+
+@click.command()
+@click.option('--size', default=256 * 1024 * 1024, type=int, help="Bytes transferred per pipeline depth")
+@click.option('--piece-length', default=512 * 1024, type=int, help="Length of piece (byte)")
+@click.option('--pipeline', 'pipelines', default=[1, 2, 4, 8], type=int, multiple=True,
+              help="Requests in flight, repeatable")
+@click.option('--messages', default=1000000, type=int, help="Small messages parsed from memory")
+@click.option('--chunk-length', default=64 * 1024, type=int, help="Bytes handed to the parser per receive")
+@click.option('--results-dir', default=RESULTS_DIRECTORY, type=str, help="Directory of the JSON results")
+@click.option('--no-save', is_flag=True, help="Only print the result")
+def main(size, piece_length, pipelines, messages, chunk_length, results_dir, no_save):
+    """
+    Throughput of the peer wire protocol: pieces over loopback
+    for every pipeline depth, and small messages parsed from memory
+    """
+    data = os.urandom(size - size % piece_length)
+    usage_before = resource_usage()
+    transfers = [transfer(data, piece_length, pipeline) for pipeline in pipelines]
+    usage_after = resource_usage()
+    result = {
+        'config': {'size': len(data), 'piece_length': piece_length, 'messages': messages, 'chunk_length': chunk_length},
+        'transfer': transfers,
+        'cpu_per_gb': (usage_after['cpu'] - usage_before['cpu']) / (len(data) * len(pipelines) / 1e9),
+        'parse': parse(messages, chunk_length)
+    }
+    click.echo(json.dumps(result, indent=2))
+    if not no_save:
+        click.echo(f'Saved to {save_result("protocol", result, results_dir)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import json
+import os
+import tempfile
+import time
+import click
+from benchmark.util import RESULTS_DIRECTORY, save_result
+from simple_peer.recheck import recheck_torrent
+from simple_peer.util import create_torrent, get_piece_number, read_piece, verify_piece, SimpleClient
+
+
+def write_random_file(path, length):
+    chunk_length = 64 * 1024 * 1024
+    with open(path, 'wb') as f:
+        for start in range(0, length, chunk_length):
+            f.write(os.urandom(min(chunk_length, length - start)))
+
+
+def per_piece_seconds(torrent, file):
+    """
+    :return: seconds to verify every piece with read_piece and verify_piece,
+    each piece opens the file and decodes the torrent again
+    """
+    start = time.perf_counter()
+    for i in range(get_piece_number(torrent)):
+        if not verify_piece(read_piece(i, torrent, file), i, torrent):
+            raise ValueError(f'Piece [{i}] is wrong')
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option('--length', default=1024 * 1024 * 1024, type=int, help="Length of the file (byte)")
+@click.option('--piece-length', default=256 * 1024, type=int, help="Length of piece (byte)")
+@click.option('--workers', default=SimpleClient.HASH_WORKERS, type=int, help="Hashing threads of the parallel recheck")
+@click.option('--results-dir', default=RESULTS_DIRECTORY, type=str, help="Directory of the JSON results")
+@click.option('--no-save', is_flag=True, help="Only print the result")
+def main(length, piece_length, workers, results_dir, no_save):
+    """
+    Rate of verifying a file against its torrent: piece by piece
+    through read_piece/verify_piece, and recheck over the mapped file
+    with one thread and with workers threads. The file is read once
+    beforehand, every measure is served from the page cache.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        file = os.path.join(directory, 'file.bin')
+        write_random_file(file, length)
+        create_torrent(file, '127.0.0.1', 8080, piece_length, directory)
+        torrent = file + '.torrent'
+        # warm the page cache
+        recheck_torrent(torrent, file, workers)
+
+        seconds = {
+            'per_piece': per_piece_seconds(torrent, file),
+            'sequential': recheck_torrent(torrent, file, 1)['seconds'],
+            'parallel': recheck_torrent(torrent, file, workers)['seconds']
+        }
+    result = {
+        'config': {'length': length, 'piece_length': piece_length, 'workers': workers, 'cpu_count': os.cpu_count()},
+        'seconds': seconds,
+        'rate': {name: length / value / 1e9 for name, value in seconds.items()},
+        'speedup': seconds['sequential'] / seconds['parallel']
+    }
+    click.echo(json.dumps(result, indent=2))
+    if not no_save:
+        click.echo(f'Saved to {save_result("recheck", result, results_dir)}')
+
+
+if __name__ == '__main__':
+    main()
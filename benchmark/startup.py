@@ -0,0 +1,112 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import bencodepy
+import click
+from benchmark.util import REPO_DIRECTORY, RESULTS_DIRECTORY, save_result
+from simple_peer.bencode import decode
+from simple_peer.util import get_torrent_meta, SimpleClient
+
+
+CLIENT = os.path.join(REPO_DIRECTORY, 'simple_bittorrent_client.py')
+
+
+def make_torrent(path, length, piece_length):
+    """
+    Write a torrent of a file of length bytes with random piece
+    hashes, no file is hashed
+    """
+    piece_number = (length + piece_length - 1) // piece_length
+    torrent_dict = {
+        'announce': 'http://127.0.0.1:8080/announce',
+        'created by': SimpleClient.APP_NAME,
+        'creation date': int(time.time()),
+        'version': SimpleClient.VERSION,
+        'info': {
+            'name': os.path.basename(path)[:-len('.torrent')],
+            'length': length,
+            'piece length': piece_length,
+            'pieces': os.urandom(20 * piece_number)
+        }
+    }
+    with open(path, 'wb') as f:
+        f.write(bencodepy.encode(torrent_dict))
+
+
+def run_seconds(args, repeat):
+    """
+    :return: median wall time of running the client with args
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, CLIENT] + args, cwd=REPO_DIRECTORY, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds)
+
+
+def call_seconds(function, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds)
+
+
+@click.command()
+@click.option('--torrents', default=50, type=int, help="Torrents inspected by the batch meta")
+@click.option('--length', default=64 * 1024 * 1024 * 1024, type=int, help="Length of the file of the large torrent (byte)")
+@click.option('--piece-length', default=256 * 1024, type=int, help="Length of piece (byte)")
+@click.option('--repeat', default=5, type=int, help="Runs per measure, the median is kept")
+@click.option('--results-dir', default=RESULTS_DIRECTORY, type=str, help="Directory of the JSON results")
+@click.option('--no-save', is_flag=True, help="Only print the result")
+def main(torrents, length, piece_length, repeat, results_dir, no_save):
+    """
+    Startup time of the client commands, meta over many torrents
+    in one process or in one process each, and decoding a large
+    torrent fully against skipping its pieces
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        large_torrent = os.path.join(directory, 'large.torrent')
+        make_torrent(large_torrent, length, piece_length)
+        batch_directory = os.path.join(directory, 'batch')
+        os.makedirs(batch_directory)
+        for i in range(torrents):
+            make_torrent(os.path.join(batch_directory, f'file{i}.torrent'), 1024 * 1024 * 1024, piece_length)
+        batch_paths = [os.path.join(batch_directory, name) for name in sorted(os.listdir(batch_directory))]
+
+        with open(large_torrent, 'rb') as f:
+            large_data = f.read()
+        start = time.perf_counter()
+        for path in batch_paths:
+            run_seconds(['meta', '-t', path], 1)
+        process_per_torrent = time.perf_counter() - start
+        result = {
+            'config': {'torrents': torrents, 'length': length, 'piece_length': piece_length,
+                       'torrent_size': len(large_data)},
+            'help': run_seconds(['--help'], repeat),
+            'meta': run_seconds(['meta', '-t', large_torrent], repeat),
+            'batch_meta': {
+                'one_process': run_seconds(['meta', '-t', batch_directory], repeat),
+                'process_per_torrent': process_per_torrent
+            },
+            'decode_large': {
+                'bencodepy': call_seconds(lambda: bencodepy.decode(large_data), repeat),
+                'reader': call_seconds(lambda: decode(large_data), repeat),
+                'reader_skip_pieces': call_seconds(lambda: decode(large_data, 1024, {b'pieces'}), repeat),
+                'get_torrent_meta': call_seconds(lambda: get_torrent_meta(large_torrent), repeat)
+            }
+        }
+    click.echo(json.dumps(result, indent=2))
+    if not no_save:
+        click.echo(f'Saved to {save_result("startup", result, results_dir)}')
+
+
+if __name__ == '__main__':
+    main()
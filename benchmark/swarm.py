@@ -0,0 +1,199 @@
+import json
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import click
+from benchmark.util import REPO_DIRECTORY, RESULTS_DIRECTORY, generate_file, wait_for_http, resource_usage, \
+    percentile, tracker_announces, save_result
+from simple_peer.util import create_torrent, SimpleClient
+
+
+def rusage_to_dict(rusage):
+    # ru_maxrss is in KB on Linux
+    return {'cpu': rusage.ru_utime + rusage.ru_stime,
+            'rss': rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024}
+
+
+def wait_process(process):
+    """
+    Reap the process and return its resource usage
+    """
+    _, _, rusage = os.wait4(process.pid, 0)
+    process.returncode = 0
+    return rusage_to_dict(rusage)
+
+
+def pipe_events(process, events):
+    for line in process.stdout:
+        line = line.strip()
+        if line.startswith('{'):
+            events.put(json.loads(line))
+
+
+def wait_events(events, event_name, count, timeout):
+    received = []
+    deadline = time.monotonic() + timeout
+    while len(received) < count:
+        event = events.get(timeout=max(0.0, deadline - time.monotonic()))
+        if event['event'] == event_name:
+            received.append(event)
+    return received
+
+
+def run_subprocess_swarm(directory, torrent, source, seeders, leechers, tracker_ip, tracker_port, base_port,
+                         having_request_time, talker_checking, super_seed, timeout):
+    tracker = subprocess.Popen([sys.executable, 'simple_bittorrent_tracker.py', '--ip', tracker_ip, '--port', str(tracker_port)],
+                               cwd=REPO_DIRECTORY, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    tracker_url = f'http://{tracker_ip}:{tracker_port}'
+    peers = []
+    pipes = []
+    events = queue.Queue()
+    try:
+        wait_for_http(tracker_url)
+
+        def start_peer(mode, file, port):
+            process = subprocess.Popen([sys.executable, '-m', 'benchmark.swarm_peer', '--mode', mode, '--torrent', torrent,
+                                        '--file', file, '--ip', '127.0.0.1', '--port', str(port),
+                                        '--having-request-time', str(having_request_time),
+                                        '--talker-checking', str(talker_checking)] + (['--super-seed'] if super_seed else []),
+                                       cwd=REPO_DIRECTORY, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.DEVNULL, text=True)
+            pipe_thread = threading.Thread(target=pipe_events, args=(process, events), daemon=True)
+            pipe_thread.start()
+            pipes.append(pipe_thread)
+            peers.append(process)
+
+        for i in range(seeders):
+            start_peer('seed', source, base_port + i)
+        # leechers only learn about the peers announced before them
+        wait_events(events, 'ready', seeders, timeout)
+
+        start_time = time.perf_counter()
+        for i in range(leechers):
+            start_peer('join', os.path.join(directory, f'leecher-{i}.bin'), base_port + seeders + i)
+        completed = wait_events(events, 'completed', leechers + seeders, timeout)
+        wall_time = time.perf_counter() - start_time
+        announces = tracker_announces(tracker_url)
+    finally:
+        usages = []
+        for process in peers:
+            process.stdin.close()
+        for process in peers:
+            usages.append(wait_process(process))
+        tracker.terminate()
+        tracker_usage = wait_process(tracker)
+
+    for pipe_thread in pipes:
+        pipe_thread.join()
+    seeder_uploaded_bytes = 0
+    while not events.empty():
+        event = events.get()
+        if event['event'] == 'stopped' and event['port'] < base_port + seeders:
+            seeder_uploaded_bytes += event['uploaded_bytes']
+    completed = [event for event in completed if event['downloaded_bytes'] > 0]
+    return completed, wall_time, announces, usages, tracker_usage, seeder_uploaded_bytes
+
+
+def run_inprocess_swarm(directory, torrent, source, seeders, leechers, tracker_ip, tracker_port, base_port,
+                        having_request_time, talker_checking, super_seed, timeout):
+    import simple_bittorrent_tracker
+    from benchmark.swarm_peer import run_peer
+
+    SimpleClient.HAVING_REQUEST_TIME = having_request_time
+    SimpleClient.TALKER_CHECKING = talker_checking
+    tracker_url = f'http://{tracker_ip}:{tracker_port}'
+    threading.Thread(target=simple_bittorrent_tracker.run, args=(tracker_ip, tracker_port), daemon=True).start()
+    wait_for_http(tracker_url)
+
+    events = queue.Queue()
+    usage_before = resource_usage()
+
+    seeder_peers = []
+
+    def start_peer(mode, file, port):
+        def run():
+            peer = run_peer(mode, torrent, file, '127.0.0.1', port, events.put, super_seed)
+            if mode == 'seed':
+                seeder_peers.append(peer)
+        threading.Thread(target=run, daemon=True).start()
+
+    for i in range(seeders):
+        start_peer('seed', source, base_port + i)
+    wait_events(events, 'ready', seeders, timeout)
+
+    start_time = time.perf_counter()
+    for i in range(leechers):
+        start_peer('join', os.path.join(directory, f'leecher-{i}.bin'), base_port + seeders + i)
+    completed = wait_events(events, 'completed', leechers + seeders, timeout)
+    wall_time = time.perf_counter() - start_time
+    announces = tracker_announces(tracker_url)
+
+    usage_after = resource_usage()
+    # one process for the whole swarm, the tracker is included in the CPU
+    usage = {'cpu': usage_after['cpu'] - usage_before['cpu'], 'rss': usage_after['rss']}
+    completed = [event for event in completed if event['downloaded_bytes'] > 0]
+    seeder_uploaded_bytes = sum(peer.uploaded_bytes for peer in seeder_peers)
+    return completed, wall_time, announces, [usage], None, seeder_uploaded_bytes
+
+
+@click.command()
+@click.option('--seeders', default=1, type=int, help="Number of seeders")
+@click.option('--leechers', default=4, type=int, help="Number of leechers")
+@click.option('--size', default=64 * 1024 * 1024, type=int, help="Size of the generated file (byte)")
+@click.option('--piece-length', default=512 * 1024, type=int, help="Length of piece (byte)")
+@click.option('--mode', default='subprocess', type=click.Choice(['subprocess', 'inprocess']), help="Run the peers as processes or threads")
+@click.option('--tracker-port', default=18080, type=int)
+@click.option('--base-port', default=19000, type=int, help="Port of the first peer, the next peers use the following ports")
+@click.option('--having-request-time', default=0.5, type=float, help="Seconds between two HAVE requests")
+@click.option('--talker-checking', default=1.0, type=float, help="Seconds between two checks of the peer list")
+@click.option('--super-seed', is_flag=True, help="Seeders use super-seeding")
+@click.option('--timeout', default=600, type=float, help="Seconds to wait for the swarm to complete")
+@click.option('--results-dir', default=RESULTS_DIRECTORY, type=str, help="Directory of the JSON results")
+@click.option('--no-save', is_flag=True, help="Only print the result")
+def main(seeders, leechers, size, piece_length, mode, tracker_port, base_port, having_request_time, talker_checking,
+         super_seed, timeout, results_dir, no_save):
+    """
+    Loopback swarm benchmark: a tracker, seeders and leechers on 127.0.0.1
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'source.bin')
+        generate_file(source, size)
+        create_torrent(source, '127.0.0.1', tracker_port, piece_length, directory)
+        torrent = source + '.torrent'
+
+        run_swarm = run_subprocess_swarm if mode == 'subprocess' else run_inprocess_swarm
+        completed, wall_time, announces, usages, tracker_usage, seeder_uploaded_bytes = run_swarm(
+            directory, torrent, source, seeders, leechers, '127.0.0.1', tracker_port, base_port,
+            having_request_time, talker_checking, super_seed, timeout)
+
+    times = [event['elapsed'] for event in completed]
+    downloaded_bytes = sum(event['downloaded_bytes'] for event in completed)
+    cpu = sum(usage['cpu'] for usage in usages)
+    result = {
+        'config': {'seeders': seeders, 'leechers': leechers, 'size': size, 'piece_length': piece_length, 'mode': mode,
+                   'having_request_time': having_request_time, 'talker_checking': talker_checking,
+                   'super_seed': super_seed},
+        'wall_time': wall_time,
+        'time_to_complete': {'min': min(times), 'p50': percentile(times, 0.5), 'max': max(times)},
+        'downloaded_bytes': downloaded_bytes,
+        'aggregate_throughput': downloaded_bytes / wall_time,
+        # bytes the seeders uploaded per byte of the file
+        'seeder_upload_ratio': seeder_uploaded_bytes / size,
+        'cpu_seconds': cpu,
+        'cpu_per_gb': cpu / (downloaded_bytes / 1024 ** 3),
+        'peak_rss': max(usage['rss'] for usage in usages),
+        'tracker_requests': announces,
+        'tracker_requests_per_second': announces / wall_time,
+        'tracker_cpu_seconds': tracker_usage['cpu'] if tracker_usage else None
+    }
+    click.echo(json.dumps(result, indent=2))
+    if not no_save:
+        click.echo(f'Saved to {save_result("swarm", result, results_dir)}')
+
+
+if __name__ == '__main__':
+    main()
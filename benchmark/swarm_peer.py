@@ -0,0 +1,81 @@
+import json
+import sys
+import threading
+import time
+import click
+from simple_peer.listener import listener
+from simple_peer.re_announcer import re_announcer
+from simple_peer.super_seed import SuperSeeder
+from simple_peer.talker import talker
+from simple_peer.util import leecher_init, seeder_init, allocate_files, started_announce, \
+    stop_announce, get_piece_number, SimpleClient
+
+
+def run_peer(mode, torrent, file, ip, port, report, super_seed=False):
+    """
+    Run a seeder or a leecher of the benchmark swarm, same
+    threads as the join/seed commands without the prompts
+    :param mode: 'seed' or 'join'
+    :param torrent: path to the torrent
+    :param file: path to the file
+    :param ip: ip address of the peer
+    :param port: port of the peer
+    :param report: function called with the 'ready' and 'completed' events
+    :param super_seed: super-seeding, only for 'seed'
+    :return: the Peer
+    """
+    init = seeder_init if mode == 'seed' else leecher_init
+    peer, peer_lock, peer_pieces_tracking, peer_pieces_tracking_lock = init(torrent, file, ip, port)
+    if super_seed and mode == 'seed':
+        peer.super_seeder = SuperSeeder(get_piece_number(torrent))
+    if mode == 'join':
+        allocate_files(peer.torrent, peer.file, peer.priorities)
+
+    listener_thread = threading.Thread(target=listener, args=(peer, peer_pieces_tracking, peer_lock), daemon=True)
+    listener_thread.start()
+
+    interval, peers = started_announce(peer)
+    peers_lock = threading.Lock()
+    re_announcer_thread = threading.Thread(target=re_announcer, args=(interval, peer, peers, peers_lock), daemon=True)
+    re_announcer_thread.start()
+    report({'event': 'ready', 'port': port})
+
+    start_time = time.perf_counter()
+    if mode == 'join':
+        talker_thread = threading.Thread(target=talker, args=(peer, peers, peers_lock, peer_pieces_tracking, peer_lock, peer_pieces_tracking_lock), daemon=True)
+        talker_thread.start()
+    peer.wait_until_completed()
+    report({'event': 'completed', 'port': port, 'elapsed': time.perf_counter() - start_time,
+            'downloaded_bytes': peer.downloaded_bytes})
+    return peer
+
+
+@click.command()
+@click.option('--mode', required=True, type=click.Choice(['seed', 'join']))
+@click.option('--torrent', required=True, type=str)
+@click.option('--file', required=True, type=str)
+@click.option('--ip', required=False, default='127.0.0.1', type=str)
+@click.option('--port', required=True, type=int)
+@click.option('--having-request-time', required=False, default=SimpleClient.HAVING_REQUEST_TIME, type=float)
+@click.option('--talker-checking', required=False, default=SimpleClient.TALKER_CHECKING, type=float)
+@click.option('--super-seed', is_flag=True)
+def main(mode, torrent, file, ip, port, having_request_time, talker_checking, super_seed):
+    """
+    Subprocess entry of the swarm benchmark, reports its events as
+    JSON lines on stdout and keeps seeding until stdin is closed
+    """
+    SimpleClient.HAVING_REQUEST_TIME = having_request_time
+    SimpleClient.TALKER_CHECKING = talker_checking
+
+    def report(event):
+        print(json.dumps(event), flush=True)
+
+    peer = run_peer(mode, torrent, file, ip, port, report, super_seed)
+    # seed until the benchmark closes stdin
+    sys.stdin.read()
+    report({'event': 'stopped', 'port': port, 'uploaded_bytes': peer.uploaded_bytes})
+    stop_announce(peer)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+import heapq
+import json
+import os
+import queue
+import random
+import subprocess
+import sys
+import threading
+import time
+import click
+import requests
+from benchmark.profiler import CProfileAnnounceProfiler, SamplingAnnounceProfiler
+from benchmark.util import REPO_DIRECTORY, RESULTS_DIRECTORY, wait_for_http, percentile, save_result
+from simple_peer.rate_limiter import TokenBucket, consume
+
+
+EVENT_STARTED = 'STARTED'
+EVENT_STOPPED = 'STOPPED'
+EVENT_RE_ANNOUNCE = 'RE_ANNOUNCE'
+
+
+class SimulatedPeer:
+    def __init__(self, index, info_hash):
+        self.info_hash = info_hash
+        self.peer_id = f'LOAD{index:016d}'
+        self.peer_port = 20000 + index % 40000
+        self.left = random.randint(0, 1000)
+        self.started = False
+
+
+    def get_params(self, event):
+        return {
+            'info_hash': self.info_hash,
+            'peer_id': self.peer_id,
+            'peer_ip': '127.0.0.1',
+            'peer_port': self.peer_port,
+            'uploaded': 0,
+            'downloaded': 0,
+            'left': self.left,
+            'event': event
+        }
+
+
+class LoadGenerator:
+    """
+    Schedules the announces of many simulated peers, each peer
+    announces again after the interval returned by the tracker
+    (scaled by interval_scale to compress the time)
+    """
+    def __init__(self, announce_url, peers, swarms, rate, workers, stop_probability, interval_scale, restart_delay):
+        self.announce_url = announce_url
+        info_hashes = [os.urandom(20).hex() for _ in range(swarms)]
+        self.peers = [SimulatedPeer(i, info_hashes[i % swarms]) for i in range(peers)]
+        self.bucket = TokenBucket(rate, burst=max(1, rate // 10)) if rate else None
+        self.workers = workers
+        self.stop_probability = stop_probability
+        self.interval_scale = interval_scale
+        self.restart_delay = restart_delay
+        # (due time, index of the peer)
+        self.schedule = [(time.monotonic() + random.random(), i) for i in range(peers)]
+        heapq.heapify(self.schedule)
+        self.schedule_lock = threading.Lock()
+        self.work = queue.Queue(maxsize=workers * 4)
+        self.latencies = {EVENT_STARTED: [], EVENT_STOPPED: [], EVENT_RE_ANNOUNCE: []}
+        self.errors = 0
+        # announces refused by the tracker under overload
+        self.shed = {EVENT_STARTED: 0, EVENT_STOPPED: 0, EVENT_RE_ANNOUNCE: 0}
+        self.intervals = []
+        self.results_lock = threading.Lock()
+        self.running = False
+
+
+    def reschedule(self, due_time, index):
+        with self.schedule_lock:
+            heapq.heappush(self.schedule, (due_time, index))
+
+
+    def dispatcher(self):
+        while self.running:
+            with self.schedule_lock:
+                due_time, index = self.schedule[0] if self.schedule else (time.monotonic() + 0.01, None)
+                if index is not None and due_time <= time.monotonic():
+                    heapq.heappop(self.schedule)
+                else:
+                    index = None
+            if index is None:
+                time.sleep(min(0.01, max(0.0, due_time - time.monotonic())))
+                continue
+            if self.bucket:
+                consume((self.bucket,), 1)
+            # the workers may be gone when the run ends
+            while self.running:
+                try:
+                    self.work.put(index, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+
+    def worker(self):
+        session = requests.Session()
+        while self.running:
+            try:
+                index = self.work.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            peer = self.peers[index]
+            if not peer.started:
+                event = EVENT_STARTED
+            elif random.random() < self.stop_probability:
+                event = EVENT_STOPPED
+            else:
+                event = EVENT_RE_ANNOUNCE
+
+            start = time.perf_counter()
+            try:
+                response = session.get(self.announce_url, params=peer.get_params(event), timeout=10)
+                latency = time.perf_counter() - start
+                if response.status_code == 503:
+                    with self.results_lock:
+                        self.shed[event] += 1
+                    self.reschedule(time.monotonic() + int(response.headers['Retry-After']) * self.interval_scale, index)
+                    continue
+                if response.status_code != 200:
+                    raise Exception(response.status_code)
+            except Exception:
+                with self.results_lock:
+                    self.errors += 1
+                self.reschedule(time.monotonic() + self.restart_delay, index)
+                continue
+
+            with self.results_lock:
+                self.latencies[event].append(latency)
+
+            if event == EVENT_STOPPED:
+                peer.started = False
+                self.reschedule(time.monotonic() + self.restart_delay, index)
+            else:
+                peer.started = True
+                interval = response.json()['interval']
+                with self.results_lock:
+                    self.intervals.append(interval)
+                self.reschedule(time.monotonic() + interval * self.interval_scale, index)
+
+
+    def run(self, duration):
+        self.running = True
+        threads = [threading.Thread(target=self.dispatcher, daemon=True)]
+        threads += [threading.Thread(target=self.worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        self.running = False
+        for thread in threads:
+            thread.join()
+
+
+def histogram_summary(metrics_text, name):
+    """
+    :return: (count, sum) of a histogram read from a Prometheus text export
+    """
+    count, total = 0, 0.0
+    for line in metrics_text.splitlines():
+        if line.startswith(name + '_count'):
+            count += float(line.rsplit(' ', 1)[1])
+        elif line.startswith(name + '_sum'):
+            total += float(line.rsplit(' ', 1)[1])
+    return count, total
+
+
+def histogram_over(metrics_text, name, bound):
+    """
+    :return: number of observations greater than bound
+    """
+    count, under = 0, 0
+    for line in metrics_text.splitlines():
+        if line.startswith(name + '_count'):
+            count = float(line.rsplit(' ', 1)[1])
+        elif line.startswith(name + '_bucket') and f'le="{bound}"' in line:
+            under = float(line.rsplit(' ', 1)[1])
+    return count - under
+
+
+@click.command()
+@click.option('--url', default=None, type=str, help="Base URL of a running tracker, default to start one on 127.0.0.1")
+@click.option('--tracker-port', default=18081, type=int, help="Port of the started tracker")
+@click.option('--peers', default=5000, type=int, help="Number of simulated peers")
+@click.option('--swarms', default=100, type=int, help="Number of swarms the peers are spread over")
+@click.option('--rate', default=0, type=int, help="Maximum announces per second, default to be 0 (unlimited)")
+@click.option('--workers', default=32, type=int, help="Concurrent HTTP clients")
+@click.option('--duration', default=30, type=float, help="Seconds of load")
+@click.option('--stop-probability', default=0.05, type=float, help="Probability that an announce is STOPPED")
+@click.option('--interval-scale', default=0.05, type=float, help="Factor applied to the interval returned by the tracker")
+@click.option('--restart-delay', default=1.0, type=float, help="Seconds before a stopped peer starts again")
+@click.option('--target-rate', default=500, type=int, help="Announces per second the started tracker aims its intervals at")
+@click.option('--max-in-flight', default=64, type=int, help="Announces the started tracker handles at once before shedding")
+@click.option('--max-rate', default=2000, type=int, help="Announces per second the started tracker handles before shedding")
+@click.option('--profile', default='none', type=click.Choice(['none', 'cprofile', 'sampling']),
+              help="Profile the announce handler, the tracker then runs in this process")
+@click.option('--profile-output', default=None, type=str, help="File of the profile (.prof for cprofile)")
+@click.option('--results-dir', default=RESULTS_DIRECTORY, type=str, help="Directory of the JSON results")
+@click.option('--no-save', is_flag=True, help="Only print the result")
+def main(url, tracker_port, peers, swarms, rate, workers, duration, stop_probability, interval_scale, restart_delay,
+         target_rate, max_in_flight, max_rate, profile, profile_output, results_dir, no_save):
+    """
+    Announce load generator and latency profiler of the tracker
+    """
+    tracker = None
+    profiler = None
+    if url is None:
+        url = f'http://127.0.0.1:{tracker_port}'
+        if profile == 'none':
+            tracker = subprocess.Popen([sys.executable, 'simple_bittorrent_tracker.py', '--ip', '127.0.0.1', '--port', str(tracker_port),
+                                        '--target-rate', str(target_rate), '--max-in-flight', str(max_in_flight),
+                                        '--max-rate', str(max_rate)],
+                                       cwd=REPO_DIRECTORY, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            import logging
+            import simple_bittorrent_tracker
+            logging.getLogger('werkzeug').setLevel(logging.ERROR)
+            profiler = CProfileAnnounceProfiler() if profile == 'cprofile' else SamplingAnnounceProfiler()
+            simple_bittorrent_tracker.announce_profiler = profiler
+            simple_bittorrent_tracker.load_controller.target_rate = target_rate
+            simple_bittorrent_tracker.load_controller.max_in_flight = max_in_flight
+            simple_bittorrent_tracker.load_controller.max_rate = max_rate
+            threading.Thread(target=simple_bittorrent_tracker.run, args=('127.0.0.1', tracker_port), daemon=True).start()
+    elif profile != 'none':
+        raise click.UsageError('--profile needs the tracker started by the load generator')
+
+    try:
+        wait_for_http(url)
+        metrics_before = requests.get(url + '/metrics').text
+        load_generator = LoadGenerator(url + '/announce', peers, swarms, rate, workers, stop_probability,
+                                       interval_scale, restart_delay)
+        if isinstance(profiler, SamplingAnnounceProfiler):
+            profiler.start()
+        load_generator.run(duration)
+        if isinstance(profiler, SamplingAnnounceProfiler):
+            profiler.stop()
+        metrics_after = requests.get(url + '/metrics').text
+    finally:
+        if tracker is not None:
+            tracker.terminate()
+            tracker.wait()
+
+    latencies = [latency for event_latencies in load_generator.latencies.values() for latency in event_latencies]
+    wait_count, wait_sum = [after - before for after, before in zip(histogram_summary(metrics_after, 'tracker_lock_wait_seconds'),
+                                                                      histogram_summary(metrics_before, 'tracker_lock_wait_seconds'))]
+    hold_count, hold_sum = [after - before for after, before in zip(histogram_summary(metrics_after, 'tracker_lock_hold_seconds'),
+                                                                      histogram_summary(metrics_before, 'tracker_lock_hold_seconds'))]
+    contended = (histogram_over(metrics_after, 'tracker_lock_wait_seconds', 0.0001)
+                 - histogram_over(metrics_before, 'tracker_lock_wait_seconds', 0.0001))
+    result = {
+        'config': {'peers': peers, 'swarms': swarms, 'rate': rate, 'workers': workers, 'duration': duration,
+                   'stop_probability': stop_probability, 'interval_scale': interval_scale,
+                   'target_rate': target_rate, 'max_in_flight': max_in_flight,
+                   'max_rate': max_rate, 'profile': profile},
+        'requests': len(latencies),
+        'errors': load_generator.errors,
+        'shed': load_generator.shed,
+        'interval': {'p50': percentile(load_generator.intervals, 0.5), 'max': max(load_generator.intervals, default=0)},
+        'throughput': len(latencies) / duration,
+        'latency': {'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99), 'max': max(latencies, default=0)},
+        'latency_per_event': {event: {'requests': len(values), 'p50': percentile(values, 0.5), 'p99': percentile(values, 0.99)}
+                              for event, values in load_generator.latencies.items()},
+        'lock': {
+            'acquisitions': wait_count,
+            'mean_wait': wait_sum / wait_count if wait_count else 0,
+            'mean_hold': hold_sum / hold_count if hold_count else 0,
+            'contended_over_100us': contended,
+            'wait_to_hold_ratio': wait_sum / hold_sum if hold_sum else 0
+        }
+    }
+    click.echo(json.dumps(result, indent=2))
+    if profiler is not None:
+        click.echo(profiler.report(profile_output))
+    if not no_save:
+        click.echo(f'Saved to {save_result("tracker_load", result, results_dir)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import requests
+
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIRECTORY = os.path.join(REPO_DIRECTORY, 'benchmark', 'results')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIRECTORY,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        return 'unknown'
+
+
+def save_result(name, result, results_directory=RESULTS_DIRECTORY):
+    """
+    Store a benchmark result as JSON, named after the benchmark,
+    the commit and the time so that runs can be compared across commits
+    :param name: name of the benchmark
+    :param result: dictionary of the result
+    :param results_directory: directory of the results
+    :return: path of the JSON file
+    """
+    os.makedirs(results_directory, exist_ok=True)
+    commit = git_commit()
+    result = {
+        'benchmark': name,
+        'commit': commit,
+        'time': int(time.time()),
+        'python': sys.version.split()[0],
+        'result': result
+    }
+    path = os.path.join(results_directory, f'{name}-{commit}-{result["time"]}.json')
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+    return path
+
+
+def generate_file(path, size, chunk_size=1024 * 1024):
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            to_write = min(chunk_size, size - written)
+            f.write(os.urandom(to_write))
+            written += to_write
+
+
+def wait_for_http(url, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def resource_usage(who=resource.RUSAGE_SELF):
+    """
+    :return: dictionary of CPU seconds and peak RSS (byte) of the process or its children
+    """
+    usage = resource.getrusage(who)
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return {'cpu': usage.ru_utime + usage.ru_stime, 'rss': rss}
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def tracker_announces(tracker_url):
+    """
+    :return: total announces counted by the tracker /metrics endpoint
+    """
+    total = 0
+    for line in requests.get(tracker_url + '/metrics').text.splitlines():
+        if line.startswith('tracker_announces_total'):
+            total += float(line.rsplit(' ', 1)[1])
+    return total
@@ -1,14 +1,14 @@
+import json
+import os
 import threading
 import click
 import pprint
 import logging
 from simple_peer.config import DEBUG, INFO, DEMO
-from simple_peer.re_announcer import re_announcer
-from simple_peer.talker import talker
-from simple_peer.listener import listener
-from simple_peer.util import create_torrent, create_file, get_torrent_dic, get_file_length, \
-    started_announce, is_download_completed, SimpleClient, stop_announce, leecher_init, seeder_init, \
-    init_progress_bar
+from simple_peer.util import SimpleClient
+
+# the modules of the peer (flask, requests, the protocol) are
+# imported by the commands using them, meta and torrent start fast
 
 
 logger = logging.getLogger(SimpleClient.APP_NAME)
@@ -23,51 +23,235 @@ if DEMO:
     logging.basicConfig(level=logging.ERROR)
 
 
+def start_metrics_dumper(metrics_file):
+    from simple_metrics.metrics import metrics_dumper
+    from simple_peer.metrics import registry
+    if metrics_file:
+        metrics_dumper_thread = threading.Thread(target=metrics_dumper, args=(registry, metrics_file, SimpleClient.METRICS_INTERVAL), daemon=True)
+        metrics_dumper_thread.start()
+
+
+def start_trace(peer, trace_file):
+    from simple_peer.trace import EventTrace
+    if trace_file:
+        peer.trace = EventTrace(trace_file, peer.info_hash)
+        peer.trace.start()
+
+
+def close_trace(peer):
+    if peer.trace is not None:
+        peer.trace.close()
+
+
+def start_local_discovery(peer):
+    from simple_peer.local_discovery import LocalDiscovery
+    simple_local_discovery = LocalDiscovery(peer.peer_ip)
+    simple_local_discovery.start()
+    simple_local_discovery.register(peer)
+
+
 @click.group()
 def cli():
     pass
 
 
 @cli.command()
-@click.option('-f', '--file', required=True, type=str, help="Name of file")
+@click.option('-f', '--file', required=True, type=str, help="Name of file, or directory for a multi-file torrent")
 @click.option('-ip', '--ip', required=True, type=str, help="IP address of tracker")
 @click.option('-p', '--port', required=True, type=int, help="Port of tracker")
-@click.option('-pl', '--piece-length', required=False, default = 512 * 1024, type=int, help="Length of piece (byte), default to be 512KB")
+@click.option('-pl', '--piece-length', required=False, default = 512 * 1024, type=int, help="Length of piece (byte), default to be 512KB, at most 16MB")
 @click.option('-d', '--destination', required=True, type=str, help="Destination directory")
-def torrent(file, ip, port, piece_length, destination):
+@click.option('-w', '--web-seed', multiple=True, type=str, help="URL of an HTTP server hosting the file (web seed), repeatable")
+@click.option('-v2', '--v2', is_flag=True, help="Hybrid v1/v2 torrent with SHA256 Merkle trees, verified per 16KB block")
+@click.option('-tr', '--tracker', multiple=True, type=str, help="Backup tier of announce urls separated by commas (announce-list), repeatable")
+def torrent(file, ip, port, piece_length, destination, web_seed, v2, tracker):
+    from simple_peer.util import create_torrent
     try:
-        create_torrent(file, ip, port, piece_length, destination)
+        create_torrent(file, ip, port, piece_length, destination, web_seed, v2, tracker)
         click.echo(f'Creating torrent from file {file}')
         click.echo(f'Saving torrent to {destination}')
     except Exception as e:
         logger.error(str(e))
 
 
+def get_torrent_paths(torrents):
+    """
+    :param torrents: torrent files, or directories of torrent files
+    :return: generator of the torrent files
+    """
+    for torrent in torrents:
+        if os.path.isdir(torrent):
+            for name in sorted(os.listdir(torrent)):
+                if name.endswith('.torrent'):
+                    yield os.path.join(torrent, name)
+        else:
+            yield torrent
+
+
+@cli.command()
+@click.option('-t', '--torrent', 'torrents', required=True, multiple=True, type=str,
+              help="Name of torrent, or directory of torrents, repeatable")
+@click.option('-j', '--json', 'as_json', is_flag=True, help="One JSON object per torrent, byte strings in hex")
+def meta(torrents, as_json):
+    from simple_peer.util import get_torrent_meta
+    batch = len(torrents) > 1 or os.path.isdir(torrents[0])
+    for torrent in get_torrent_paths(torrents):
+        try:
+            torrent_dic = get_torrent_meta(torrent)
+        except Exception as e:
+            logger.error(f'{torrent}: {e}' if batch else str(e))
+            continue
+        if as_json:
+            click.echo(json.dumps({'torrent': torrent, 'meta': torrent_dic}, default=lambda value: bytes(value).hex()))
+        else:
+            if batch:
+                click.echo(f'==> {torrent} <==')
+            pprint.pprint(torrent_dic)
+
+
+@cli.command()
+@click.option('-tf', '--trace-file', required=True, type=str, help="Trace recorded by join or stream")
+@click.option('-pi', '--peer-id', required=False, default=None, type=str, help="Print the timeline of this server peer")
+@click.option('-n', '--top', required=False, default=10, type=int, help="Pieces listed on the critical path, default to be 10")
+@click.option('-j', '--json', 'as_json', is_flag=True, help="Print the analysis as JSON")
+def trace(trace_file, peer_id, top, as_json):
+    """
+    Analyze a transfer trace: per-peer timelines, request pipeline
+    occupancy and the pieces on the critical path
+    """
+    from simple_peer.trace import read_trace, analyze_trace, peer_timeline
+    try:
+        header, records = read_trace(trace_file)
+    except Exception as e:
+        logger.error(str(e))
+        return
+    if peer_id is not None:
+        timeline = peer_timeline(records, peer_id)
+        if as_json:
+            click.echo(json.dumps(timeline))
+        for t, event, piece, begin, length in ([] if as_json else timeline):
+            click.echo(f'{t:10.6f}  {event:<10}  piece {piece:<6}  begin {begin:<8}  length {length}')
+        return
+    analysis = analyze_trace(header, records, top)
+    if as_json:
+        click.echo(json.dumps(analysis, indent=2))
+        return
+    click.echo(f'{analysis["events"]} events over {analysis["duration"]:.3f}s, {analysis["dropped"]} dropped')
+    click.echo('Peers:')
+    for peer in analysis['peers']:
+        pipeline = peer['pipeline']
+        click.echo(f'  [{peer["peer_id"]}] {peer["bytes"]} bytes in {peer["connected_seconds"]:.3f}s, '
+                   f'{peer["blocks"]}/{peer["requests"]} requests answered, {peer["rejects"]} rejected, '
+                   f'{peer["hash_failures"]} wrong, {peer["chokes"]} chokes, latency p50 {format_seconds(peer["latency"]["p50"])}, '
+                   f'pipeline mean {format_number(pipeline["mean"])} max {pipeline["max"]} idle {format_number(pipeline["idle"])}')
+    pieces = analysis['pieces']
+    click.echo(f'Pieces: {pieces["completed"]} completed, {pieces["incomplete"]} incomplete, '
+               f'p50 written at {format_seconds(pieces["p50_written"])}, p90 at {format_seconds(pieces["p90_written"])}, '
+               f'last at {format_seconds(pieces["last_written"])}')
+    click.echo('  mean stage: ' + ', '.join(f'{stage} {format_seconds(seconds)}' for stage, seconds in pieces['stages'].items()))
+    for title in ('critical_path', 'slowest_pieces'):
+        click.echo(title.replace('_', ' ').capitalize() + ':')
+        for piece in analysis[title]:
+            click.echo(f'  piece [{piece["piece"]}] from [{piece["peer_id"]}] written at {piece["written"]:.3f}s, '
+                       f'queued {piece["queued"]:.3f}s retries {piece["retries"]:.3f}s transfer {piece["transfer"]:.3f}s '
+                       f'verify {piece["verify"]:.3f}s write {piece["write"]:.3f}s')
+
+
 @cli.command()
 @click.option('-t', '--torrent', required=True, type=str, help="Name of torrent")
-def meta(torrent):
+@click.option('-f', '--file', required=True, type=str, help="Name of file, or directory of a multi-file torrent")
+@click.option('-w', '--workers', required=False, default=SimpleClient.HASH_WORKERS, type=int, help="Hashing threads, default to the number of cores")
+@click.option('-rf', '--resume-file', required=False, default=None, type=str, help="Save the valid pieces as resume data for join/seed --resume-file")
+@click.option('-b', '--baseline', is_flag=True, help="Hash sequentially first and compare the rates")
+@click.option('-j', '--json', 'as_json', is_flag=True, help="Print the report as JSON")
+def recheck(torrent, file, workers, resume_file, baseline, as_json):
+    """
+    Verify the data on disk against the piece hashes of the torrent
+    """
+    from simple_peer.recheck import recheck_torrent, write_resume, piece_ranges, bitfield_map
     try:
-        torrent_dic = get_torrent_dic(torrent)
-        torrent_dic['info']['pieces'] = '***'
-        pprint.pprint(torrent_dic)
+        sequential = recheck_torrent(torrent, file, workers=1) if baseline else None
+        result = recheck_torrent(torrent, file, workers)
+        if resume_file:
+            write_resume(resume_file, result)
     except Exception as e:
         logger.error(str(e))
+        return
+    valid = set(result['valid_pieces'])
+    missing_ranges = piece_ranges([i for i in range(result['piece_number']) if i not in valid])
+    if as_json:
+        report = {key: value for key, value in result.items() if key != 'files'}
+        report['missing'] = missing_ranges
+        report['workers'] = workers
+        if sequential is not None:
+            report['baseline'] = {'seconds': sequential['seconds'], 'rate': sequential['rate']}
+        click.echo(json.dumps(report))
+        return
+    click.echo(f'[{bitfield_map(result["valid_pieces"], result["piece_number"])}]')
+    click.echo(f'{len(valid)}/{result["piece_number"]} pieces valid')
+    if missing_ranges:
+        click.echo('Missing or wrong pieces: ' + ', '.join(str(first) if first == last else f'{first}-{last}'
+                                                          for first, last in missing_ranges))
+    click.echo(f'Hashed {result["bytes"] / 1e9:.2f} GB in {result["seconds"]:.2f}s, '
+               f'{format_rate(result["rate"])} with {workers} workers')
+    if sequential is not None:
+        click.echo(f'Sequential baseline {format_rate(sequential["rate"])}, '
+                   f'speedup {sequential["seconds"] / result["seconds"]:.2f}x')
+    if resume_file:
+        click.echo(f'Saving resume data to {resume_file}')
+
+
+def format_rate(rate):
+    return '-' if rate is None else f'{rate / 1e9:.2f} GB/s'
+
+
+def format_seconds(seconds):
+    return '-' if seconds is None else f'{seconds:.3f}s'
+
+
+def format_number(number):
+    return '-' if number is None else f'{number:.2f}'
 
 
 @cli.command()
 @click.option('-t', '--torrent', required=True, type=str, help="Name of torrent")
-@click.option('-f', '--file', required=True, type=str, help="Name of file")
+@click.option('-f', '--file', required=True, type=str, help="Name of file, or directory of a multi-file torrent")
 @click.option('-ip', '--ip', required=True, type=str, help="IP address of peer")
 @click.option('-p', '--port', required=True, type=int, help="Port of the peer")
-def join(torrent, file, ip, port):
+@click.option('-ur', '--upload-rate', required=False, default=0, type=int, help="Global upload limit (KB/s), default to be 0 (unlimited)")
+@click.option('-dr', '--download-rate', required=False, default=0, type=int, help="Global download limit (KB/s), default to be 0 (unlimited)")
+@click.option('-mf', '--metrics-file', required=False, default=None, type=str, help="Periodically dump the metrics as JSON into this file")
+@click.option('-lsd', '--local-discovery', is_flag=True, help="Discover the peers of the local network by multicast")
+@click.option('-s', '--select', multiple=True, type=str, help="Download only '<file pattern>[:priority]' or 'bytes=<start>-<end>[:priority]', priority in skip/low/normal/high, repeatable")
+@click.option('-st', '--site', required=False, default=None, type=str, help="Site of the peer sent to the tracker, e.g. 'eu-west/dc1', peers of the same site are preferred")
+@click.option('-tf', '--trace-file', required=False, default=None, type=str, help="Record the transfer events into this binary trace, read by the trace command")
+@click.option('-rf', '--resume-file', required=False, default=None, type=str, help="Resume data of recheck, the valid pieces are not downloaded again")
+def join(torrent, file, ip, port, upload_rate, download_rate, metrics_file, local_discovery, select, site, trace_file, resume_file):
+    from simple_peer.listener import listener
+    from simple_peer.rate_limiter import global_bandwidth
+    from simple_peer.re_announcer import re_announcer
+    from simple_peer.talker import talker
+    from simple_peer.util import allocate_files, started_announce, is_download_completed, stop_announce, \
+        leecher_init, init_progress_bar
     try:
+        global_bandwidth.set_limits(upload_rate * 1024, download_rate * 1024)
+        start_metrics_dumper(metrics_file)
         (peer,
          peer_lock,
          peer_pieces_tracking,
          peer_pieces_tracking_lock) = leecher_init(torrent, file, ip, port)
+        peer.site = site
+        start_trace(peer, trace_file)
 
+        if select:
+            peer.priorities.select(select)
+            peer.update_left(peer_pieces_tracking, peer_pieces_tracking_lock)
 
-        create_file(peer.file, get_file_length(peer.torrent))
+        if resume_file:
+            from simple_peer.recheck import load_resume, resume_pieces
+            resume_pieces(peer, peer_pieces_tracking, peer_pieces_tracking_lock, load_resume(resume_file, torrent, file))
+        # the checked data is kept
+        allocate_files(peer.torrent, peer.file, peer.priorities, overwrite=not resume_file)
 
         interval, peers = started_announce(peer)
         peers_lock = threading.Lock()
@@ -78,6 +262,9 @@ def join(torrent, file, ip, port):
         re_announcer_thread = threading.Thread(target=re_announcer, args=(interval, peer, peers, peers_lock), daemon=True)
         re_announcer_thread.start()
 
+        if local_discovery:
+            start_local_discovery(peer)
+
 
         # talker
         talker_thread = threading.Thread(target=talker, args=(peer, peers, peers_lock, peer_pieces_tracking, peer_lock, peer_pieces_tracking_lock), daemon=True)
@@ -93,6 +280,9 @@ def join(torrent, file, ip, port):
             init_progress_bar(peer)
 
 
+        # block until the talker signals completion, no busy-waiting
+        peer.wait_until_completed()
+        close_trace(peer)
         while True:
             if is_download_completed(peer):
                 print('')
@@ -111,15 +301,97 @@ def join(torrent, file, ip, port):
 
 @cli.command()
 @click.option('-t', '--torrent', required=True, type=str, help="Name of torrent")
-@click.option('-f', '--file', required=True, type=str, help="Name of file saved")
+@click.option('-f', '--file', required=True, type=str, help="Name of file, or directory of a multi-file torrent")
 @click.option('-ip', '--ip', required=True, type=str, help="IP address of peer")
 @click.option('-p', '--port', required=True, type=int, help="Port of the peer")
-def seed(torrent, file, ip, port):
+@click.option('-n', '--name', required=False, default=None, type=str, help="File of a multi-file torrent to stream, default to the whole torrent")
+@click.option('-o', '--output', required=False, default='-', type=click.File('wb'), help="Where the data is written as it downloads, default to stdout")
+@click.option('-ur', '--upload-rate', required=False, default=0, type=int, help="Global upload limit (KB/s), default to be 0 (unlimited)")
+@click.option('-dr', '--download-rate', required=False, default=0, type=int, help="Global download limit (KB/s), default to be 0 (unlimited)")
+@click.option('-st', '--site', required=False, default=None, type=str, help="Site of the peer sent to the tracker, e.g. 'eu-west/dc1', peers of the same site are preferred")
+@click.option('-tf', '--trace-file', required=False, default=None, type=str, help="Record the transfer events into this binary trace, read by the trace command")
+def stream(torrent, file, ip, port, name, output, upload_rate, download_rate, site, trace_file):
+    from simple_peer.listener import listener
+    from simple_peer.rate_limiter import global_bandwidth
+    from simple_peer.re_announcer import re_announcer
+    from simple_peer.stream import StreamReader
+    from simple_peer.talker import talker
+    from simple_peer.util import allocate_files, started_announce, stop_announce, leecher_init
     try:
+        global_bandwidth.set_limits(upload_rate * 1024, download_rate * 1024)
+        (peer,
+         peer_lock,
+         peer_pieces_tracking,
+         peer_pieces_tracking_lock) = leecher_init(torrent, file, ip, port)
+        peer.site = site
+        start_trace(peer, trace_file)
+
+        if name is not None:
+            peer.priorities.select([name])
+            peer.update_left(peer_pieces_tracking, peer_pieces_tracking_lock)
+        allocate_files(peer.torrent, peer.file, peer.priorities)
+        reader = StreamReader(peer, peer_pieces_tracking, name)
+
+        interval, peers = started_announce(peer)
+        peers_lock = threading.Lock()
+
+        re_announcer_thread = threading.Thread(target=re_announcer, args=(interval, peer, peers, peers_lock), daemon=True)
+        re_announcer_thread.start()
+
+        talker_thread = threading.Thread(target=talker, args=(peer, peers, peers_lock, peer_pieces_tracking, peer_lock, peer_pieces_tracking_lock), daemon=True)
+        talker_thread.start()
+
+        listener_thread = threading.Thread(target=listener, args=(peer, peer_pieces_tracking, peer_lock), daemon=True)
+        listener_thread.start()
+
+        # write the data as soon as the pieces under the cursor are verified
+        with reader:
+            data = reader.read(SimpleClient.STREAM_CHUNK_LENGTH)
+            while data:
+                output.write(data)
+                output.flush()
+                data = reader.read(SimpleClient.STREAM_CHUNK_LENGTH)
+        close_trace(peer)
+        stop_announce(peer)
+    except Exception as e:
+        logger.error(str(e))
+
+
+@cli.command()
+@click.option('-t', '--torrent', required=True, type=str, help="Name of torrent")
+@click.option('-f', '--file', required=True, type=str, help="Name of file saved, or directory of a multi-file torrent")
+@click.option('-ip', '--ip', required=True, type=str, help="IP address of peer")
+@click.option('-p', '--port', required=True, type=int, help="Port of the peer")
+@click.option('-ur', '--upload-rate', required=False, default=0, type=int, help="Global upload limit (KB/s), default to be 0 (unlimited)")
+@click.option('-dr', '--download-rate', required=False, default=0, type=int, help="Global download limit (KB/s), default to be 0 (unlimited)")
+@click.option('-mf', '--metrics-file', required=False, default=None, type=str, help="Periodically dump the metrics as JSON into this file")
+@click.option('-lsd', '--local-discovery', is_flag=True, help="Discover the peers of the local network by multicast")
+@click.option('-ss', '--super-seed', is_flag=True, help="Super-seeding, advertise pieces to each peer selectively")
+@click.option('-st', '--site', required=False, default=None, type=str, help="Site of the peer sent to the tracker, e.g. 'eu-west/dc1', peers of the same site are preferred")
+@click.option('-rf', '--resume-file', required=False, default=None, type=str, help="Resume data of recheck, refuse to seed data that is incomplete or changed since")
+def seed(torrent, file, ip, port, upload_rate, download_rate, metrics_file, local_discovery, super_seed, site, resume_file):
+    from simple_peer.listener import listener
+    from simple_peer.rate_limiter import global_bandwidth
+    from simple_peer.re_announcer import re_announcer
+    from simple_peer.super_seed import SuperSeeder
+    from simple_peer.util import started_announce, is_download_completed, stop_announce, seeder_init, \
+        get_piece_number
+    try:
+        if resume_file:
+            from simple_peer.recheck import load_resume
+            missing = get_piece_number(torrent) - len(load_resume(resume_file, torrent, file))
+            if missing:
+                raise ValueError(f'{missing} pieces are missing or wrong, join to download them')
+        global_bandwidth.set_limits(upload_rate * 1024, download_rate * 1024)
+        start_metrics_dumper(metrics_file)
         (peer,
          peer_lock,
          peer_pieces_tracking,
          peer_pieces_tracking_lock) = seeder_init(torrent, file, ip, port)
+        peer.site = site
+
+        if super_seed:
+            peer.super_seeder = SuperSeeder(get_piece_number(peer.torrent))
 
 
         interval, peers = started_announce(peer)
@@ -132,12 +404,16 @@ def seed(torrent, file, ip, port):
         re_announcer_thread = threading.Thread(target=re_announcer, args=(interval, peer, peers, peers_lock), daemon=True)
         re_announcer_thread.start()
 
+        if local_discovery:
+            start_local_discovery(peer)
+
 
         # listener
         listener_thread = threading.Thread(target=listener, args=(peer, peer_pieces_tracking, peer_lock), daemon=True)
         listener_thread.start()
 
 
+        peer.wait_until_completed()
         while True:
             if is_download_completed(peer):
                 print('')
@@ -154,5 +430,32 @@ def seed(torrent, file, ip, port):
         logger.error(str(e))
 
 
+@cli.command()
+@click.option('-ip', '--ip', required=True, type=str, help="IP address of peer")
+@click.option('-p', '--port', required=True, type=int, help="Port of the peer, shared by every torrent")
+@click.option('-cp', '--control-port', required=False, default=SimpleClient.DAEMON_CONTROL_PORT, type=int, help="Port of the local control API (127.0.0.1)")
+@click.option('-ur', '--upload-rate', required=False, default=0, type=int, help="Global upload limit (KB/s), default to be 0 (unlimited)")
+@click.option('-dr', '--download-rate', required=False, default=0, type=int, help="Global download limit (KB/s), default to be 0 (unlimited)")
+@click.option('-pur', '--peer-upload-rate', required=False, default=0, type=int, help="Upload limit per peer (KB/s), default to be 0 (unlimited)")
+@click.option('-pdr', '--peer-download-rate', required=False, default=0, type=int, help="Download limit per peer (KB/s), default to be 0 (unlimited)")
+@click.option('-lsd', '--local-discovery', is_flag=True, help="Discover the peers of the local network by multicast")
+@click.option('-st', '--site', required=False, default=None, type=str, help="Site of the peer sent to the tracker, e.g. 'eu-west/dc1', peers of the same site are preferred")
+def daemon(ip, port, control_port, upload_rate, download_rate, peer_upload_rate, peer_download_rate, local_discovery, site):
+    from simple_peer.daemon import SimpleDaemon, create_control_app
+    from simple_peer.rate_limiter import global_bandwidth
+    try:
+        global_bandwidth.set_limits(upload_rate * 1024, download_rate * 1024,
+                                    peer_upload_rate * 1024, peer_download_rate * 1024)
+        simple_daemon = SimpleDaemon(ip, port, local_discovery=local_discovery, site=site)
+        simple_daemon.start()
+        click.echo(f'Daemon listening on [{ip}][{port}], control API on http://127.0.0.1:{control_port}/torrents')
+        try:
+            create_control_app(simple_daemon).run(host='127.0.0.1', port=control_port, threaded=True)
+        finally:
+            simple_daemon.shutdown()
+    except Exception as e:
+        logger.error(str(e))
+
+
 if __name__ == '__main__':
     cli()
\ No newline at end of file
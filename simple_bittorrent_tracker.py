@@ -1,8 +1,14 @@
 from simple_tracker.cleaner import cleaner
+from simple_tracker.locality import SiteIndex, load_site_map
+from simple_tracker.load import LoadController
+from simple_metrics.metrics import TimedLock
+from simple_tracker.metrics import registry, register_swarm_gauges, register_load_gauges, ANNOUNCES, ANNOUNCE_LATENCY, \
+    SHED_ANNOUNCES, LOCK_WAIT, LOCK_HOLD
 from simple_tracker.util import SimpleTracker, announce_parse_request, announce_handler_lack_info, \
     announce_handler_stopped_event, announce_handler_started_event, announce_handler_re_announce_event, \
     announce_handler_swarm_response
 from flask import Flask, jsonify
+import click
 import threading
 import logging
 
@@ -17,44 +23,89 @@ logger = logging.getLogger("announce")
 #       'info_hash': [list of peers (object)]
 #   }
 peers_db = {}
-peers_db_lock = threading.Lock()
+peers_db_lock = TimedLock(LOCK_WAIT, LOCK_HOLD)
+register_swarm_gauges(peers_db, peers_db_lock)
+# peers of every swarm grouped by site, guarded by peers_db_lock
+site_index = SiteIndex()
+# announce intervals and load shedding
+load_controller = LoadController()
+register_load_gauges(load_controller, site_index)
+
+# set by the load generator to profile the announce handler
+announce_profiler = None
 
 @simple_bittorrent_tracker.route('/', methods=['GET'])
 def test():
     return 'Hello', 200
 
 
+@simple_bittorrent_tracker.route('/metrics', methods=['GET'])
+def metrics():
+    return registry.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
 @simple_bittorrent_tracker.route('/announce', methods=['GET'])
 def announce():
     peer = announce_parse_request()
+    ANNOUNCES.inc((peer.event,))
+    # refused at once under overload instead of waiting for peers_db_lock
+    retry_after = load_controller.admit(peer.event)
+    if retry_after is not None:
+        SHED_ANNOUNCES.inc((peer.event,))
+        return jsonify({'failure reason': 'Tracker overloaded', 'retry in': retry_after}), 503, \
+            {'Retry-After': str(retry_after)}
+    try:
+        with ANNOUNCE_LATENCY.time((peer.event,)):
+            if announce_profiler is not None:
+                return announce_profiler.runcall(announce_handler, peer)
+            return announce_handler(peer)
+    finally:
+        load_controller.release()
 
+
+def announce_handler(peer):
     announce_handler_lack_info(peer)
 
     # STOPPED event
     if peer.event == SimpleTracker.EVENT_LIST[1]:
-        announce_handler_stopped_event(peers_db, peers_db_lock, peer)
+        announce_handler_stopped_event(peers_db, peers_db_lock, site_index, peer)
         return "Peer stopped", 200
 
     # STARTED event
     elif peer.event == SimpleTracker.EVENT_LIST[0]:
-        announce_handler_started_event(peers_db, peers_db_lock, peer)
+        announce_handler_started_event(peers_db, peers_db_lock, site_index, peer)
 
     # RE_ANNOUNCE event
     elif peer.event == SimpleTracker.EVENT_LIST[2]:
-        announce_handler_re_announce_event(peers_db, peers_db_lock, peer)
+        announce_handler_re_announce_event(peers_db, peers_db_lock, site_index, peer)
 
     # response the swarms
-    return jsonify(announce_handler_swarm_response(peer, peers_db, peers_db_lock)), 200
+    return jsonify(announce_handler_swarm_response(peer, peers_db_lock, site_index, load_controller)), 200
 
 
 # Start the Flask server with threaded support
-def run():
-    simple_bittorrent_tracker.run(host='0.0.0.0', port=8080, threaded=True)
+def run(host='0.0.0.0', port=8080):
+    simple_bittorrent_tracker.run(host=host, port=port, threaded=True)
 
 
-# Run the Flask server in a new thread
-if __name__ == '__main__':
-    server_thread = threading.Thread(target=run)
+@click.command()
+@click.option('-ip', '--ip', required=False, default='0.0.0.0', type=str, help="IP address to bind, default to be 0.0.0.0")
+@click.option('-p', '--port', required=False, default=8080, type=int, help="Port of the tracker, default to be 8080")
+@click.option('-sm', '--site-map', required=False, default=None, type=str, help="JSON file of {\"<CIDR>\": \"<site>\"}, peers of the same site are returned first")
+@click.option('-tr', '--target-rate', required=False, default=LoadController.TARGET_RATE, type=int, help="Announces per second the intervals aim at, default to be 500")
+@click.option('-mif', '--max-in-flight', required=False, default=LoadController.MAX_IN_FLIGHT, type=int, help="Announces handled at once before refusing them with a 503, default to be 64")
+@click.option('-mr', '--max-rate', required=False, default=LoadController.MAX_RATE, type=int, help="Announces per second before refusing them with a 503, default to be 2000")
+def main(ip, port, site_map, target_rate, max_in_flight, max_rate):
+    site_index.site_map = load_site_map(site_map)
+    load_controller.target_rate = target_rate
+    load_controller.max_in_flight = max_in_flight
+    load_controller.max_rate = max_rate
+    server_thread = threading.Thread(target=run, args=(ip, port))
     server_thread.start()
-    cleaner_thread = threading.Thread(target=cleaner, args=(peers_db, peers_db_lock), daemon=True)
+    cleaner_thread = threading.Thread(target=cleaner, args=(peers_db, peers_db_lock, site_index, load_controller), daemon=True)
     cleaner_thread.start()
+
+
+# Run the Flask server in a new thread
+if __name__ == '__main__':
+    main()
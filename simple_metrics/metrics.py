@@ -0,0 +1,256 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+
+# default latency buckets (seconds)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# buckets for lock waiting/holding times (seconds)
+LOCK_BUCKETS = (0.000001, 0.00001, 0.0001, 0.001, 0.01, 0.1, 1)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labelnames, labels):
+    if not labelnames:
+        return ''
+    pairs = ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(labelnames, labels))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    TYPE = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+
+    def to_dict(self):
+        with self.lock:
+            return {','.join(map(str, labels)): value for labels, value in self.values.items()}
+
+
+class Gauge(Counter):
+    """
+    Gauge set by the instrumented code, or computed on
+    every export by callback, returning either a number
+    or a dictionary of labels -> number
+    """
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), callback=None):
+        super().__init__(name, help, labelnames)
+        self.callback = callback
+
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+    def _collect(self):
+        if self.callback is not None:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+            with self.lock:
+                self.values = values
+
+
+    def samples(self):
+        self._collect()
+        return super().samples()
+
+
+    def to_dict(self):
+        self._collect()
+        return super().to_dict()
+
+
+class Histogram:
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., count, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if labels not in self.values:
+                self.values[labels] = [0] * (len(self.buckets) + 2)
+            entry = self.values[labels]
+            if index < len(self.buckets):
+                entry[index] += 1
+            entry[-2] += 1
+            entry[-1] += value
+
+
+    def time(self, labels=()):
+        return HistogramTimer(self, labels)
+
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, entry in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, entry):
+                    cumulative += count
+                    samples.append((self.name + '_bucket', labels + (bound,), cumulative))
+                samples.append((self.name + '_bucket', labels + ('+Inf',), entry[-2]))
+                samples.append((self.name + '_count', labels, entry[-2]))
+                samples.append((self.name + '_sum', labels, entry[-1]))
+        return samples
+
+
+    def to_dict(self):
+        with self.lock:
+            return {','.join(map(str, labels)): {'count': entry[-2],
+                                                 'sum': entry[-1],
+                                                 'buckets': dict(zip(map(str, self.buckets), entry))}
+                    for labels, entry in self.values.items()}
+
+
+class HistogramTimer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+
+class TimedLock:
+    """
+    Lock recording the time spent waiting for it and holding it,
+    a drop-in replacement of threading.Lock to measure contention
+    """
+    def __init__(self, wait_histogram, hold_histogram):
+        self.lock = threading.Lock()
+        self.wait_histogram = wait_histogram
+        self.hold_histogram = hold_histogram
+        self.acquired_time = 0
+
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            # only written by the holder of the lock
+            self.acquired_time = time.perf_counter()
+            self.wait_histogram.observe(self.acquired_time - start)
+        return acquired
+
+
+    def release(self):
+        self.hold_histogram.observe(time.perf_counter() - self.acquired_time)
+        self.lock.release()
+
+
+    def locked(self):
+        return self.lock.locked()
+
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+
+    def gauge(self, name, help, labelnames=(), callback=None):
+        return self.register(Gauge(name, help, labelnames, callback))
+
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+    def render_prometheus(self):
+        """
+        Export every metric in the Prometheus text format
+        :return: string
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            for name, labels, value in metric.samples():
+                labelnames = metric.labelnames
+                if name.endswith('_bucket'):
+                    labelnames = labelnames + ('le',)
+                lines.append(f'{name}{format_labels(labelnames, labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+    def to_dict(self):
+        return {metric.name: metric.to_dict() for metric in self.metrics}
+
+
+def metrics_dumper(registry, path, interval):
+    """
+    Periodically dump the registry as JSON into path
+    :param registry: the Registry to export
+    :param path: path to the JSON file, rewritten on every dump
+    :param interval: seconds between two dumps
+    :return: None
+    """
+    while True:
+        time.sleep(interval)
+        snapshot = {'time': time.time(), 'metrics': registry.to_dict()}
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(snapshot, f)
+        # replace atomically, readers never see a partial dump
+        os.replace(temporary_path, path)
@@ -0,0 +1,204 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from simple_peer.config import INFO
+from simple_peer.metrics import ANNOUNCES, ANNOUNCE_LATENCY
+
+
+logger = logging.getLogger('announcer')
+
+STOPPED_EVENT = 'STOPPED'
+
+
+class TrackerBusy(Exception):
+    """
+    No tracker answered and at least one asked to retry later (503 with Retry-After)
+    """
+
+
+class Tracker:
+    """
+    A tracker of the announce-list and its failure state
+    """
+    def __init__(self, url):
+        self.url = url
+        self.failures = 0
+        # monotonic time before which the tracker is not tried again
+        self.retry_time = 0
+        # the tracker is overloaded and asked to retry at retry_time
+        self.deferred = False
+
+
+    def to_dict(self):
+        return {
+            'url': self.url,
+            'failures': self.failures,
+            'deferred': self.deferred,
+            'retry_in': max(0.0, self.retry_time - time.monotonic())
+        }
+
+
+class TrackerAnnouncer:
+    """
+    Announces a torrent to the trackers of its announce-list (BEP 12).
+    The tiers are announced concurrently and their peers merged.
+    Within a tier the trackers are tried in order until one answers,
+    and the one answering moves to the front of its tier. A failing
+    tracker is skipped for a jittered exponential backoff. Every
+    torrent of the process shares the keep-alive session and the
+    announcing threads.
+    """
+    # seconds to connect to and to read from a tracker
+    TIMEOUT = 10
+    # seconds a failing tracker is skipped, doubled at every failure up to MAX_BACKOFF
+    BACKOFF = 15
+    MAX_BACKOFF = 30 * 60
+    # the interval of the next announce is shortened by up to this fraction,
+    # so that the peers started together do not announce together
+    INTERVAL_JITTER = 0.1
+    # announces running at once, and pooled connections per tracker
+    WORKERS = 16
+
+    session = None
+    pool = None
+    shared_lock = threading.Lock()
+
+    def __init__(self, tiers):
+        """
+        :param tiers: list of tiers, a tier is a list of announce urls
+        """
+        # the trackers of a tier are tried in a random order (BEP 12)
+        self.tiers = [[Tracker(url) for url in random.sample(tier, len(tier))] for tier in tiers if tier]
+        self.lock = threading.Lock()
+
+
+    @classmethod
+    def get_session(cls):
+        with cls.shared_lock:
+            if cls.session is None:
+                # imported at the first announce, the commands not announcing start faster
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=cls.WORKERS, pool_maxsize=cls.WORKERS)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                cls.session = session
+            return cls.session
+
+
+    @classmethod
+    def get_pool(cls):
+        with cls.shared_lock:
+            if cls.pool is None:
+                cls.pool = ThreadPoolExecutor(max_workers=cls.WORKERS, thread_name_prefix='announcer')
+            return cls.pool
+
+
+    def announce(self, params):
+        """
+        :param params: parameters of the announce, see Peer.get_params
+        :return: (interval, peers), the shortest interval of the trackers
+        answering, jittered but not below their 'min interval', and
+        their peers without duplicates (None and no peers for a
+        STOPPED announce)
+        :exception TrackerBusy: no tracker answered, an overloaded one asked to retry later
+        :exception Exception: no tracker answered
+        """
+        params = dict(params)
+        pool = TrackerAnnouncer.get_pool()
+        results = [future.result() for future in [pool.submit(self.announce_tier, tier, params) for tier in self.tiers]]
+        answers = [result for result in results if result is not None]
+        if not answers:
+            with self.lock:
+                deferred = any(tracker.deferred for tier in self.tiers for tracker in tier)
+            if deferred:
+                raise TrackerBusy(f'Trackers overloaded, the {params.get("event")} announce is deferred')
+            raise Exception(f'No tracker answered the {params.get("event")} announce')
+
+        intervals = [interval for interval, _, _ in answers if interval is not None]
+        min_intervals = [min_interval for _, min_interval, _ in answers if min_interval is not None]
+        interval = min(intervals) * (1 - random.uniform(0, TrackerAnnouncer.INTERVAL_JITTER)) if intervals else None
+        if interval is not None and min_intervals:
+            interval = max(interval, max(min_intervals))
+        peers = []
+        peer_ids = set()
+        for _, _, tier_peers in answers:
+            for peer in tier_peers:
+                if peer['peer_id'] not in peer_ids:
+                    peer_ids.add(peer['peer_id'])
+                    peers.append(peer)
+        return interval, peers
+
+
+    def announce_tier(self, tier, params):
+        """
+        :return: (interval, min interval, peers) of the first tracker of the tier answering, None if none does
+        """
+        with self.lock:
+            trackers = list(tier)
+        for tracker in trackers:
+            if tracker.retry_time > time.monotonic():
+                continue
+            start = time.perf_counter()
+            try:
+                response = TrackerAnnouncer.get_session().get(tracker.url, params=params, timeout=TrackerAnnouncer.TIMEOUT)
+                retry_after = response.headers.get('Retry-After', '')
+                if response.status_code == 503 and retry_after.isdigit():
+                    # overloaded, not failing: retried when it asks, the next tracker of the tier meanwhile
+                    ANNOUNCES.inc((tracker.url, 'deferred'))
+                    with self.lock:
+                        tracker.deferred = True
+                        tracker.retry_time = time.monotonic() + int(retry_after)
+                    if INFO:
+                        logger.info(f'Announce to {tracker.url} deferred for {retry_after} seconds')
+                    continue
+                if response.status_code != 200:
+                    raise Exception(f'Tracker {tracker.url} returned {response.status_code}')
+                if params.get('event') == STOPPED_EVENT:
+                    # the tracker acknowledges a STOPPED announce without a swarm
+                    interval, min_interval, peers = None, None, []
+                else:
+                    body = response.json()
+                    interval, min_interval, peers = body['interval'], body.get('min interval'), body['peers']
+            except Exception as e:
+                ANNOUNCES.inc((tracker.url, 'failure'))
+                with self.lock:
+                    tracker.deferred = False
+                    tracker.failures += 1
+                    backoff = min(TrackerAnnouncer.BACKOFF * 2 ** (tracker.failures - 1), TrackerAnnouncer.MAX_BACKOFF)
+                    # jittered, the peers of a dead tracker do not retry together
+                    tracker.retry_time = time.monotonic() + random.uniform(backoff / 2, backoff)
+                if INFO:
+                    logger.info(f'Announce to {tracker.url} failed: {e}')
+                continue
+
+            ANNOUNCES.inc((tracker.url, 'success'))
+            ANNOUNCE_LATENCY.observe(time.perf_counter() - start)
+            with self.lock:
+                tracker.failures = 0
+                tracker.retry_time = 0
+                tracker.deferred = False
+                # the tracker answering is tried first next time (BEP 12)
+                tier.remove(tracker)
+                tier.insert(0, tracker)
+            return interval, min_interval, peers
+        return None
+
+
+    def retry_delay(self):
+        """
+        :return: seconds until a failing or overloaded tracker can be tried again
+        """
+        now = time.monotonic()
+        with self.lock:
+            delays = [tracker.retry_time - now for tier in self.tiers for tracker in tier
+                      if tracker.failures or tracker.deferred]
+        return max(1.0, min(delays, default=TrackerAnnouncer.BACKOFF))
+
+
+    def to_dict(self):
+        with self.lock:
+            return [[tracker.to_dict() for tracker in tier] for tier in self.tiers]
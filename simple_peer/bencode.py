@@ -0,0 +1,191 @@
+import mmap
+
+
+class BencodeError(ValueError):
+    """
+    The data is not valid bencode
+    """
+
+
+class Skipped:
+    """
+    A value the reader skipped without decoding it
+    """
+    def __init__(self, length):
+        # bytes of the encoded value
+        self.length = length
+
+
+    def __repr__(self):
+        return f'<skipped {self.length} bytes>'
+
+
+class BencodeReader:
+    """
+    Decodes bencode from a buffer (bytes, memoryview or mmap) without
+    copying it first. Byte strings from lazy_length bytes on, within
+    the values of the dictionary keys in lazy_keys, are returned as
+    memoryview slices of the buffer, and the values of the dictionary
+    keys in skip_keys are only walked over, so that the pieces of a
+    torrent are never copied when they are not needed.
+    """
+    def __init__(self, data, lazy_length=None, skip_keys=(), lazy_keys=None):
+        """
+        :param data: buffer of the encoded data
+        :param lazy_length: byte strings at least that long are memoryview slices, None to copy every string
+        :param skip_keys: dictionary keys (bytes) whose values are returned as Skipped
+        :param lazy_keys: dictionary keys (bytes) whose values may hold memoryview slices, None for any value
+        """
+        # bytes and mmap search without a python loop
+        self.data = data if hasattr(data, 'find') else bytes(data)
+        self.view = memoryview(self.data)
+        self.lazy_length = lazy_length
+        self.skip_keys = frozenset(skip_keys)
+        self.lazy_keys = frozenset(lazy_keys or ())
+        # True while decoding the value of a key of lazy_keys
+        self.in_lazy = lazy_keys is None
+        self.position = 0
+
+
+    def decode(self):
+        """
+        :return: the value at the start of the buffer, dictionaries have bytes keys
+        :exception BencodeError: the data is invalid or has trailing bytes
+        """
+        value = self.read_value()
+        if self.position != len(self.view):
+            raise BencodeError(f'Trailing data at offset {self.position}')
+        return value
+
+
+    def read_value(self):
+        try:
+            token = self.view[self.position]
+        except IndexError:
+            raise BencodeError('Unexpected end of data')
+        if token == 0x64:  # d
+            self.position += 1
+            dictionary = {}
+            while self.peek() != 0x65:  # e
+                key = self.read_string(lazy=False)
+                if key in self.skip_keys:
+                    start = self.position
+                    self.skip_value()
+                    dictionary[key] = Skipped(self.position - start)
+                elif key in self.lazy_keys and not self.in_lazy:
+                    self.in_lazy = True
+                    try:
+                        dictionary[key] = self.read_value()
+                    finally:
+                        self.in_lazy = False
+                else:
+                    dictionary[key] = self.read_value()
+            self.position += 1
+            return dictionary
+        if token == 0x6c:  # l
+            self.position += 1
+            items = []
+            while self.peek() != 0x65:
+                items.append(self.read_value())
+            self.position += 1
+            return items
+        if token == 0x69:  # i
+            return self.read_integer()
+        if 0x30 <= token <= 0x39:
+            return self.read_string(lazy=True)
+        raise BencodeError(f'Invalid token {chr(token)!r} at offset {self.position}')
+
+
+    def skip_value(self):
+        """
+        Walk over the value at the position, the strings are jumped over
+        """
+        token = self.peek()
+        if token in (0x64, 0x6c):
+            self.position += 1
+            while self.peek() != 0x65:
+                self.skip_value()
+            self.position += 1
+        elif token == 0x69:
+            self.read_integer()
+        else:
+            self.position = self.string_end(*self.string_bounds())
+
+
+    def peek(self):
+        try:
+            return self.view[self.position]
+        except IndexError:
+            raise BencodeError('Unexpected end of data')
+
+
+    def find(self, byte):
+        end = self.data.find(byte, self.position)
+        if end < 0:
+            raise BencodeError('Unexpected end of data')
+        return end
+
+
+    def read_integer(self):
+        end = self.find(b'e')
+        try:
+            value = int(bytes(self.view[self.position + 1:end]))
+        except ValueError:
+            raise BencodeError(f'Invalid integer at offset {self.position}')
+        self.position = end + 1
+        return value
+
+
+    def string_bounds(self):
+        """
+        :return: (start of the string, its length)
+        """
+        colon = self.find(b':')
+        try:
+            length = int(bytes(self.view[self.position:colon]))
+        except ValueError:
+            raise BencodeError(f'Invalid string length at offset {self.position}')
+        return colon + 1, length
+
+
+    def string_end(self, start, length):
+        end = start + length
+        if end > len(self.view):
+            raise BencodeError('Unexpected end of data')
+        return end
+
+
+    def read_string(self, lazy):
+        start, length = self.string_bounds()
+        end = self.string_end(start, length)
+        self.position = end
+        if lazy and self.in_lazy and self.lazy_length is not None and length >= self.lazy_length:
+            return self.view[start:end]
+        return bytes(self.view[start:end])
+
+
+def decode(data, lazy_length=None, skip_keys=(), lazy_keys=None):
+    """
+    :param data: bencoded bytes
+    :return: the decoded value, see BencodeReader
+    """
+    return BencodeReader(data, lazy_length, skip_keys, lazy_keys).decode()
+
+
+def decode_file(path, lazy_length=None, skip_keys=(), lazy_keys=None):
+    """
+    Decode a file mapped in memory, only the pages of the
+    values decoded are read from the disk
+    :param path: path to the bencoded file
+    :return: the decoded value, the lazy strings stay valid after the file is closed
+    """
+    with open(path, 'rb') as f:
+        if lazy_length is None and not skip_keys:
+            return decode(f.read())
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file cannot be mapped
+            raise BencodeError('Unexpected end of data')
+    # the lazy memoryviews keep the mapping alive
+    return decode(mapped, lazy_length, skip_keys, lazy_keys)
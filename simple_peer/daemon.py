@@ -0,0 +1,342 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, jsonify, request
+from simple_peer.listener import shared_listener
+from simple_peer.local_discovery import LocalDiscovery
+from simple_peer.metrics import registry
+from simple_peer.rate_limiter import global_bandwidth
+from simple_peer.re_announcer import re_announcer
+from simple_peer.storage import Storage
+from simple_peer.stream import StreamReader
+from simple_peer.super_seed import SuperSeeder
+from simple_peer.talker import talker
+from simple_peer.util import leecher_init, seeder_init, allocate_files, started_announce, \
+    stop_announce, is_download_completed, SimpleClient
+
+
+logger = logging.getLogger('daemon')
+
+
+class TorrentSession:
+    def __init__(self, mode, peer, peer_lock, peer_pieces_tracking, peer_pieces_tracking_lock):
+        self.mode = mode
+        self.peer = peer
+        self.peer_lock = peer_lock
+        self.peer_pieces_tracking = peer_pieces_tracking
+        self.peer_pieces_tracking_lock = peer_pieces_tracking_lock
+        self.peers = []
+        self.peers_lock = threading.Lock()
+
+
+    def to_dict(self):
+        peer = self.peer
+        return {
+            'info_hash': peer.info_hash.hex(),
+            'torrent': peer.torrent,
+            'file': peer.file,
+            'mode': self.mode,
+            'paused': peer.paused,
+            'super_seed': peer.super_seeder is not None,
+            'priorities': peer.priorities.to_dict(),
+            'completed': is_download_completed(peer),
+            'pieces': peer.priorities.piece_number,
+            'left': peer.left,
+            'uploaded': peer.uploaded,
+            'downloaded': peer.downloaded,
+            'uploaded_bytes': peer.uploaded_bytes,
+            'downloaded_bytes': peer.downloaded_bytes,
+            'upload': peer.upload_bucket.to_dict(),
+            'download': peer.download_bucket.to_dict(),
+            'peers': len(self.peers),
+            'trackers': peer.announcer.to_dict(),
+            'banned_peers': peer.scores.banned_number()
+        }
+
+
+class SimpleDaemon:
+    """
+    Manages many torrents in one process. Every torrent shares
+    the listener socket, the disk I/O layer and the hashing pool.
+    """
+    def __init__(self, ip, port, hash_workers=SimpleClient.HASH_WORKERS, local_discovery=False, site=None):
+        self.ip = ip
+        self.port = port
+        # site tag of every torrent, sent to the trackers
+        self.site = site
+        self.local_discovery = LocalDiscovery(ip) if local_discovery else None
+        self.storage = Storage()
+        self.hash_pool = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix='hasher')
+        self.sessions = {}
+        # info_hash (hex) -> (peer, peer_pieces_tracking, peer_lock), served by the listener
+        self.torrents = {}
+        self.torrents_lock = threading.Lock()
+
+
+    def start(self):
+        listener_thread = threading.Thread(target=shared_listener, args=(self.ip, self.port, self.torrents, self.torrents_lock), daemon=True)
+        listener_thread.start()
+        if self.local_discovery:
+            self.local_discovery.start()
+
+
+    def add(self, torrent, file, mode, super_seed=False, selections=None):
+        """
+        Start seeding or downloading a torrent
+        :param torrent: path to the torrent
+        :param file: path to the file of the torrent
+        :param mode: 'seed' or 'join'
+        :param super_seed: super-seeding, only for 'seed'
+        :param selections: pieces to download, see parse_selection, only for 'join'
+        :return: the TorrentSession
+        """
+        if mode == 'seed':
+            init = seeder_init
+        elif mode == 'join':
+            init = leecher_init
+        else:
+            raise ValueError(f'Unknown mode {mode}')
+
+        session = TorrentSession(mode, *init(torrent, file, self.ip, self.port, self.storage, self.hash_pool))
+        peer = session.peer
+        peer.site = self.site
+        info_hash = peer.info_hash.hex()
+        if super_seed and mode == 'seed':
+            peer.super_seeder = SuperSeeder(peer.priorities.piece_number)
+        if selections and mode == 'join':
+            peer.priorities.select(selections)
+            peer.update_left(session.peer_pieces_tracking, session.peer_pieces_tracking_lock)
+
+        with self.torrents_lock:
+            if info_hash in self.sessions:
+                raise ValueError(f'Torrent {info_hash} already added')
+            self.sessions[info_hash] = session
+
+        try:
+            if mode == 'join':
+                allocate_files(torrent, file, peer.priorities, overwrite=False)
+
+            interval, peers = started_announce(peer)
+            session.peers.extend(peers)
+        except Exception:
+            with self.torrents_lock:
+                del self.sessions[info_hash]
+            raise
+
+        with self.torrents_lock:
+            self.torrents[info_hash] = (peer, session.peer_pieces_tracking, session.peer_lock)
+
+        re_announcer_thread = threading.Thread(target=re_announcer, args=(interval, peer, session.peers, session.peers_lock), daemon=True)
+        re_announcer_thread.start()
+
+        if self.local_discovery:
+            self.local_discovery.register(peer)
+
+        if mode == 'join':
+            self.start_talker(session)
+
+        logger.info(f'Added torrent {info_hash} ({mode})')
+        return session
+
+
+    def start_talker(self, session):
+        talker_thread = threading.Thread(target=talker, args=(session.peer, session.peers, session.peers_lock, session.peer_pieces_tracking,
+                                                              session.peer_lock, session.peer_pieces_tracking_lock), daemon=True)
+        talker_thread.start()
+
+
+    def select(self, info_hash, selections):
+        """
+        Change the pieces downloaded by a torrent
+        :param info_hash: info_hash (hex) of the torrent
+        :param selections: list of selection strings, see parse_selection
+        :return: None
+        :exception ValueError: the torrent is seeded or a selection is invalid
+        """
+        session = self.get(info_hash)
+        if session.mode != 'join':
+            raise ValueError('Only downloading torrents have priorities')
+        peer = session.peer
+        was_completed = is_download_completed(peer)
+        peer.set_selections(selections, session.peer_pieces_tracking, session.peer_pieces_tracking_lock)
+        if was_completed and not is_download_completed(peer):
+            # the talker stopped with the previous selection
+            self.start_talker(session)
+
+
+    def get(self, info_hash):
+        with self.torrents_lock:
+            if info_hash not in self.sessions:
+                raise KeyError(info_hash)
+            return self.sessions[info_hash]
+
+
+    def remove(self, info_hash):
+        with self.torrents_lock:
+            if info_hash not in self.sessions:
+                raise KeyError(info_hash)
+            session = self.sessions.pop(info_hash)
+            self.torrents.pop(info_hash, None)
+        session.peer.stop()
+        if self.local_discovery:
+            self.local_discovery.unregister(session.peer)
+        for path in session.peer.layout.paths:
+            if path is not None:
+                self.storage.close(path)
+        try:
+            stop_announce(session.peer)
+        except Exception as e:
+            logger.error(str(e))
+        logger.info(f'Removed torrent {info_hash}')
+
+
+    def open_stream(self, info_hash, name=None):
+        """
+        :param info_hash: info_hash (hex) of the torrent
+        :param name: name of the file in the torrent, None for the whole torrent
+        :return: StreamReader of the file, reading as it downloads
+        """
+        session = self.get(info_hash)
+        return StreamReader(session.peer, session.peer_pieces_tracking, name)
+
+
+    def pause(self, info_hash):
+        self.get(info_hash).peer.pause()
+
+
+    def resume(self, info_hash):
+        self.get(info_hash).peer.resume()
+
+
+    def status(self):
+        with self.torrents_lock:
+            sessions = list(self.sessions.values())
+        return [session.to_dict() for session in sessions]
+
+
+    def shutdown(self):
+        with self.torrents_lock:
+            info_hashes = list(self.sessions)
+        for info_hash in info_hashes:
+            self.remove(info_hash)
+        self.hash_pool.shutdown(wait=False)
+        self.storage.close_all()
+
+
+def create_control_app(simple_daemon):
+    """
+    Local HTTP API controlling the daemon
+    :param simple_daemon: the SimpleDaemon to control
+    :return: Flask application
+    """
+    control = Flask('daemon')
+
+    @control.route('/torrents', methods=['GET'])
+    def torrents_status():
+        return jsonify(simple_daemon.status()), 200
+
+    @control.route('/torrents', methods=['POST'])
+    def torrents_add():
+        body = request.get_json(force=True)
+        try:
+            session = simple_daemon.add(body['torrent'], body['file'], body.get('mode', 'join'), body.get('super_seed', False),
+                                        body.get('select'))
+        except (KeyError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            return jsonify({'error': str(e)}), 502
+        return jsonify(session.to_dict()), 201
+
+    @control.route('/torrents/<info_hash>', methods=['GET'])
+    def torrent_status(info_hash):
+        try:
+            return jsonify(simple_daemon.get(info_hash).to_dict()), 200
+        except KeyError:
+            return jsonify({'error': 'Unknown torrent'}), 404
+
+    @control.route('/torrents/<info_hash>/peers', methods=['GET'])
+    def torrent_peers(info_hash):
+        try:
+            return jsonify(simple_daemon.get(info_hash).peer.scores.to_dict()), 200
+        except KeyError:
+            return jsonify({'error': 'Unknown torrent'}), 404
+
+    @control.route('/torrents/<info_hash>', methods=['DELETE'])
+    def torrent_remove(info_hash):
+        try:
+            simple_daemon.remove(info_hash)
+        except KeyError:
+            return jsonify({'error': 'Unknown torrent'}), 404
+        return '', 204
+
+    @control.route('/torrents/<info_hash>/pause', methods=['POST'])
+    def torrent_pause(info_hash):
+        try:
+            simple_daemon.pause(info_hash)
+        except KeyError:
+            return jsonify({'error': 'Unknown torrent'}), 404
+        return '', 204
+
+    @control.route('/torrents/<info_hash>/resume', methods=['POST'])
+    def torrent_resume(info_hash):
+        try:
+            simple_daemon.resume(info_hash)
+        except KeyError:
+            return jsonify({'error': 'Unknown torrent'}), 404
+        return '', 204
+
+    @control.route('/torrents/<info_hash>/limits', methods=['PUT'])
+    def torrent_limits(info_hash):
+        body = request.get_json(force=True)
+        try:
+            simple_daemon.get(info_hash).peer.set_limits(body.get('upload_rate'), body.get('download_rate'))
+        except KeyError:
+            return jsonify({'error': 'Unknown torrent'}), 404
+        return '', 204
+
+    @control.route('/torrents/<info_hash>/priorities', methods=['PUT'])
+    def torrent_priorities(info_hash):
+        body = request.get_json(force=True)
+        try:
+            simple_daemon.select(info_hash, body.get('select', []))
+        except KeyError:
+            return jsonify({'error': 'Unknown torrent'}), 404
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return '', 204
+
+    @control.route('/torrents/<info_hash>/stream', methods=['GET'])
+    def torrent_stream(info_hash):
+        try:
+            reader = simple_daemon.open_stream(info_hash, request.args.get('name'))
+            reader.seek(int(request.args.get('offset', 0)))
+        except KeyError:
+            return jsonify({'error': 'Unknown torrent or file'}), 404
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        def generate():
+            with reader:
+                data = reader.read(SimpleClient.STREAM_CHUNK_LENGTH)
+                while data:
+                    yield data
+                    data = reader.read(SimpleClient.STREAM_CHUNK_LENGTH)
+
+        return Response(generate(), mimetype='application/octet-stream')
+
+    @control.route('/metrics', methods=['GET'])
+    def metrics():
+        return registry.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+    @control.route('/bandwidth', methods=['GET'])
+    def bandwidth_status():
+        return jsonify(global_bandwidth.to_dict()), 200
+
+    @control.route('/bandwidth', methods=['PUT'])
+    def bandwidth_limits():
+        body = request.get_json(force=True)
+        global_bandwidth.set_limits(body.get('upload_rate'), body.get('download_rate'),
+                                    body.get('peer_upload_rate'), body.get('peer_download_rate'))
+        return '', 204
+
+    return control
@@ -1,11 +1,15 @@
-import json
+import collections
 import logging
+import select
 import socket
-import struct
 import threading
 
 from simple_peer.config import INFO
-from simple_peer.util import get_interest_piece_index, get_piece_length
+from simple_peer.metrics import BYTES, PIECES, CONNECTIONS
+from simple_peer.util import SimpleClient
+from simple_peer.wire import Connection, ProtocolError, decode_bitfield, encode_bitfield, PROTOCOL_VERSION, \
+    MESSAGE_NAMES, KEEPALIVE, HANDSHAKE, HAVE, REQUEST, PIECE, CANCEL, REJECT, HASHES, PEX, DONE, \
+    HANDSHAKE_HEADER, BLOCK_REQUEST, PIECE_HEADER, PIECE_INDEX
 
 
 listener_logger = logging.getLogger('listener')
@@ -21,103 +25,203 @@ def listener(server_peer, peer_pieces_tracking, server_peer_lock):
     :param server_peer_lock: lock for changing the server peer
     :return: None
     """
+    torrents = {server_peer.info_hash.hex(): (server_peer, peer_pieces_tracking, server_peer_lock)}
+    shared_listener(server_peer.peer_ip, server_peer.peer_port, torrents, threading.Lock())
+
+
+def shared_listener(ip, port, torrents, torrents_lock):
+    """
+    Listener serving every torrent registered in torrents on one
+    socket, the client peer chooses the torrent with the HANDSHAKE
+    message at the start of the connection
+    :param ip: ip address to bind
+    :param port: port to bind
+    :param torrents: dictionary of info_hash (hex) -> (server_peer, peer_pieces_tracking, server_peer_lock)
+    :param torrents_lock: lock for changing torrents
+    :return: None
+    """
     # todo: a central thread that accepts the connection from client peers
     try:
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((server_peer.peer_ip, server_peer.peer_port))
+        # allow restarting a peer on the same port right away
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((ip, port))
 
         server_socket.listen(10)
 
         while True:
             server_client_socket, addr = server_socket.accept()
-            handler_thread = threading.Thread(target=handler, args=(server_peer, server_client_socket, peer_pieces_tracking, server_peer_lock), daemon=True)
+            handler_thread = threading.Thread(target=handler, args=(server_client_socket, torrents, torrents_lock), daemon=True)
             handler_thread.start()
     except Exception as e:
         listener_logger.error(str(e))
 
 
-def handler(server_peer, server_client_socket, peer_pieces_tracking, server_peer_lock):
+def handler(server_client_socket, torrents, torrents_lock):
     """
     Run by thread created by handle_connections_from_client_peers
-    to handle a connection from the client peer
-    :param server_peer: object represents the server peer
+    to handle a connection from the client peer. Messages are
+    answered in order, one at a time, and the socket is polled
+    between two pieces so that a CANCEL reaches the requests
+    still waiting
     :param server_client_socket: socket to send and receive message from client peer
-    :param peer_pieces_tracking: dictionary represents peer pieces tracking
-    :param server_peer_lock: lock to change the server peer
+    :param torrents: dictionary of info_hash (hex) -> (server_peer, peer_pieces_tracking, server_peer_lock)
+    :param torrents_lock: lock for changing torrents
     :return: None
     """
     # todo: thread that instantly handle requests from a peer
+    server_peer = None
+    client_address = None
+    # version of the peers sent by the last PEX on this connection
+    pex_version = 0
+    connection = Connection(server_client_socket)
+    CONNECTIONS.inc(('in',))
     try:
-        buffer = ""
+        client_address = server_client_socket.getpeername()
+        peer_pieces_tracking, server_peer_lock = None, None
+        # peer_id of the client peer, from its HANDSHAKE message
+        requester_id = client_address
+        # (message id, payload) received and not answered yet
+        pending = collections.deque()
         while True:
-            # Receive data and append to buffer
-            data = server_client_socket.recv(1024).decode('utf-8')
-            if not data:
-                break  # Client closed connection
-
-            buffer += data
-
-            # Process all complete messages in the buffer
-            while "\n" in buffer:
-                # Split the buffer on the newline delimiter
-                request_message, buffer = buffer.split("\n", 1)
-
-                request_type = handler_request_type(request_message)
-                if request_type == 'DONE':
-                    handler_done(server_client_socket)
-                    return
-                elif request_type == 'HAVING':
-                    handler_having(server_client_socket, peer_pieces_tracking)
-                elif request_type == 'INTEREST':
-                    handler_interest(server_peer, server_client_socket, request_message, server_peer_lock)
+            # block for the next messages only when nothing is left to answer
+            if not pending or select.select([server_client_socket], [], [], 0)[0]:
+                if not connection.fill(connection.needed()):
+                    break  # Client closed connection
+                for message_id, payload in connection.messages():
+                    if message_id is KEEPALIVE:
+                        continue
+                    if message_id == CANCEL:
+                        handler_cancel(connection, pending, payload)
+                    elif message_id == REQUEST:
+                        pending.append((message_id, BLOCK_REQUEST.unpack(payload)))
+                    else:
+                        # the payload is a view of the receive buffer
+                        pending.append((message_id, bytes(payload)))
+                continue
+
+            message_id, payload = pending.popleft()
+            if message_id == HANDSHAKE:
+                server_peer, peer_pieces_tracking, server_peer_lock, requester_id = handler_handshake(payload, torrents, torrents_lock,
+                                                                                                      client_address)
+                continue
+
+            if server_peer is None:
+                raise ProtocolError('Missing HANDSHAKE message')
+
+            if server_peer.paused or server_peer.stopped:
+                return
+
+            if message_id == DONE:
+                handler_done(connection)
+                return
+            elif message_id == HAVE:
+                handler_have(connection, server_peer, peer_pieces_tracking, payload, requester_id)
+            elif message_id == PEX:
+                pex_version = handler_pex(connection, server_peer, pex_version)
+            elif message_id == HASHES:
+                handler_hashes(connection, server_peer, peer_pieces_tracking, payload)
+            elif message_id == REQUEST:
+                handler_request(connection, server_peer, peer_pieces_tracking, requester_id, *payload)
+            else:
+                raise ProtocolError(f'Unexpected {MESSAGE_NAMES[message_id]} message')
+    except ProtocolError as e:
+        if INFO:
+            handler_logger.info(str(e))
+        try:
+            # tell the client peer why the connection is closed
+            connection.send_error(e)
+        except OSError:
+            pass
     except Exception as e:
         if INFO:
             handler_logger.info(str(e))
     finally:
+        CONNECTIONS.dec(('in',))
+        if server_peer is not None and server_peer.super_seeder is not None:
+            server_peer.super_seeder.remove(requester_id)
         server_client_socket.close()
 
 
-
-def handler_request_type(request):
-    if request == 'HAVING':
-        return 'HAVING'
-    elif request == 'DONE':
-        return 'DONE'
-    else:
-        return 'INTEREST'
+def handler_handshake(payload, torrents, torrents_lock, client_address):
+    # HANDSHAKE <version><info_hash><port><peer_id>
+    version, info_hash, port = HANDSHAKE_HEADER.unpack_from(payload)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f'Unsupported protocol version {version}')
+    info_hash = info_hash.hex()
+    with torrents_lock:
+        if info_hash not in torrents:
+            raise ProtocolError(f'Unknown torrent {info_hash}')
+        server_peer, peer_pieces_tracking, server_peer_lock = torrents[info_hash]
+    peer_id = payload[HANDSHAKE_HEADER.size:].decode('utf-8')
+    # the client peer is now a known peer of the swarm, shared through PEX
+    server_peer.learn_peer({'peer_id': peer_id, 'peer_ip': client_address[0], 'peer_port': port})
+    return server_peer, peer_pieces_tracking, server_peer_lock, peer_id
 
 
-def handler_done(server_client_socket):
+def handler_done(connection):
     # todo: send back the acknowledgement and close the socket
-    done_response = 'DONE_OK'
-    server_client_socket.send(done_response.encode('utf-8'))
-    server_client_socket.close()
-
-
-def handler_interest(server_peer, server_client_socket, interest_request, server_peer_lock, ):
-    piece_index = get_interest_piece_index(interest_request)
+    connection.send(DONE)
+    connection.sock.close()
+
+
+def handler_cancel(connection, pending, payload):
+    # CANCEL <index><begin><length>, a request not answered yet is rejected
+    request = BLOCK_REQUEST.unpack(payload)
+    if (REQUEST, request) in pending:
+        pending.remove((REQUEST, request))
+        connection.send(REJECT, BLOCK_REQUEST.pack(*request))
+
+
+def handler_request(connection, server_peer, peer_pieces_tracking, requester_id, piece_index, begin, length):
+    # REQUEST <index><begin><length>, a whole piece or a block of it
+    piece_length = server_peer.priorities.piece_length
+    piece_size = min(piece_length, server_peer.layout.total_length - piece_index * piece_length)
+    if (peer_pieces_tracking.get(piece_index) != 'AVAILABLE' or
+            not 0 < length <= piece_size - begin):
+        connection.send(REJECT, BLOCK_REQUEST.pack(piece_index, begin, length))
+        return
     # todo: send the piece back to the peer client
-    with open(server_peer.file, 'rb') as f:
-        read_index = piece_index * get_piece_length(server_peer.torrent)
-        f.seek(read_index)
-        piece_data = f.read(get_piece_length(server_peer.torrent))
-        server_client_socket.send(piece_data)
-        client_ip, client_port = server_client_socket.getpeername()
+    data = server_peer.read_range(piece_index * piece_length + begin, length)
+    connection.send(PIECE, PIECE_HEADER.pack(piece_index, begin), data, server_peer.upload_buckets(requester_id))
+    # one series per peer_id, like the download side, not per connection
+    BYTES.inc(('out', requester_id), len(data))
+    # a block is not a whole piece, only its bytes are counted
+    whole_piece = length == piece_size
+    if whole_piece:
+        PIECES.inc(('out',))
         if INFO:
-            handler_logger.info(f'Uploaded piece [{piece_index}] to [{client_ip}][{client_port}]')
-    server_peer.update_peer_uploaded()
-
-
-def handler_having(server_client_socket, peer_pieces_tracking):
-    # Convert the dictionary to a JSON string
-    json_data = json.dumps(peer_pieces_tracking)
-
-    # Get the length of the JSON data
-    json_length = len(json_data)
-
-    # Pack the length of the JSON data into a 4-byte integer (big-endian)
-    length_header = struct.pack('!I', json_length)
-
-    # Send the length header followed by the JSON data (encoded in utf-8)
-    server_client_socket.send(length_header)
-    server_client_socket.send(json_data.encode('utf-8'))
\ No newline at end of file
+            handler_logger.info(f'Uploaded piece [{piece_index}] to [{requester_id}]')
+    server_peer.update_peer_uploaded(len(data), 1 if whole_piece else 0)
+
+
+def handler_hashes(connection, server_peer, peer_pieces_tracking, payload):
+    # HASHES <index>, the SHA256 of the blocks of the piece (v2 torrents)
+    piece_index = PIECE_INDEX.unpack(payload)[0]
+    if server_peer.merkle is None:
+        raise ProtocolError('HASHES request for a v1 torrent')
+    if not 0 <= piece_index < server_peer.priorities.piece_number:
+        raise ProtocolError(f'HASHES request for piece [{piece_index}] out of the torrent')
+    if peer_pieces_tracking.get(piece_index) != 'AVAILABLE':
+        # no hashes, the server peer doesn't have the piece
+        connection.send(HASHES, PIECE_INDEX.pack(piece_index))
+        return
+    piece_data = server_peer.read_piece(piece_index)
+    hashes = server_peer.merkle.block_hashes(piece_data, piece_index)
+    connection.send(HASHES, PIECE_INDEX.pack(piece_index) + b''.join(hashes))
+
+
+def handler_pex(connection, server_peer, pex_version):
+    # todo: send the peers added/dropped since the previous PEX
+    pex_version, added, dropped = server_peer.pex.changes_since(pex_version, SimpleClient.PEX_MAX_PEERS)
+    connection.send_json(PEX, {'added': added, 'dropped': dropped})
+    return pex_version
+
+
+def handler_have(connection, server_peer, peer_pieces_tracking, payload, requester_id):
+    # HAVE <bitfield of the client peer>
+    if server_peer.super_seeder is not None:
+        # only advertise the pieces chosen for this client peer
+        peer_pieces_tracking = server_peer.super_seeder.pieces_for(requester_id, decode_bitfield(payload))
+    available = [i for i, state in peer_pieces_tracking.items() if state == 'AVAILABLE']
+    connection.send(HAVE, encode_bitfield(available, len(peer_pieces_tracking)))
@@ -0,0 +1,154 @@
+import logging
+import socket
+import struct
+import threading
+import time
+from simple_peer.config import INFO
+from simple_peer.util import SimpleClient
+
+
+logger = logging.getLogger('local_discovery')
+
+
+def create_announce_message(peer):
+    """
+    BEP 14 style announce, the cookie carries the peer_id so that
+    receivers can add the peer and drop their own announces
+    :param peer: object represents the peer
+    :return: bytes of the message
+    """
+    return (f'BT-SEARCH * HTTP/1.1\r\n'
+            f'Host: {SimpleClient.LSD_GROUP}:{SimpleClient.LSD_PORT}\r\n'
+            f'Port: {peer.peer_port}\r\n'
+            f'Infohash: {peer.info_hash.hex()}\r\n'
+            f'cookie: {peer.peer_id}\r\n'
+            f'\r\n\r\n').encode('utf-8')
+
+
+def parse_announce_message(data):
+    """
+    :param data: bytes received from the multicast group
+    :return: (port, list of info_hash (hex), cookie), None if it is not an announce
+    """
+    try:
+        lines = data.decode('utf-8').split('\r\n')
+    except UnicodeDecodeError:
+        return None
+    if not lines or not lines[0].startswith('BT-SEARCH'):
+        return None
+    port, info_hashes, cookie = None, [], None
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        name = name.strip().lower()
+        value = value.strip()
+        if name == 'port':
+            port = int(value)
+        elif name == 'infohash':
+            info_hashes.append(value.lower())
+        elif name == 'cookie':
+            cookie = value
+    if port is None or cookie is None:
+        return None
+    return port, info_hashes, cookie
+
+
+class LocalDiscovery:
+    """
+    Local service discovery over IP multicast, peers of the same
+    LAN announce their torrents to the group and learn each other
+    without a round trip to the tracker
+    """
+    def __init__(self, interface_ip='0.0.0.0', group=None, port=None):
+        self.interface_ip = interface_ip
+        self.group = group or SimpleClient.LSD_GROUP
+        self.port = port or SimpleClient.LSD_PORT
+        # info_hash (hex) -> peer
+        self.peers = {}
+        # info_hash (hex) -> last announce time
+        self.last_announce = {}
+        self.lock = threading.Lock()
+
+        self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        # stay on the local segment, loop back for peers of the same host
+        self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if interface_ip != '0.0.0.0':
+            self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface_ip))
+
+        self.receive_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        # every peer of the host binds the same port
+        self.receive_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.receive_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.receive_socket.bind(('', self.port))
+        membership = struct.pack('4s4s', socket.inet_aton(self.group), socket.inet_aton(interface_ip))
+        self.receive_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+
+    def start(self):
+        threading.Thread(target=self.receiver, daemon=True).start()
+        threading.Thread(target=self.announcer, daemon=True).start()
+
+
+    def register(self, peer):
+        with self.lock:
+            self.peers[peer.info_hash.hex()] = peer
+        self.announce(peer, force=True)
+
+
+    def unregister(self, peer):
+        with self.lock:
+            self.peers.pop(peer.info_hash.hex(), None)
+            self.last_announce.pop(peer.info_hash.hex(), None)
+
+
+    def announce(self, peer, force=False):
+        """
+        Send the announce of the peer, the answers to newcomers
+        are sent at most once per LSD_MIN_INTERVAL seconds
+        :param peer: object represents the peer
+        :param force: True for the registration and periodic announces
+        :return: None
+        """
+        if not force:
+            info_hash = peer.info_hash.hex()
+            now = time.monotonic()
+            with self.lock:
+                if now - self.last_announce.get(info_hash, 0) < SimpleClient.LSD_MIN_INTERVAL:
+                    return
+                self.last_announce[info_hash] = now
+        try:
+            self.send_socket.sendto(create_announce_message(peer), (self.group, self.port))
+        except OSError as e:
+            logger.error(str(e))
+
+
+    def announcer(self):
+        while True:
+            time.sleep(SimpleClient.LSD_INTERVAL)
+            with self.lock:
+                peers = list(self.peers.values())
+            for peer in peers:
+                self.announce(peer, force=True)
+
+
+    def receiver(self):
+        while True:
+            try:
+                data, address = self.receive_socket.recvfrom(1500)
+                message = parse_announce_message(data)
+                if message is None:
+                    continue
+                port, info_hashes, cookie = message
+                for info_hash in info_hashes:
+                    with self.lock:
+                        peer = self.peers.get(info_hash)
+                    if peer is None or cookie == peer.peer_id:
+                        continue
+                    if peer.learn_peer({'peer_id': cookie, 'peer_ip': address[0], 'peer_port': port}):
+                        if INFO:
+                            logger.info(f'Discovered [{address[0]}][{port}] on the local network')
+                        # answer the newcomer, so it learns about this peer within seconds
+                        self.announce(peer)
+            except Exception as e:
+                logger.error(str(e))
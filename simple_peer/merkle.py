@@ -0,0 +1,178 @@
+import hashlib
+
+
+# leaves of the trees are the SHA256 of 16KB blocks (BEP 52)
+BLOCK_SIZE = 16 * 1024
+ZERO_HASH = bytes(32)
+
+
+def sha256(data):
+    return hashlib.sha256(data).digest()
+
+
+def next_power_of_two(n):
+    power = 1
+    while power < n:
+        power *= 2
+    return power
+
+
+def block_hashes(data):
+    """
+    :param data: bytes of a file range starting at a block boundary
+    :return: list of the SHA256 of its blocks, the last one may be shorter
+    """
+    view = memoryview(data)
+    return [sha256(view[k:k + BLOCK_SIZE]) for k in range(0, len(data), BLOCK_SIZE)]
+
+
+def zero_subtree_hash(width):
+    """
+    :param width: number of leaves of the subtree, a power of two
+    :return: root of a subtree of zero leaves, pads the layers above the leaves
+    """
+    node = ZERO_HASH
+    while width > 1:
+        node = sha256(node + node)
+        width //= 2
+    return node
+
+
+def merkle_root(hashes, width, pad=ZERO_HASH):
+    """
+    :param hashes: nodes of the bottom layer
+    :param width: number of nodes of the bottom layer once padded, a power of two
+    :param pad: node padding the bottom layer
+    :return: root of the tree
+    """
+    layer = list(hashes) + [pad] * (width - len(hashes))
+    while len(layer) > 1:
+        layer = [sha256(layer[k] + layer[k + 1]) for k in range(0, len(layer), 2)]
+    return layer[0]
+
+
+def file_merkle(file_path, piece_length):
+    """
+    Merkle tree of a file as BEP 52: the pieces root and the piece
+    layer, the nodes covering piece_length bytes each
+    :param file_path: path to the file, not empty
+    :param piece_length: length of piece (byte), a power of two of at least 16KB
+    :return: (pieces root, bytes of the piece layer, empty when the file fits in a piece)
+    """
+    blocks_per_piece = piece_length // BLOCK_SIZE
+    piece_layer = []
+    leaves = []
+    with open(file_path, 'rb') as f:
+        block = f.read(BLOCK_SIZE)
+        while block:
+            leaves.append(sha256(block))
+            if len(leaves) == blocks_per_piece:
+                piece_layer.append(merkle_root(leaves, blocks_per_piece))
+                leaves = []
+            block = f.read(BLOCK_SIZE)
+    if not piece_layer:
+        # the file fits in one piece, its root is the root of its blocks
+        return merkle_root(leaves, next_power_of_two(len(leaves))), b''
+    if leaves:
+        piece_layer.append(merkle_root(leaves, blocks_per_piece))
+    root = merkle_root(piece_layer, next_power_of_two(len(piece_layer)), zero_subtree_hash(blocks_per_piece))
+    return root, b''.join(piece_layer)
+
+
+def walk_file_tree(file_tree, prefix=()):
+    """
+    :param file_tree: 'file tree' of the info dictionary
+    :return: dictionary of path components (tuple) -> {'length', 'pieces root'}
+    """
+    files = {}
+    for name, node in file_tree.items():
+        if '' in node:
+            files[prefix + (name,)] = node['']
+        else:
+            files.update(walk_file_tree(node, prefix + (name,)))
+    return files
+
+
+class MerkleVerifier:
+    """
+    Block-level verification of the pieces of a v2 torrent. Every
+    file starts at a piece boundary (padding files in between), so a
+    piece is a range of one file and is checked against the piece
+    layer of the file, or against its root when it fits in a piece.
+    """
+    def __init__(self, torrent_dic, layout, piece_length):
+        """
+        :exception ValueError: the torrent is inconsistent
+        """
+        info = torrent_dic['info']
+        piece_layers = torrent_dic.get('piece layers', {})
+        roots = walk_file_tree(info['file tree'])
+        if 'files' in info:
+            file_entries = [tuple(torrent_file['path']) for torrent_file in info['files']]
+        else:
+            file_entries = [(info['name'],)]
+
+        # piece index -> (expected hash, bytes of file data in the piece, leaves of the tree)
+        self.pieces = {}
+        for components, path, offset, length in zip(file_entries, layout.paths, layout.offsets, layout.lengths):
+            if path is None or not length:
+                continue
+            if offset % piece_length:
+                raise ValueError(f'File {"/".join(components)} does not start at a piece boundary')
+            root = roots[components]['pieces root']
+            first_piece = offset // piece_length
+            if length <= piece_length:
+                self.pieces[first_piece] = (root, length, next_power_of_two(-(-length // BLOCK_SIZE)))
+                continue
+            layer = piece_layers[root]
+            for j in range(len(layer) // 32):
+                self.pieces[first_piece + j] = (layer[32 * j:32 * j + 32], min(piece_length, length - j * piece_length),
+                                                piece_length // BLOCK_SIZE)
+
+
+    def data_length(self, piece_index):
+        """
+        :return: bytes of file data in the piece, the rest is padding
+        """
+        return self.pieces[piece_index][1]
+
+
+    def block_number(self, piece_index):
+        return -(-self.data_length(piece_index) // BLOCK_SIZE)
+
+
+    def block_hashes(self, piece_data, piece_index):
+        return block_hashes(memoryview(piece_data)[:self.data_length(piece_index)])
+
+
+    def check_hashes(self, hashes, piece_index):
+        """
+        :param hashes: block hashes of the piece
+        :return: True when they hash up to the piece layer
+        """
+        expected, _, width = self.pieces[piece_index]
+        return len(hashes) == self.block_number(piece_index) and merkle_root(hashes, width) == expected
+
+
+    def verify(self, piece_data, piece_index):
+        """
+        :return: (True if the piece is valid, block hashes of the data)
+        """
+        hashes = self.block_hashes(piece_data, piece_index)
+        return self.check_hashes(hashes, piece_index), hashes
+
+
+class PartialPiece:
+    """
+    Blocks of a piece that failed the verification, the valid ones
+    are kept and only the missing ones are requested again
+    """
+    def __init__(self, data, missing, hashes):
+        """
+        :param data: bytearray of the piece
+        :param missing: set of the indexes of the blocks to request
+        :param hashes: verified block hashes of the piece
+        """
+        self.data = data
+        self.missing = missing
+        self.hashes = hashes
@@ -0,0 +1,20 @@
+from simple_metrics.metrics import Registry
+
+
+# every instrument of the peer, exported by the daemon
+# /metrics endpoint or dumped as JSON by the join/seed commands
+registry = Registry()
+
+BYTES = registry.counter('peer_bytes_total', 'Piece bytes transferred per remote peer', ('direction', 'peer'))
+PIECES = registry.counter('peer_pieces_total', 'Pieces transferred', ('direction',))
+HASH_FAILURES = registry.counter('peer_hash_failures_total', 'Pieces failing the hash check', ('peer',))
+BLOCK_FAILURES = registry.counter('peer_block_failures_total', 'Blocks failing the Merkle check (v2 torrents)', ('peer',))
+PIECE_LATENCY = registry.histogram('peer_piece_latency_seconds', 'Time from REQUEST sent to piece verified')
+HASH_LATENCY = registry.histogram('peer_hash_seconds', 'Time to hash a piece, queueing included')
+DISK_WRITE_LATENCY = registry.histogram('peer_disk_write_seconds', 'Time to write a piece')
+DISK_READ_LATENCY = registry.histogram('peer_disk_read_seconds', 'Time to read a piece')
+CONNECTIONS = registry.gauge('peer_connections', 'Open peer connections', ('direction',))
+PIECES_IN_FLIGHT = registry.gauge('peer_pieces_in_flight', 'Pieces requested and not verified yet')
+ANNOUNCES = registry.counter('peer_announces_total', 'Announces to the trackers', ('tracker', 'result'))
+ANNOUNCE_LATENCY = registry.histogram('peer_announce_seconds', 'Time of an announce answered by a tracker')
+HASH_QUEUE_DEPTH = registry.gauge('peer_hash_queue_depth', 'Pieces waiting for or being hashed')
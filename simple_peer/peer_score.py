@@ -0,0 +1,218 @@
+import math
+import threading
+import time
+
+
+class PeerScore:
+    """
+    What a client peer measured about a server peer: round trip
+    time and sustained throughput (moving averages), pieces,
+    hash failures and errors, and the ban state
+    """
+    def __init__(self):
+        self.rtt = None
+        self.throughput = None
+        self.pieces = 0
+        self.hash_failures = 0
+        self.errors = 0
+        self.bans = 0
+        self.banned_until = 0
+        # asked to disconnect, replaced by a better peer
+        self.evicted = False
+
+
+    def to_dict(self):
+        return {
+            'rtt': self.rtt,
+            'throughput': self.throughput,
+            'pieces': self.pieces,
+            'hash_failures': self.hash_failures,
+            'errors': self.errors,
+            'bans': self.bans,
+            'banned': self.banned_until > time.monotonic()
+        }
+
+
+def moving_average(average, sample, weight):
+    return sample if average is None else (1 - weight) * average + weight * sample
+
+
+class PeerScoreBoard:
+    """
+    Scores of the server peers of a client peer. The talker connects
+    to the best scored peers, a requester pipelines as many pieces
+    as the bandwidth-delay product of its peer, and misbehaving
+    peers are banned for a time doubling at every ban.
+    """
+    # weight of a new sample in the moving averages
+    WEIGHT = 0.3
+    # connections opened to server peers at most
+    MAX_CONNECTIONS = 30
+    # pieces requested in advance on a connection at most
+    MAX_PIPELINE = 8
+    # seconds of the first ban, doubled at every ban up to BAN_MAX
+    BAN_BASE = 5
+    BAN_MAX = 10 * 60
+    # banned when more pieces than that failed, and more than half of them
+    MAX_HASH_FAILURES = 3
+    # a connected peer slower than this fraction of the median is replaced
+    EVICT_RATIO = 0.25
+
+    def __init__(self):
+        # peer_id -> PeerScore
+        self.scores = {}
+        self.lock = threading.Lock()
+
+
+    def _get(self, peer_id):
+        if peer_id not in self.scores:
+            self.scores[peer_id] = PeerScore()
+        return self.scores[peer_id]
+
+
+    def record_rtt(self, peer_id, seconds):
+        with self.lock:
+            score = self._get(peer_id)
+            score.rtt = moving_average(score.rtt, seconds, PeerScoreBoard.WEIGHT)
+
+
+    def record_piece(self, peer_id, piece_bytes, seconds):
+        """
+        :param piece_bytes: bytes of the verified piece
+        :param seconds: time the connection spent receiving it
+        :return: None
+        """
+        with self.lock:
+            score = self._get(peer_id)
+            score.pieces += 1
+            score.throughput = moving_average(score.throughput, piece_bytes / max(seconds, 1e-6), PeerScoreBoard.WEIGHT)
+
+
+    def record_hash_failure(self, peer_id):
+        """
+        :return: True if the peer is now banned
+        """
+        with self.lock:
+            score = self._get(peer_id)
+            score.hash_failures += 1
+            if (score.hash_failures > PeerScoreBoard.MAX_HASH_FAILURES and
+                    score.hash_failures > score.pieces):
+                self._ban(score)
+                return True
+            return False
+
+
+    def record_error(self, peer_id):
+        # connection refused, reset or protocol error, the peer is banned
+        with self.lock:
+            score = self._get(peer_id)
+            score.errors += 1
+            self._ban(score)
+
+
+    def _ban(self, score):
+        score.bans += 1
+        duration = min(PeerScoreBoard.BAN_BASE * 2 ** (score.bans - 1), PeerScoreBoard.BAN_MAX)
+        score.banned_until = time.monotonic() + duration
+
+
+    def is_banned(self, peer_id):
+        with self.lock:
+            return peer_id in self.scores and self.scores[peer_id].banned_until > time.monotonic()
+
+
+    def score(self, peer_id):
+        """
+        Expected throughput of the peer, unknown peers get the best
+        measured throughput so that they are tried
+        """
+        with self.lock:
+            return self._score(peer_id, self._best_throughput())
+
+
+    def _best_throughput(self):
+        return max((score.throughput for score in self.scores.values() if score.throughput), default=1.0)
+
+
+    def _score(self, peer_id, best_throughput):
+        score = self.scores.get(peer_id)
+        if score is None or score.throughput is None:
+            return best_throughput
+        failure_rate = score.hash_failures / (score.pieces + score.hash_failures)
+        return score.throughput * (1 - failure_rate)
+
+
+    def rank(self, peer_ids):
+        """
+        :param peer_ids: candidate peers
+        :return: the peers not banned, best score first
+        """
+        now = time.monotonic()
+        with self.lock:
+            best_throughput = self._best_throughput()
+            candidates = [peer_id for peer_id in peer_ids
+                          if peer_id not in self.scores or self.scores[peer_id].banned_until <= now]
+            return sorted(candidates, key=lambda peer_id: -self._score(peer_id, best_throughput))
+
+
+    def pipeline_depth(self, peer_id, piece_length):
+        """
+        Pieces to keep requested on the connection, enough to cover
+        the bandwidth-delay product of the peer
+        """
+        with self.lock:
+            score = self.scores.get(peer_id)
+            if score is None or score.rtt is None or score.throughput is None:
+                return 2
+            depth = math.ceil(score.throughput * score.rtt / piece_length) + 1
+            return max(1, min(depth, PeerScoreBoard.MAX_PIPELINE))
+
+
+    def evict_slowest(self, connected_peer_ids):
+        """
+        Ask the slowest connected peer to disconnect when it is far
+        below the median, its slot goes to an untried peer
+        :return: the evicted peer_id, None if none is
+        """
+        with self.lock:
+            measured = [(self.scores[peer_id].throughput, peer_id) for peer_id in connected_peer_ids
+                        if peer_id in self.scores and self.scores[peer_id].throughput is not None
+                        and not self.scores[peer_id].evicted]
+            if len(measured) < 2:
+                return None
+            measured.sort()
+            median = measured[len(measured) // 2][0]
+            throughput, peer_id = measured[0]
+            if throughput >= PeerScoreBoard.EVICT_RATIO * median:
+                return None
+            self.scores[peer_id].evicted = True
+            return peer_id
+
+
+    def should_disconnect(self, peer_id):
+        with self.lock:
+            score = self.scores.get(peer_id)
+            return score is not None and (score.evicted or score.banned_until > time.monotonic())
+
+
+    def is_measured(self, peer_id):
+        with self.lock:
+            return peer_id in self.scores and self.scores[peer_id].throughput is not None
+
+
+    def disconnected(self, peer_id):
+        # an evicted peer may be chosen again once the untried ones are
+        with self.lock:
+            if peer_id in self.scores:
+                self.scores[peer_id].evicted = False
+
+
+    def banned_number(self):
+        now = time.monotonic()
+        with self.lock:
+            return sum(1 for score in self.scores.values() if score.banned_until > now)
+
+
+    def to_dict(self):
+        with self.lock:
+            return {peer_id: score.to_dict() for peer_id, score in self.scores.items()}
@@ -0,0 +1,107 @@
+import threading
+
+
+class PeerExchange:
+    """
+    Peers known by a client peer, shared with the connected peers
+    through the PEX message. Every change is logged with a version,
+    so that each connection only receives the peers added/dropped
+    since its previous PEX message.
+    """
+    # changes kept in the log, older versions get a full snapshot
+    MAX_LOG = 1000
+
+    def __init__(self, own_peer_id):
+        self.own_peer_id = own_peer_id
+        # peer_id -> {'peer_id', 'peer_ip', 'peer_port'}
+        self.peers = {}
+        # list of (version, 'added' or 'dropped', peer)
+        self.log = []
+        self.version = 0
+        self.lock = threading.Lock()
+
+
+    def _log(self, action, peer):
+        self.version += 1
+        self.log.append((self.version, action, peer))
+        if len(self.log) > PeerExchange.MAX_LOG:
+            del self.log[:len(self.log) - PeerExchange.MAX_LOG]
+
+
+    def add(self, peer):
+        """
+        :param peer: dictionary with peer_id, peer_ip and peer_port
+        :return: True if the peer was not known
+        """
+        if peer['peer_id'] == self.own_peer_id:
+            return False
+        peer = {'peer_id': peer['peer_id'], 'peer_ip': peer['peer_ip'], 'peer_port': peer['peer_port']}
+        with self.lock:
+            if peer['peer_id'] in self.peers:
+                return False
+            self.peers[peer['peer_id']] = peer
+            self._log('added', peer)
+            return True
+
+
+    def drop(self, peer_id):
+        """
+        Forget a peer that is gone and tell the connected peers
+        :param peer_id: peer_id of the peer
+        :return: None
+        """
+        with self.lock:
+            peer = self.peers.pop(peer_id, None)
+            if peer is not None:
+                self._log('dropped', peer)
+
+
+    def forget(self, peer_id):
+        """
+        Forget a peer dropped by another peer, without passing the drop on
+        :param peer_id: peer_id of the peer
+        :return: None
+        """
+        with self.lock:
+            self.peers.pop(peer_id, None)
+
+
+    def merge(self, peers):
+        """
+        Add the peers returned by the tracker. The reply is a capped
+        sample of the swarm, the known peers it leaves out are kept,
+        a peer is only dropped when it refuses a connection
+        :param peers: list of dictionary of peers
+        :return: None
+        """
+        for peer in peers:
+            self.add(peer)
+
+
+    def get_peers(self):
+        with self.lock:
+            return list(self.peers.values())
+
+
+    def changes_since(self, version, max_peers):
+        """
+        :param version: version returned by the previous call, 0 for the first one
+        :param max_peers: maximum number of peers in added and in dropped
+        :return: (new version, list of added peers, list of dropped peer_id)
+        """
+        with self.lock:
+            if not self.log or version < self.log[0][0] - 1:
+                # first message or too old for the log, send everything
+                return self.version, list(self.peers.values())[:max_peers], []
+            added = {}
+            dropped = {}
+            for entry_version, action, peer in self.log:
+                if entry_version <= version:
+                    continue
+                if action == 'added':
+                    dropped.pop(peer['peer_id'], None)
+                    added[peer['peer_id']] = peer
+                else:
+                    added.pop(peer['peer_id'], None)
+                    dropped[peer['peer_id']] = peer
+            return self.version, list(added.values())[:max_peers], list(dropped)[:max_peers]
@@ -0,0 +1,202 @@
+import bisect
+import fnmatch
+import threading
+
+
+SKIP = 0
+LOW = 1
+NORMAL = 2
+HIGH = 3
+
+PRIORITY_NAMES = {
+    'skip': SKIP,
+    'low': LOW,
+    'normal': NORMAL,
+    'high': HIGH
+}
+
+
+def parse_selection(spec, layout):
+    """
+    Parse a selection of the form '<file pattern>[:priority]' or
+    'bytes=<start>-<end>[:priority]' (end included, like HTTP ranges)
+    :param spec: string of the selection
+    :param layout: FileLayout of the torrent, the patterns match its names
+    :return: list of (start, end, priority) byte ranges of the torrent
+    :exception ValueError: the selection is invalid
+    """
+    target, _, priority_name = spec.rpartition(':')
+    if not target or priority_name.lower() not in PRIORITY_NAMES:
+        target, priority_name = spec, 'normal'
+    priority = PRIORITY_NAMES[priority_name.lower()]
+
+    if target.startswith('bytes='):
+        start, _, end = target[len('bytes='):].partition('-')
+        try:
+            start = int(start)
+            end = int(end) + 1 if end else layout.total_length
+        except ValueError:
+            raise ValueError(f'Invalid byte range {target}')
+        if start < 0 or end <= start:
+            raise ValueError(f'Invalid byte range {target}')
+        return [(start, min(end, layout.total_length), priority)]
+
+    ranges = [(offset, offset + length, priority)
+              for name, offset, length in zip(layout.names, layout.offsets, layout.lengths)
+              if length and fnmatch.fnmatchcase(name, target)]
+    if not ranges:
+        raise ValueError(f'No file matches {target}')
+    return ranges
+
+
+class PiecePriorities:
+    """
+    Priority of every piece (skip/low/normal/high) derived from
+    selections of byte ranges. The selections are applied in order,
+    a later one overrides the earlier ones on the bytes they share.
+    A piece takes the highest priority of the bytes it covers, so
+    that a piece shared by a wanted and a skipped file is downloaded.
+    The read cursors of the stream readers make the pieces just
+    ahead of them due first, whatever their priority.
+    """
+    # pieces ahead of a read cursor requested before any other
+    STREAM_WINDOW = 16
+
+    def __init__(self, layout, piece_length):
+        self.layout = layout
+        self.piece_length = piece_length
+        self.piece_number = -(-layout.total_length // piece_length)
+        self.selections = []
+        self.priorities = [NORMAL] * self.piece_number
+        # reader -> piece under its read cursor
+        self.cursors = {}
+        # bumped when the order of the pieces changes
+        self.version = 0
+        self.lock = threading.Lock()
+
+
+    def select(self, specs):
+        """
+        Replace the selections, nothing selected means every piece is normal
+        :param specs: list of selection strings, see parse_selection
+        :return: None
+        :exception ValueError: a selection is invalid
+        """
+        selections = []
+        for spec in specs:
+            selections.extend(parse_selection(spec, self.layout))
+        priorities = self.compute(selections)
+        with self.lock:
+            self.selections = selections
+            self.priorities = priorities
+            self.version += 1
+
+
+    def set_cursor(self, reader, offset):
+        """
+        :param reader: the stream reader
+        :param offset: offset (byte) in the torrent of its next read
+        :return: None
+        """
+        piece_index = min(offset // self.piece_length, self.piece_number - 1)
+        with self.lock:
+            if self.cursors.get(reader) != piece_index:
+                self.cursors[reader] = piece_index
+                self.version += 1
+
+
+    def remove_cursor(self, reader):
+        with self.lock:
+            if self.cursors.pop(reader, None) is not None:
+                self.version += 1
+
+
+    def compute(self, selections):
+        if not selections:
+            return [NORMAL] * self.piece_number
+        # selecting what to download skips the rest, only skipping keeps the rest
+        default = SKIP if any(priority != SKIP for _, _, priority in selections) else NORMAL
+
+        # split the torrent at every selection boundary, each segment
+        # takes the priority of the last selection covering it
+        boundaries = sorted({0, self.layout.total_length} |
+                            {min(max(offset, 0), self.layout.total_length)
+                             for start, end, _ in selections for offset in (start, end)})
+        segment_priorities = [default] * (len(boundaries) - 1)
+        for start, end, priority in selections:
+            for k in range(bisect.bisect_left(boundaries, start), bisect.bisect_left(boundaries, end)):
+                segment_priorities[k] = priority
+
+        priorities = [SKIP] * self.piece_number
+        for k, priority in enumerate(segment_priorities):
+            if priority == SKIP:
+                continue
+            for i in range(boundaries[k] // self.piece_length, (boundaries[k + 1] - 1) // self.piece_length + 1):
+                priorities[i] = max(priorities[i], priority)
+        return priorities
+
+
+    def get(self, piece_index):
+        return self.priorities[piece_index]
+
+
+    def is_wanted(self, piece_index):
+        return self.priorities[piece_index] != SKIP
+
+
+    def wanted_pieces(self):
+        priorities = self.priorities
+        return [i for i in range(self.piece_number) if priorities[i] != SKIP]
+
+
+    def wanted_length(self):
+        """
+        :return: number of bytes of the wanted pieces
+        """
+        last_piece_length = self.layout.total_length - (self.piece_number - 1) * self.piece_length
+        return sum(last_piece_length if i == self.piece_number - 1 else self.piece_length
+                   for i in self.wanted_pieces())
+
+
+    def order(self, piece_indexes):
+        """
+        :param piece_indexes: candidate pieces to request
+        :return: the wanted pieces, the ones in the window of a read cursor
+        first by deadline (distance to the cursor), then the others by
+        highest priority then by index
+        """
+        priorities = self.priorities
+        with self.lock:
+            cursors = sorted(set(self.cursors.values()))
+
+        def deadline(i):
+            # distance to the closest cursor before the piece
+            k = bisect.bisect_right(cursors, i)
+            if k and i - cursors[k - 1] < PiecePriorities.STREAM_WINDOW:
+                return 0, i - cursors[k - 1]
+            return 1, -priorities[i], i
+
+        return sorted((i for i in piece_indexes if priorities[i] != SKIP), key=deadline)
+
+
+    def file_states(self):
+        """
+        :return: for every file, 'full' when all its pieces are wanted,
+        'partial' when some are and 'skip' when none is
+        """
+        priorities = self.priorities
+        states = []
+        for offset, length in zip(self.layout.offsets, self.layout.lengths):
+            if not length:
+                states.append('full')
+                continue
+            wanted = [priorities[i] != SKIP for i in range(offset // self.piece_length,
+                                                          (offset + length - 1) // self.piece_length + 1)]
+            states.append('full' if all(wanted) else 'partial' if any(wanted) else 'skip')
+        return states
+
+
+    def to_dict(self):
+        priorities = self.priorities
+        return {name: sum(1 for i in range(self.piece_number) if priorities[i] == priority)
+                for name, priority in PRIORITY_NAMES.items()}
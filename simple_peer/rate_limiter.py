@@ -0,0 +1,166 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket limiting a byte rate. A rate of 0 means unlimited,
+    the bucket then only measures the achieved rate.
+    Tokens may go negative (debt), so a block larger than the burst
+    is still accepted, the caller just waits longer.
+    """
+    # seconds over which the achieved rate is measured
+    RATE_WINDOW = 2
+
+    def __init__(self, rate=0, burst=None):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.total_bytes = 0
+        self.window_start = self.last_refill
+        self.window_bytes = 0
+        self.achieved_rate = 0.0
+
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate
+            self.burst = burst or rate
+            self.tokens = min(self.tokens, self.burst)
+
+
+    def reserve(self, n):
+        """
+        Take n bytes worth of tokens
+        :param n: number of bytes about to be sent or received
+        :return: seconds the caller must wait before transferring
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.total_bytes += n
+            self.window_bytes += n
+            if now - self.window_start >= TokenBucket.RATE_WINDOW:
+                self.achieved_rate = self.window_bytes / (now - self.window_start)
+                self.window_start = now
+                self.window_bytes = 0
+
+            if not self.rate:
+                self.last_refill = now
+                return 0
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+    def get_rate(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.window_start
+            if elapsed >= TokenBucket.RATE_WINDOW:
+                # nothing transferred for a full window
+                return self.window_bytes / elapsed
+            return self.achieved_rate
+
+
+    def to_dict(self):
+        return {
+            'limit': self.rate,
+            'rate': self.get_rate(),
+            'total_bytes': self.total_bytes
+        }
+
+
+def consume(buckets, n):
+    """
+    Wait until n bytes may pass through every bucket
+    :param buckets: iterable of TokenBucket
+    :param n: number of bytes
+    :return: None
+    """
+    wait = 0
+    for bucket in buckets:
+        wait = max(wait, bucket.reserve(n))
+    if wait > 0:
+        time.sleep(wait)
+
+
+class BandwidthManager:
+    """
+    Global upload/download buckets plus the per-peer buckets,
+    created on demand with the configured per-peer rates. The
+    buckets of a peer are keyed by its peer_id and outlive its
+    connections, a peer reconnecting keeps its debt, they are
+    evicted once idle for IDLE_TIMEOUT
+    """
+    # seconds without a transfer before the buckets of a peer are evicted
+    IDLE_TIMEOUT = 60
+
+    def __init__(self, upload_rate=0, download_rate=0, peer_upload_rate=0, peer_download_rate=0):
+        self.upload = TokenBucket(upload_rate)
+        self.download = TokenBucket(download_rate)
+        self.peer_upload_rate = peer_upload_rate
+        self.peer_download_rate = peer_download_rate
+        # key of the remote peer -> (upload bucket, download bucket)
+        self.peers = {}
+        self.peers_lock = threading.Lock()
+        self.last_eviction = time.monotonic()
+
+
+    def set_limits(self, upload_rate=None, download_rate=None, peer_upload_rate=None, peer_download_rate=None):
+        if upload_rate is not None:
+            self.upload.set_rate(upload_rate)
+        if download_rate is not None:
+            self.download.set_rate(download_rate)
+        with self.peers_lock:
+            if peer_upload_rate is not None:
+                self.peer_upload_rate = peer_upload_rate
+                for upload, _ in self.peers.values():
+                    upload.set_rate(peer_upload_rate)
+            if peer_download_rate is not None:
+                self.peer_download_rate = peer_download_rate
+                for _, download in self.peers.values():
+                    download.set_rate(peer_download_rate)
+
+
+    def peer_buckets(self, key):
+        """
+        :param key: peer_id of the remote peer, or url of a web seed
+        :return: (upload bucket, download bucket) of the peer
+        """
+        with self.peers_lock:
+            now = time.monotonic()
+            if now - self.last_eviction >= BandwidthManager.IDLE_TIMEOUT:
+                self.evict_idle(now)
+            if key not in self.peers:
+                self.peers[key] = (TokenBucket(self.peer_upload_rate), TokenBucket(self.peer_download_rate))
+            return self.peers[key]
+
+
+    def evict_idle(self, now):
+        # called with peers_lock held, an idle bucket has refilled long ago
+        self.last_eviction = now
+        idle_keys = [key for key, (upload, download) in self.peers.items()
+                     if now - max(upload.last_refill, download.last_refill) >= BandwidthManager.IDLE_TIMEOUT]
+        for key in idle_keys:
+            del self.peers[key]
+
+
+    def to_dict(self):
+        with self.peers_lock:
+            peers = {str(key): {'upload': upload.to_dict(), 'download': download.to_dict()}
+                     for key, (upload, download) in self.peers.items()}
+        return {
+            'upload': self.upload.to_dict(),
+            'download': self.download.to_dict(),
+            'peer_upload_limit': self.peer_upload_rate,
+            'peer_download_limit': self.peer_download_rate,
+            'peers': peers
+        }
+
+
+# limits shared by every torrent of the process
+global_bandwidth = BandwidthManager()
@@ -1,7 +1,4 @@
 import logging
-import time
-import requests
-from simple_peer.util import get_announce
 
 
 logger = logging.getLogger('re_announcer')
@@ -16,29 +13,32 @@ def re_announce_announce(client_peer):
     of the client_peer
     :param client_peer: object peer to re-announce
     :return: (interval, peers)
+    :exception Exception: no tracker answered
     """
     client_peer.set_re_announce_event()
-    response = requests.get(get_announce(client_peer.torrent), params=client_peer.get_params())
-    if response.status_code == 200:
-        interval = response.json()['interval']
-        peers = response.json()['peers']
-        # todo: replace the old peers with the new peers
-        return interval, peers
-    else:
-        raise Exception("Failed to re-announce to tracker")
+    interval, peers = client_peer.announcer.announce(client_peer.get_params())
+    client_peer.pex.merge(peers)
+    return interval, peers
 
 
 def re_announcer(interval, client_peer, peers, peers_lock):
-    try:
-        while True:
-            time.sleep(interval)
-
-            new_interval, new_peers = re_announce_announce(client_peer)
-
-            interval = new_interval
-
-            with peers_lock:
-                peers.clear()
-                peers.extend(new_peers)
-    except Exception as e:
-        logger.error(str(e))
\ No newline at end of file
+    """
+    Re-announce every interval until the peer is stopped. When no
+    tracker answers, the announce is retried once the backoff of
+    the first failing tracker expires, the peers are kept meanwhile
+    """
+    while True:
+        # sleep for interval, wake up and quit if the peer is stopped
+        if client_peer.wait_until_stopped(interval):
+            return
+
+        try:
+            interval, new_peers = re_announce_announce(client_peer)
+        except Exception as e:
+            interval = client_peer.announcer.retry_delay()
+            logger.error(f'{e}, retrying in {interval:.0f} seconds')
+            continue
+
+        with peers_lock:
+            peers.clear()
+            peers.extend(new_peers)
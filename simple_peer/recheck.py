@@ -0,0 +1,210 @@
+import hashlib
+import json
+import math
+import mmap
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from simple_peer.util import get_torrent_dic, get_info_hash_from_torrent_dic, get_file_layout_from_torrent_dic, \
+    SimpleClient
+from simple_peer.wire import encode_bitfield, decode_bitfield
+
+
+class FileMaps:
+    """
+    The files of a torrent mapped read-only in memory, the pages
+    are read ahead sequentially by the kernel. A missing or empty file
+    maps to None, its pieces are wrong.
+    """
+    def __init__(self, layout):
+        # path -> mmap
+        self.maps = {}
+        for path in layout.paths:
+            if path is None or path in self.maps:
+                continue
+            self.maps[path] = map_file(path)
+
+
+    def get(self, path):
+        return self.maps.get(path)
+
+
+    def close(self):
+        for mapped in self.maps.values():
+            if mapped is not None:
+                mapped.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def map_file(path):
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError:
+        return None
+    if hasattr(mapped, 'madvise'):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped
+
+
+def hash_pieces(file_maps, layout, piece_length, pieces_hash, start, end):
+    """
+    Hash the pieces start to end - 1 straight from the mapped files,
+    sha1 releases the GIL so the tasks of a thread pool hash in parallel
+    :return: list of the valid piece indexes
+    """
+    valid_pieces = []
+    for i in range(start, end):
+        piece_hash = hashlib.sha1()
+        for path, file_offset, span_length in layout.spans(i * piece_length, piece_length):
+            if path is None:
+                # padding file
+                piece_hash.update(bytes(span_length))
+                continue
+            mapped = file_maps.get(path)
+            if mapped is None or file_offset + span_length > len(mapped):
+                # the file is missing or shorter than in the torrent
+                break
+            with memoryview(mapped) as view:
+                piece_hash.update(view[file_offset:file_offset + span_length])
+        else:
+            if piece_hash.digest() == pieces_hash[20 * i:20 * i + 20]:
+                valid_pieces.append(i)
+    return valid_pieces
+
+
+def recheck_torrent(torrent, file, workers=SimpleClient.HASH_WORKERS, chunk_length=SimpleClient.RECHECK_CHUNK_LENGTH):
+    """
+    Verify the data on disk against the piece hashes of the torrent.
+    The torrent is decoded once, the pieces are split in tasks of
+    chunk_length consecutive bytes hashed by a pool of workers threads
+    :param torrent: the torrent
+    :param file: path to the file, or to the directory of a multi-file torrent
+    :param workers: hashing threads, 1 for a sequential recheck
+    :return: dictionary of the pieces, the valid pieces, the files checked and the hashing rate
+    """
+    torrent_dic = get_torrent_dic(torrent)
+    layout = get_file_layout_from_torrent_dic(torrent_dic, file)
+    piece_length = torrent_dic['info']['piece length']
+    pieces_hash = torrent_dic['info']['pieces']
+    piece_number = math.ceil(layout.total_length / piece_length)
+    # taken before hashing, a file written meanwhile is stale in the resume data
+    files = file_states(layout)
+    pieces_per_task = max(1, chunk_length // piece_length)
+
+    start_time = time.perf_counter()
+    with FileMaps(layout) as file_maps, ThreadPoolExecutor(max_workers=workers, thread_name_prefix='recheck') as pool:
+        tasks = [pool.submit(hash_pieces, file_maps, layout, piece_length, pieces_hash,
+                             start, min(start + pieces_per_task, piece_number))
+                 for start in range(0, piece_number, pieces_per_task)]
+        valid_pieces = [i for task in tasks for i in task.result()]
+    seconds = time.perf_counter() - start_time
+
+    return {
+        'info_hash': get_info_hash_from_torrent_dic(torrent_dic).hex(),
+        'piece_number': piece_number,
+        'valid_pieces': valid_pieces,
+        'files': files,
+        'bytes': layout.total_length,
+        'seconds': seconds,
+        'rate': layout.total_length / seconds if seconds else None
+    }
+
+
+def file_states(layout):
+    """
+    :return: list of {'path', 'length', 'mtime'} of the files on disk
+    """
+    files = []
+    for path in dict.fromkeys(path for path in layout.paths if path is not None):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        files.append({'path': path, 'length': stat.st_size, 'mtime': stat.st_mtime_ns})
+    return files
+
+
+def write_resume(path, result):
+    """
+    Save the outcome of a recheck as resume data
+    :param result: dictionary from recheck_torrent
+    :return: None
+    """
+    resume = {
+        'info_hash': result['info_hash'],
+        'piece_number': result['piece_number'],
+        'bitfield': encode_bitfield(result['valid_pieces'], result['piece_number']).hex(),
+        'files': result['files']
+    }
+    with open(path, 'w') as f:
+        json.dump(resume, f, indent=2)
+
+
+def load_resume(path, torrent, file):
+    """
+    :param path: resume data written by write_resume
+    :return: set of the valid piece indexes
+    :exception ValueError: the resume data is about another torrent, or a file changed since the recheck
+    """
+    with open(path, 'r') as f:
+        resume = json.load(f)
+    torrent_dic = get_torrent_dic(torrent)
+    if resume['info_hash'] != get_info_hash_from_torrent_dic(torrent_dic).hex():
+        raise ValueError(f'{path} is the resume data of another torrent')
+    checked_files = {checked['path']: checked for checked in resume['files']}
+    for state in file_states(get_file_layout_from_torrent_dic(torrent_dic, file)):
+        if checked_files.pop(state['path'], None) != state:
+            raise ValueError(f'{state["path"]} changed since the recheck, run recheck again')
+    if checked_files:
+        raise ValueError(f'{next(iter(checked_files))} is missing, run recheck again')
+    return {i for i in decode_bitfield(bytes.fromhex(resume['bitfield'])) if i < resume['piece_number']}
+
+
+def resume_pieces(peer, peer_pieces_tracking, peer_pieces_tracking_lock, valid_pieces):
+    """
+    Track the pieces of the resume data AVAILABLE, the leecher
+    only downloads the other ones and seeds right away when none is left
+    :return: None
+    """
+    with peer_pieces_tracking_lock:
+        for i in valid_pieces:
+            peer_pieces_tracking[i] = 'AVAILABLE'
+    peer.update_left(peer_pieces_tracking, peer_pieces_tracking_lock)
+
+
+def piece_ranges(pieces):
+    """
+    :param pieces: sorted piece indexes
+    :return: list of (first, last) of the runs of consecutive pieces
+    """
+    ranges = []
+    for i in pieces:
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return [(first, last) for first, last in ranges]
+
+
+def bitfield_map(valid_pieces, piece_number, width=64):
+    """
+    :return: one character per group of consecutive pieces, '#' all valid, '+' some, '.' none
+    """
+    valid = set(valid_pieces)
+    groups = min(width, piece_number)
+    characters = []
+    for k in range(groups):
+        group = range(k * piece_number // groups, (k + 1) * piece_number // groups)
+        count = sum(1 for i in group if i in valid)
+        characters.append('#' if count == len(group) else '+' if count else '.')
+    return ''.join(characters)
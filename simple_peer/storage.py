@@ -0,0 +1,182 @@
+import bisect
+import os
+import threading
+
+
+class FileLayout:
+    """
+    Maps the byte range of the torrent (the files concatenated in
+    order) onto the files. The path of a padding file is None.
+    The start offset of every file is precomputed, a range is
+    located with a binary search so that torrents of thousands
+    of files don't walk the list per block.
+    """
+    def __init__(self, files, names=None, directory=None):
+        """
+        :param files: list of (path, length) in the order of the torrent
+        :param names: names of the files in the torrent, default to the paths
+        :param directory: name of the directory of a multi-file torrent, None for a single-file one
+        """
+        self.paths = [path for path, _ in files]
+        self.names = names or self.paths
+        self.directory = directory
+        self.lengths = [length for _, length in files]
+        self.offsets = []
+        offset = 0
+        for length in self.lengths:
+            self.offsets.append(offset)
+            offset += length
+        self.total_length = offset
+
+
+    def spans(self, offset, length):
+        """
+        :param offset: offset (byte) in the torrent
+        :param length: number of bytes, cut at the end of the torrent
+        :return: list of (path, offset in the file, length) covering the range
+        """
+        length = min(length, self.total_length - offset)
+        spans = []
+        if length <= 0:
+            return spans
+        # last file starting at or before offset, skips the empty files sharing its offset
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        while length > 0:
+            file_offset = offset - self.offsets[i]
+            span_length = min(length, self.lengths[i] - file_offset)
+            if span_length > 0:
+                spans.append((self.paths[i], file_offset, span_length))
+                offset += span_length
+                length -= span_length
+            i += 1
+        return spans
+
+
+class Storage:
+    """
+    Disk I/O layer shared by every torrent of the process.
+    Keeps open descriptors per file and uses positional
+    reads/writes, so that concurrent requesters and handlers
+    never fight over a shared file offset. A file is opened
+    read-only for reading and read-write on its first write,
+    so that read-only data can still be seeded.
+    """
+    def __init__(self):
+        # (path, writable) -> (descriptor, lock)
+        self.files = {}
+        self.files_lock = threading.Lock()
+
+
+    def _get_file(self, file, writable=False):
+        key = (file, writable)
+        with self.files_lock:
+            if key not in self.files:
+                flags = os.O_RDWR if writable else os.O_RDONLY
+                fd = os.open(file, flags | getattr(os, 'O_BINARY', 0))
+                # only needed when positional I/O is not supported (Windows)
+                self.files[key] = (fd, threading.Lock())
+            return self.files[key]
+
+
+    def read(self, file, offset, length):
+        """
+        Read length bytes of file starting at offset
+        :param file: path to the file
+        :param offset: offset (byte) in the file
+        :param length: number of bytes to read
+        :return: bytes read, shorter than length at the end of the file
+        """
+        fd, fd_lock = self._get_file(file)
+        if hasattr(os, 'pread'):
+            return os.pread(fd, length, offset)
+        with fd_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+
+    def write(self, file, offset, data):
+        """
+        Write data into file starting at offset
+        :param file: path to the file
+        :param offset: offset (byte) in the file
+        :param data: bytes to write
+        :return: None
+        """
+        fd, fd_lock = self._get_file(file, writable=True)
+        view = memoryview(data)
+        if hasattr(os, 'pwrite'):
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+            return
+        with fd_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+
+
+    def read_spans(self, layout, offset, length):
+        """
+        Read a range of the torrent that may span several files,
+        the files are read straight into one buffer
+        :param layout: FileLayout of the torrent
+        :param offset: offset (byte) in the torrent
+        :param length: number of bytes to read
+        :return: bytes read, shorter than length at the end of the torrent
+        """
+        spans = layout.spans(offset, length)
+        if len(spans) == 1 and spans[0][0] is not None:
+            return self.read(*spans[0])
+        buffer = bytearray(sum(span_length for _, _, span_length in spans))
+        view = memoryview(buffer)
+        position = 0
+        for path, file_offset, span_length in spans:
+            if path is None:
+                # padding file, the buffer is already zeros
+                position += span_length
+                continue
+            fd, _ = self._get_file(path)
+            if hasattr(os, 'preadv'):
+                read = os.preadv(fd, [view[position:position + span_length]], file_offset)
+            else:
+                data = self.read(path, file_offset, span_length)
+                read = len(data)
+                view[position:position + read] = data
+            position += read
+            if read < span_length:
+                break
+        return bytes(view[:position])
+
+
+    def write_spans(self, layout, offset, data):
+        """
+        Write a range of the torrent that may span several files
+        :param layout: FileLayout of the torrent
+        :param offset: offset (byte) in the torrent
+        :param data: bytes to write
+        :return: None
+        """
+        view = memoryview(data)
+        position = 0
+        for path, file_offset, span_length in layout.spans(offset, len(data)):
+            if path is not None:
+                self.write(path, file_offset, view[position:position + span_length])
+            position += span_length
+
+
+    def close(self, file):
+        with self.files_lock:
+            entries = [self.files.pop((file, writable), None) for writable in (False, True)]
+        for entry in entries:
+            if entry:
+                os.close(entry[0])
+
+
+    def close_all(self):
+        with self.files_lock:
+            entries = list(self.files.values())
+            self.files.clear()
+        for fd, _ in entries:
+            os.close(fd)
@@ -0,0 +1,116 @@
+import asyncio
+import io
+
+
+class StreamReader(io.RawIOBase):
+    """
+    Read-only file-like view of a file of the torrent while it
+    downloads. A read blocks until the piece under the cursor is
+    verified and returns the bytes available from there, so that a
+    consumer processes the head of a file while the tail is still
+    downloading. The cursor makes the pieces just ahead of it the
+    first ones requested.
+    """
+    # seconds between two checks of the pieces, in case a notification is missed
+    WAIT_TIMEOUT = 1.0
+
+    def __init__(self, peer, peer_pieces_tracking, name=None):
+        """
+        :param peer: object represents the downloading peer
+        :param peer_pieces_tracking: dictionary of pieces tracking of the peer
+        :param name: name of the file in the torrent, None for the whole torrent
+        :exception KeyError: no file of the torrent has this name
+        """
+        super().__init__()
+        self.peer = peer
+        self.peer_pieces_tracking = peer_pieces_tracking
+        layout = peer.layout
+        if name is None:
+            self.start, self.length = 0, layout.total_length
+        else:
+            if name not in layout.names:
+                raise KeyError(name)
+            k = layout.names.index(name)
+            self.start, self.length = layout.offsets[k], layout.lengths[k]
+        self.piece_length = peer.priorities.piece_length
+        self.position = 0
+        peer.priorities.set_cursor(self, self.start)
+
+
+    def readable(self):
+        return True
+
+
+    def seekable(self):
+        return True
+
+
+    def tell(self):
+        return self.position
+
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.length + offset
+        else:
+            raise ValueError(f'Invalid whence {whence}')
+        if position < 0:
+            raise ValueError(f'Negative seek position {position}')
+        self.position = position
+        self.peer.priorities.set_cursor(self, self.start + min(position, self.length))
+        return position
+
+
+    def is_available(self, piece_index):
+        return self.peer_pieces_tracking[piece_index] == 'AVAILABLE'
+
+
+    def wait_for_piece(self, piece_index):
+        """
+        :param piece_index: the piece under the cursor
+        :return: None
+        :exception IOError: the piece is skipped or the peer stopped
+        """
+        while not self.is_available(piece_index):
+            if not self.peer.priorities.is_wanted(piece_index):
+                raise IOError(f'Piece [{piece_index}] is not selected for download')
+            if self.peer.stopped:
+                raise IOError('The peer is stopped')
+            self.peer.wait_for_state(lambda peer: self.is_available(piece_index) or peer.stopped,
+                                     StreamReader.WAIT_TIMEOUT)
+
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.length - self.position)
+        if size <= 0 or self.closed:
+            return 0
+        offset = self.start + self.position
+        piece_index = offset // self.piece_length
+        self.wait_for_piece(piece_index)
+
+        # extend the read over the next verified pieces, at most size bytes
+        end = min(offset + size, (piece_index + 1) * self.piece_length)
+        while end < offset + size and self.is_available(end // self.piece_length):
+            end = min(offset + size, end + self.piece_length)
+
+        data = self.peer.read_range(offset, end - offset)
+        buffer[:len(data)] = data
+        self.seek(self.position + len(data))
+        return len(data)
+
+
+    async def read_async(self, size=-1):
+        """
+        read() run in the default executor, for asyncio consumers
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.read, size)
+
+
+    def close(self):
+        if not self.closed:
+            self.peer.priorities.remove_cursor(self)
+        super().close()
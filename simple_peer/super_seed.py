@@ -0,0 +1,125 @@
+import random
+import threading
+import time
+from simple_peer.util import SimpleClient
+
+
+class SuperSeeder:
+    """
+    Super-seeding (BEP 16 style) of the initial seeder: every peer
+    is offered one piece that the other peers don't have yet, the
+    next one is revealed once the offered piece is seen at another
+    peer, so that the origin uploads each piece about once.
+    The pieces of the peers are learned from the bitfield they send
+    with their HAVE requests. A peer is forgotten when its connection
+    closes or after SUPER_SEED_TIMEOUT seconds without a HAVE, so
+    that only the connected peers count in the availability.
+    """
+    def __init__(self, piece_number):
+        self.piece_number = piece_number
+        # peer -> set of pieces the peer has
+        self.peer_pieces = {}
+        # peer -> (piece offered, time of the offer)
+        self.offers = {}
+        # peer -> set of pieces ever offered to the peer
+        self.offered = {}
+        # peer -> time of its last HAVE
+        self.last_seen = {}
+        # piece -> number of offers
+        self.offer_count = [0] * piece_number
+        # piece -> number of peers having the piece
+        self.availability = [0] * piece_number
+        self.completed = False
+        self.lock = threading.Lock()
+
+
+    def update_peer_pieces(self, peer, pieces):
+        old_pieces = self.peer_pieces.get(peer, set())
+        for i in pieces - old_pieces:
+            self.availability[i] += 1
+        for i in old_pieces - pieces:
+            self.availability[i] -= 1
+        self.peer_pieces[peer] = pieces
+
+
+    def remove(self, peer):
+        """
+        Forget a peer, its pieces leave the availability and
+        a piece offered to it and not received is offered again
+        :param peer: identifier of the peer
+        :return: None
+        """
+        with self.lock:
+            self.remove_peer(peer)
+
+
+    def remove_peer(self, peer):
+        # called with the lock held
+        pieces = self.peer_pieces.pop(peer, set())
+        for i in pieces:
+            self.availability[i] -= 1
+        offer = self.offers.pop(peer, None)
+        if offer is not None and offer[0] not in pieces:
+            self.offer_count[offer[0]] -= 1
+        self.offered.pop(peer, None)
+        self.last_seen.pop(peer, None)
+
+
+    def expire(self, now):
+        # the peers without a HAVE for SUPER_SEED_TIMEOUT seconds are gone
+        for peer in [peer for peer, seen in self.last_seen.items() if now - seen >= SimpleClient.SUPER_SEED_TIMEOUT]:
+            self.remove_peer(peer)
+
+
+    def is_propagated(self, peer, piece):
+        # another peer than the one it was offered to has it
+        return self.availability[piece] - (piece in self.peer_pieces.get(peer, ())) > 0
+
+
+    def choose_piece(self, peer):
+        pieces = self.peer_pieces.get(peer, set())
+        candidates = [i for i in range(self.piece_number) if i not in pieces]
+        if not candidates:
+            return None
+        rarest = min(self.offer_count[i] + self.availability[i] for i in candidates)
+        return random.choice([i for i in candidates if self.offer_count[i] + self.availability[i] == rarest])
+
+
+    def pieces_for(self, peer, pieces):
+        """
+        Pieces advertised to a peer in the HAVE response
+        :param peer: identifier of the requesting peer
+        :param pieces: set of pieces the peer has, the indexes beyond the torrent are ignored
+        :return: dictionary of piece index -> 'AVAILABLE'/'UNAVAILABLE'
+        """
+        pieces = {i for i in pieces if i < self.piece_number}
+        with self.lock:
+            now = time.monotonic()
+            self.expire(now)
+            self.last_seen[peer] = now
+            self.update_peer_pieces(peer, pieces)
+
+            if not self.completed and all(self.availability):
+                # every piece is in the swarm, it is self-sufficient
+                self.completed = True
+            if self.completed:
+                return {i: 'AVAILABLE' for i in range(self.piece_number)}
+
+            offer = self.offers.get(peer)
+            if offer is not None:
+                piece, offer_time = offer
+                if piece in pieces:
+                    # reveal the next piece once the offered one propagates, when the peer is
+                    # alone or when it did not propagate for SUPER_SEED_TIMEOUT seconds
+                    if (self.is_propagated(peer, piece) or len(self.peer_pieces) <= 1 or
+                            time.monotonic() - offer_time >= SimpleClient.SUPER_SEED_TIMEOUT):
+                        offer = None
+            if offer is None:
+                piece = self.choose_piece(peer)
+                if piece is not None:
+                    self.offers[peer] = (piece, time.monotonic())
+                    self.offered.setdefault(peer, set()).add(piece)
+                    self.offer_count[piece] += 1
+
+            offered = self.offered.get(peer, set())
+            return {i: 'AVAILABLE' if i in offered else 'UNAVAILABLE' for i in range(self.piece_number)}
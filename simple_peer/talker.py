@@ -1,12 +1,19 @@
-import json
+import collections
 import logging
 import socket
-import struct
 import threading
 import time
 from simple_peer.config import INFO
-from simple_peer.util import get_piece_number, get_piece_length, verify_piece, write_piece, is_download_completed, SimpleClient, \
-    recv_exact_bytes, get_file_length
+from simple_peer.merkle import BLOCK_SIZE, PartialPiece
+from simple_peer.metrics import BYTES, PIECES, HASH_FAILURES, BLOCK_FAILURES, PIECE_LATENCY, CONNECTIONS, PIECES_IN_FLIGHT
+from simple_peer.peer_score import PeerScoreBoard
+from simple_peer.trace import trace_event, TRACE_CONNECT, TRACE_DISCONNECT, TRACE_BITFIELD, TRACE_REQUEST, \
+    TRACE_BLOCK, TRACE_REJECT, TRACE_CANCEL, TRACE_HASH_OK, TRACE_HASH_FAIL, TRACE_WRITE_DONE, TRACE_CHOKE
+from simple_peer.util import is_download_completed, SimpleClient
+from simple_peer.web_seed import start_web_seeds
+from simple_peer.wire import Connection, ProtocolError, decode_bitfield, encode_bitfield, PROTOCOL_VERSION, \
+    MESSAGE_NAMES, HANDSHAKE, HAVE, REQUEST, PIECE, CANCEL, REJECT, HASHES, PEX, DONE, \
+    HANDSHAKE_HEADER, BLOCK_REQUEST, PIECE_HEADER, PIECE_INDEX
 
 
 logger = logging.getLogger("requester")
@@ -15,7 +22,8 @@ logger = logging.getLogger("requester")
 def talker(client_peer, server_peers, server_peers_lock, peer_pieces_tracking, client_peer_lock, peer_pieces_tracking_lock):
     """
     Generate multiple threads to concurrently request pieces
-    from the server peer.
+    from the server peers, up to MAX_CONNECTIONS of them, the best
+    scored first. Banned peers are connected again when the ban expires.
     :param client_peer: object representing the client peer
     :param server_peers: list of dictionary of server peers
     :param server_peers_lock: the lock for changing server_peers
@@ -27,28 +35,50 @@ def talker(client_peer, server_peers, server_peers_lock, peer_pieces_tracking, c
     connected_server_peers = set([])
     connected_server_peers_lock = threading.Lock()
 
-    while not is_download_completed(client_peer):
+    # web seeds of the torrent download alongside the peers
+    start_web_seeds(client_peer, peer_pieces_tracking, peer_pieces_tracking_lock)
+
+    while not is_download_completed(client_peer) and not client_peer.stopped:
+        if client_peer.paused:
+            client_peer.wait_for_state(lambda peer: not peer.paused or peer.stopped)
+            continue
+        peers_version = client_peer.peers_version
         with server_peers_lock:
+            # add the peers learned through PEX since the last pass
+            known_peer_ids = {server_peer['peer_id'] for server_peer in server_peers}
+            server_peers.extend(peer for peer in client_peer.pex.get_peers() if peer['peer_id'] not in known_peer_ids)
             with connected_server_peers_lock:
-                for server_peer in server_peers:
-                    if (server_peer['peer_id'] != client_peer.peer_id and
-                        server_peer['peer_id'] not in connected_server_peers):
-
-                        connected_server_peers.add(server_peer['peer_id'])
-
-                        requester_thread = threading.Thread(target=requester, args=(client_peer,
-                                                                            server_peer,
-                                                                            peer_pieces_tracking,
-                                                                            peer_pieces_tracking_lock,
-                                                                            client_peer_lock,
-                                                                            connected_server_peers,
-                                                                            connected_server_peers_lock,
-                                                                            server_peers,
-                                                                            server_peers_lock),
-                                                            daemon=True)
-
-                        requester_thread.start()
-        time.sleep(SimpleClient.TALKER_CHECKING)
+                candidates = {server_peer['peer_id']: server_peer for server_peer in server_peers
+                              if server_peer['peer_id'] != client_peer.peer_id and
+                              server_peer['peer_id'] not in connected_server_peers}
+                # the best scored peers first, banned ones are left out
+                ranked_peer_ids = client_peer.scores.rank(candidates)
+                slots = PeerScoreBoard.MAX_CONNECTIONS - len(connected_server_peers)
+                if slots <= 0 and any(not client_peer.scores.is_measured(peer_id) for peer_id in ranked_peer_ids):
+                    # every slot is taken, the slowest peer makes room for an untried one
+                    evicted_peer_id = client_peer.scores.evict_slowest(connected_server_peers)
+                    if INFO and evicted_peer_id is not None:
+                        logger.info(f'Replacing the slow peer [{evicted_peer_id}]')
+                for peer_id in ranked_peer_ids[:max(slots, 0)]:
+                    connected_server_peers.add(peer_id)
+
+                    requester_thread = threading.Thread(target=requester, args=(client_peer,
+                                                                        candidates[peer_id],
+                                                                        peer_pieces_tracking,
+                                                                        peer_pieces_tracking_lock,
+                                                                        client_peer_lock,
+                                                                        connected_server_peers,
+                                                                        connected_server_peers_lock,
+                                                                        server_peers,
+                                                                        server_peers_lock),
+                                                        daemon=True)
+
+                    requester_thread.start()
+        # wake up early when the download completes, is stopped
+        # or new peers are learned through PEX
+        client_peer.wait_for_state(lambda peer: peer.left == 0 or peer.stopped or peer.paused or
+                                                peer.peers_version != peers_version,
+                                   SimpleClient.TALKER_CHECKING)
 
 
 def requester(client_peer, server_peer, peer_pieces_tracking, peer_pieces_tracking_lock,
@@ -72,13 +102,24 @@ def requester(client_peer, server_peer, peer_pieces_tracking, peer_pieces_tracki
         connected_server_peers.add(server_peer['peer_id'])
 
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connection = Connection(client_socket)
+    CONNECTIONS.inc(('out',))
     try:
-        client_socket.connect((server_peer['peer_ip'], server_peer['peer_port']))
+        try:
+            client_socket.connect((server_peer['peer_ip'], server_peer['peer_port']))
+        except ConnectionRefusedError:
+            # nothing listens on the port anymore, the peer is gone for the whole swarm
+            client_peer.pex.drop(server_peer['peer_id'])
+            raise
 
-        requester_having_interests(client_peer, client_socket, peer_pieces_tracking, client_peer_lock,
-                                   peer_pieces_tracking_lock, server_peer)
+        requester_handshake(connection, client_peer)
+        trace_event(client_peer, TRACE_CONNECT, server_peer['peer_id'])
 
-        requester_done(client_socket)
+        requester_having_interests(client_peer, connection, peer_pieces_tracking, client_peer_lock,
+                                   peer_pieces_tracking_lock, server_peer, server_peers, server_peers_lock,
+                                   connected_server_peers, connected_server_peers_lock)
+
+        requester_done(connection)
 
         with connected_server_peers_lock:
             connected_server_peers.remove(server_peer['peer_id'])
@@ -87,15 +128,17 @@ def requester(client_peer, server_peer, peer_pieces_tracking, peer_pieces_tracki
             if server_peer['peer_id'] in connected_server_peers:
                 connected_server_peers.remove(server_peer['peer_id'])
 
-        with server_peers_lock:
-            for server_peer_mem in server_peers:
-                if server_peer['peer_id'] == server_peer_mem['peer_id']:
-                    server_peers.remove(server_peer_mem)
-
+        # banned for a while rather than forgotten, the talker
+        # connects again once the ban expires
+        client_peer.scores.record_error(server_peer['peer_id'])
+        trace_event(client_peer, TRACE_CHOKE, server_peer['peer_id'])
 
         if INFO:
-            logger.info(str(e))
+            logger.info(f'{e}, banning [{server_peer["peer_id"]}]')
     finally:
+        trace_event(client_peer, TRACE_DISCONNECT, server_peer['peer_id'])
+        client_peer.scores.disconnected(server_peer['peer_id'])
+        CONNECTIONS.dec(('out',))
         client_socket.close()
 
 
@@ -118,102 +161,399 @@ def update_peer_pieces_tracking_unavailable(peer_pieces_tracking, peer_pieces_tr
     peer_pieces_tracking_lock.release()
 
 
-def requester_having_accumulator(peer_client_socket):
-    # print('Starting handling full json')
-    # First, receive the message length (assuming a 4-byte integer length header)
-    length_header = peer_client_socket.recv(4)  # Read the first 4 bytes for the length
-    if not length_header:
-        # If no length header received, the connection has been closed
-        raise ValueError("Connection closed unexpectedly")
+def requester_handshake(connection, client_peer):
+    """
+    Tell the server peer the protocol version and which torrent
+    this connection is about, a listener may serve many torrents
+    on the same port. Also tell the peer_id and listening port,
+    shared with other peers by PEX
+    :param connection: Connection to the server peer
+    :param client_peer: object represents the client peer
+    :return: None
+    """
+    payload = HANDSHAKE_HEADER.pack(PROTOCOL_VERSION, client_peer.info_hash, client_peer.peer_port)
+    connection.send(HANDSHAKE, payload + client_peer.peer_id.encode('utf-8'))
 
-    # Unpack the length from the header
-    message_length = struct.unpack('!I', length_header)[0]  # Big-endian unsigned int
 
-    full_data = recv_exact_bytes(peer_client_socket, message_length)
+def requester_having(connection, peer_pieces_tracking):
+    """
+    Send the 'HAVE' request, request for the available pieces
+    of the server peer. The request carries the bitfield of the
+    client peer (used by super-seeding server peers)
+    :param connection: Connection to the server peer
+    :param peer_pieces_tracking: dictionary of pieces tracking of the client peer
+    :return: set of the available pieces of the server peer
+    """
+    available = [i for i, state in peer_pieces_tracking.items() if state == 'AVAILABLE']
+    connection.send(HAVE, encode_bitfield(available, len(peer_pieces_tracking)))
+    return decode_bitfield(connection.expect(HAVE))
 
-    # Once we have the full message, attempt to decode and parse it
-    try:
-        json_data = full_data.decode('utf-8')  # Decode bytes to string
-        parsed_json = json.loads(json_data)  # Parse the string into a JSON object
-        # print('Finishing handling full json')
-        return parsed_json  # Return the parsed JSON object if successful
-    except (UnicodeDecodeError, json.JSONDecodeError):
-        # If decoding or JSON parsing fails, continue to receive data
-        if INFO:
-            logger.info('Error parsing JSON, waiting for more data...')
 
-def requester_having(client_socket):
+def requester_piece_length(client_peer, i):
+    # the last piece is shorter, the lengths are the ones of the peer, not decoded per request
+    piece_length = client_peer.priorities.piece_length
+    return min(piece_length, client_peer.layout.total_length - i * piece_length)
+
+
+def requester_send_request(connection, client_peer, server_peer, i, begin, length):
+    connection.send(REQUEST, BLOCK_REQUEST.pack(i, begin, length))
+    trace_event(client_peer, TRACE_REQUEST, server_peer['peer_id'], i, begin, length)
+
+
+def requester_send_cancel(connection, client_peer, server_peer, i, begin, length):
+    connection.send(CANCEL, BLOCK_REQUEST.pack(i, begin, length))
+    trace_event(client_peer, TRACE_CANCEL, server_peer['peer_id'], i, begin, length)
+
+
+def requester_receive_reply(connection, client_peer, server_peer):
+    """
+    Receive the reply to a REQUEST, the data is a view of the
+    receive buffer, valid until the next receive on the connection
+    :return: (piece index, begin, data), data is None when the request is rejected
+    :exception ProtocolError: the reply is neither PIECE nor REJECT
+    """
+    message_id, payload = connection.receive(client_peer.download_buckets(server_peer['peer_id']))
+    if message_id == PIECE:
+        i, begin = PIECE_HEADER.unpack_from(payload)
+        data = payload[PIECE_HEADER.size:]
+        BYTES.inc(('in', server_peer['peer_id']), len(data))
+        trace_event(client_peer, TRACE_BLOCK, server_peer['peer_id'], i, begin, len(data))
+        return i, begin, data
+    if message_id == REJECT:
+        i, begin, length = BLOCK_REQUEST.unpack(payload)
+        trace_event(client_peer, TRACE_REJECT, server_peer['peer_id'], i, begin, length)
+        return i, begin, None
+    raise ProtocolError(f'Expected PIECE, received {MESSAGE_NAMES[message_id]}')
+
+
+def requester_verify(connection, client_peer, peer_pieces_tracking, peer_pieces_tracking_lock, i, piece_data,
+                     requested_time, busy_time, server_peer):
     """
-    Send the 'HAVING' request using client_socket,
-    request for the dictionary of available pieces
-    of the server peer
-    :param client_socket: socket used to send
-    :return: dictionary of available pieces
+    Verify a received piece, a valid one is written and tracked
+    AVAILABLE, both outcomes are scored to the server peer
+    :param requested_time: time the piece was requested
+    :param busy_time: seconds the connection spent receiving the piece
+    :return: (True if the piece is valid, block hashes for a v2 torrent, None for a v1 one)
     """
-    # print('Sending HAVING request')
-    client_socket.send('HAVING\n'.encode('utf-8'))
-    server_peer_pieces_tracking = requester_having_accumulator(client_socket)
-    # print('Receiving HAVING response')
-    # todo: in the form as {'0': 'AVAILABLE'}
-    # todo: convert back to indexable form
-    server_peer_pieces_tracking = {int(k) : v for k, v in server_peer_pieces_tracking.items()}
-    return server_peer_pieces_tracking
+    if client_peer.merkle is not None:
+        is_valid, hashes = client_peer.verify_blocks(piece_data, i)
+    else:
+        is_valid, hashes = client_peer.verify_piece(piece_data, i), None
+
+    if is_valid:
+        trace_event(client_peer, TRACE_HASH_OK, server_peer['peer_id'], i, 0, len(piece_data))
+        PIECE_LATENCY.observe(time.perf_counter() - requested_time)
+        PIECES.inc(('in',))
+        client_peer.scores.record_piece(server_peer['peer_id'], len(piece_data), busy_time)
+        # todo: write piece_data to the file
+        client_peer.write_piece(piece_data, i)
+        trace_event(client_peer, TRACE_WRITE_DONE, server_peer['peer_id'], i, 0, len(piece_data))
+        # todo: update the piece_pieces_tracking
+        # tracked before the peer notifies, stream readers wake up on the notification
+        update_peer_pieces_tracking_available(peer_pieces_tracking, peer_pieces_tracking_lock, i)
+        client_peer.update_peer_available(len(piece_data), i)
+        server_ip, server_port = connection.sock.getpeername()
+        if INFO:
+            logger.info(f'Downloaded piece [{i}] from [{server_ip}][{server_port}]')
+    else:
+        trace_event(client_peer, TRACE_HASH_FAIL, server_peer['peer_id'], i, 0, len(piece_data))
+        HASH_FAILURES.inc((server_peer['peer_id'],))
+        if client_peer.scores.record_hash_failure(server_peer['peer_id']) and INFO:
+            logger.info(f'Banning [{server_peer["peer_id"]}], too many wrong pieces')
+        if INFO:
+            logger.info(f'Piece [{i}] is wrong')
+    return is_valid, hashes
 
 
-def requester_interest(peer_client_socket, client_peer, client_peer_lock, peer_pieces_tracking, peer_pieces_tracking_lock, i, server_peer):
+def requester_interest(connection, client_peer, client_peer_lock, peer_pieces_tracking, peer_pieces_tracking_lock, i, server_peer):
+    PIECES_IN_FLIGHT.inc()
+    # valid blocks kept from a previous attempt (v2 torrents)
+    partial = client_peer.partial_pieces.pop(i, None)
     try:
         # set DOWNLOADING on this piece index
         update_peer_pieces_tracking_downloading(peer_pieces_tracking, peer_pieces_tracking_lock, i)
-        interest_message = f'INTEREST {i}\n'
-        peer_client_socket.send(interest_message.encode('utf-8'))
-        # print(f'Sending INTEREST request {i}')
-        if i == get_piece_number(client_peer.torrent) - 1:
-            # if it is the last piece index
-            # calculate the last piece length
-            last_piece_length = get_file_length(client_peer.torrent) - (
-                        (get_piece_number(client_peer.torrent) - 1) * get_piece_length(client_peer.torrent))
-            piece_data = recv_exact_bytes(peer_client_socket, last_piece_length)
+        requested_time = time.perf_counter()
+        if partial is not None:
+            piece_data = requester_blocks(connection, client_peer, i, partial, server_peer)
         else:
-            piece_data = recv_exact_bytes(peer_client_socket, get_piece_length(client_peer.torrent))
-
-        if verify_piece(piece_data, i, client_peer.torrent):
-            # todo: write piece_data to the file
-            write_piece(piece_data, i, client_peer.torrent, client_peer.file)
-            # todo: update the piece_pieces_tracking
-            client_peer.update_peer_available()
-            update_peer_pieces_tracking_available(peer_pieces_tracking, peer_pieces_tracking_lock, i)
-            server_ip, server_port = peer_client_socket.getpeername()
-            if INFO:
-                logger.info(f'Downloaded piece [{i}] from [{server_ip}][{server_port}]')
-        else:
-            if INFO:
-                logger.info(f'Piece [{i}] is wrong')
+            length = requester_piece_length(client_peer, i)
+            requester_send_request(connection, client_peer, server_peer, i, 0, length)
+            piece_data = requester_check_reply(requester_receive_reply(connection, client_peer, server_peer), i, 0, length)
+            if piece_data is None:
+                update_peer_pieces_tracking_unavailable(peer_pieces_tracking, peer_pieces_tracking_lock, i)
+                return
+
+        is_valid, hashes = requester_verify(connection, client_peer, peer_pieces_tracking, peer_pieces_tracking_lock,
+                                            i, piece_data, requested_time, time.perf_counter() - requested_time, server_peer)
+        if not is_valid:
+            if hashes is not None:
+                # copied, the data is a view of the receive buffer
+                requester_bad_blocks(connection, client_peer, i, bytes(piece_data), hashes, partial, server_peer)
+                partial = None
             update_peer_pieces_tracking_unavailable(peer_pieces_tracking, peer_pieces_tracking_lock, i)
     except Exception as e:
+        if partial is not None:
+            # keep the valid blocks for the next attempt
+            client_peer.partial_pieces[i] = partial
         update_peer_pieces_tracking_unavailable(peer_pieces_tracking, peer_pieces_tracking_lock, i)
         raise
+    finally:
+        PIECES_IN_FLIGHT.dec()
+
+
+def requester_check_reply(reply, i, begin, length):
+    """
+    :param reply: (piece index, begin, data) from requester_receive_reply
+    :return: the data, None when the request is rejected
+    :exception ProtocolError: the reply is not the one of the request
+    """
+    reply_index, reply_begin, data = reply
+    if (reply_index, reply_begin) != (i, begin) or (data is not None and len(data) != length):
+        raise ProtocolError(f'Unexpected reply to the request of piece [{i}] at {begin}')
+    return data
 
 
-def requester_interests(client_peer, peer_client_socket, peer_pieces_tracking, server_peer_pieces_tracking, client_peer_lock, peer_pieces_tracking_lock, server_peer):
-        for i in range(get_piece_number(client_peer.torrent)):
-            if server_peer_pieces_tracking[i] == 'AVAILABLE' and peer_pieces_tracking[i] == 'UNAVAILABLE':
-                update_peer_pieces_tracking_downloading(peer_pieces_tracking, peer_pieces_tracking_lock, i)
-                requester_interest(peer_client_socket, client_peer, client_peer_lock, peer_pieces_tracking, peer_pieces_tracking_lock, i, server_peer)
+def requester_hashes(connection, i):
+    """
+    Send the 'HASHES' request, the server peer replies with the
+    SHA256 of the blocks of the piece (v2 torrents)
+    :return: list of block hashes
+    """
+    connection.send(HASHES, PIECE_INDEX.pack(i))
+    payload = connection.expect(HASHES)
+    if PIECE_INDEX.unpack_from(payload)[0] != i:
+        raise ProtocolError(f'Unexpected block hashes, requested piece [{i}]')
+    hashes = payload[PIECE_INDEX.size:]
+    return [bytes(hashes[k:k + 32]) for k in range(0, len(hashes), 32)]
 
 
-def requester_having_interests(client_peer, peer_client_socket, peer_pieces_tracking, client_peer_lock, peer_pieces_tracking_lock, server_peer):
+def requester_blocks(connection, client_peer, i, partial, server_peer):
+    """
+    Request the missing blocks of a piece, all at once
+    :param partial: PartialPiece of the piece, its data is completed
+    :return: bytes of the piece
+    :exception ValueError: a block is rejected
+    """
+    data_length = client_peer.merkle.data_length(i)
+    requests = {block_index * BLOCK_SIZE: min(BLOCK_SIZE, data_length - block_index * BLOCK_SIZE)
+                for block_index in sorted(partial.missing)}
+    for begin, length in requests.items():
+        requester_send_request(connection, client_peer, server_peer, i, begin, length)
+    rejected = False
+    for _ in range(len(requests)):
+        reply_index, begin, block_data = requester_receive_reply(connection, client_peer, server_peer)
+        if reply_index != i or begin not in requests:
+            raise ProtocolError(f'Unexpected reply to the blocks of piece [{i}]')
+        if block_data is None:
+            rejected = True
+            continue
+        requester_check_reply((reply_index, begin, block_data), i, begin, requests[begin])
+        partial.data[begin:begin + len(block_data)] = block_data
+    if rejected:
+        raise ValueError(f'Blocks of piece [{i}] rejected')
+    return bytes(partial.data)
+
+
+def requester_bad_blocks(connection, client_peer, i, piece_data, hashes, partial, server_peer):
+    """
+    Find the blocks of a piece failing the Merkle check, the piece
+    is kept with only these blocks to request again, and the blocks
+    are accounted to the server peer that sent them
+    :param hashes: SHA256 of the blocks received
+    :param partial: PartialPiece of the previous attempt, None for a whole piece
+    :return: None
+    """
+    if partial is not None:
+        expected_hashes = partial.hashes
+    else:
+        expected_hashes = requester_hashes(connection, i)
+        if not expected_hashes:
+            # the server peer doesn't have the piece anymore, the blocks can't be told apart
+            return
+        if not client_peer.merkle.check_hashes(expected_hashes, i):
+            # the server peer lies about its hashes, nothing can be kept
+            BLOCK_FAILURES.inc((server_peer['peer_id'],), len(hashes))
+            return
+    bad_blocks = {block_index for block_index, block_hash in enumerate(hashes) if block_hash != expected_hashes[block_index]}
+    BLOCK_FAILURES.inc((server_peer['peer_id'],), len(bad_blocks))
+    if INFO:
+        logger.info(f'Blocks {sorted(bad_blocks)} of piece [{i}] from [{server_peer["peer_id"]}] are wrong')
+    client_peer.partial_pieces[i] = PartialPiece(bytearray(piece_data), bad_blocks, expected_hashes)
+
+
+def requester_claim(peer_pieces_tracking, peer_pieces_tracking_lock, priorities, i):
+    """
+    :return: True if the piece was wanted and nobody downloads it, it is now DOWNLOADING
+    """
+    with peer_pieces_tracking_lock:
+        if peer_pieces_tracking[i] != 'UNAVAILABLE' or not priorities.is_wanted(i):
+            return False
+        peer_pieces_tracking[i] = 'DOWNLOADING'
+        return True
+
+
+def requester_interests(client_peer, connection, peer_pieces_tracking, server_peer_pieces, client_peer_lock, peer_pieces_tracking_lock, server_peer):
+    """
+    Request the wanted pieces of the server peer. Up to pipeline_depth
+    REQUEST messages are kept in flight so that the connection stays
+    busy across the round trips. When the peer is paused, stopped or
+    disconnected, the requests in flight are cancelled, the server
+    peer answers each of them with the piece or a REJECT. The pieces
+    kept partially (v2) are requested block by block once the
+    pipeline is drained, so are the block hashes of wrong pieces.
+    :param server_peer_pieces: set of the available pieces of the server peer
+    """
+    # wanted pieces of the server peer, the ones due by a stream reader first
+    priorities = client_peer.priorities
+    scores = client_peer.scores
+    peer_id = server_peer['peer_id']
+    piece_length = priorities.piece_length
+    version = priorities.version
+    candidates = priorities.order(server_peer_pieces)
+    k = 0
+    # piece index -> requested time of the requests sent
+    in_flight = collections.OrderedDict()
+    cancelled = set()
+    # (piece index, piece data, block hashes) of the wrong pieces of a v2 torrent
+    bad_pieces = []
+    received_time = None
+    try:
+        while True:
+            leaving = client_peer.paused or client_peer.stopped or scores.should_disconnect(peer_id)
+            if leaving:
+                for i in in_flight:
+                    if i not in cancelled:
+                        requester_send_cancel(connection, client_peer, server_peer, i, 0, requester_piece_length(client_peer, i))
+                        cancelled.add(i)
+
+            depth = scores.pipeline_depth(peer_id, piece_length)
+            while not leaving and len(in_flight) < depth and k < len(candidates):
+                if priorities.version != version:
+                    # a read cursor moved or the selections changed
+                    version = priorities.version
+                    candidates = priorities.order(candidates[k:])
+                    k = 0
+                    continue
+                i = candidates[k]
+                if i in client_peer.partial_pieces:
+                    if peer_pieces_tracking[i] == 'UNAVAILABLE' and priorities.is_wanted(i):
+                        # requested block by block once the pipeline is drained
+                        break
+                    # completed by another source or no longer wanted, the kept blocks are useless
+                    client_peer.partial_pieces.pop(i, None)
+                k += 1
+                if requester_claim(peer_pieces_tracking, peer_pieces_tracking_lock, priorities, i):
+                    requester_send_request(connection, client_peer, server_peer, i, 0, requester_piece_length(client_peer, i))
+                    PIECES_IN_FLIGHT.inc()
+                    in_flight[i] = time.perf_counter()
+
+            if not in_flight:
+                if not leaving and k < len(candidates) and candidates[k] in client_peer.partial_pieces:
+                    i = candidates[k]
+                    k += 1
+                    if requester_claim(peer_pieces_tracking, peer_pieces_tracking_lock, priorities, i):
+                        requester_interest(connection, client_peer, client_peer_lock, peer_pieces_tracking, peer_pieces_tracking_lock, i, server_peer)
+                    continue
+                break
+
+            i, begin, piece_data = requester_receive_reply(connection, client_peer, server_peer)
+            if i not in in_flight:
+                raise ProtocolError(f'Unexpected reply, piece [{i}] was not requested')
+            requested_time = in_flight.pop(i)
+            PIECES_IN_FLIGHT.dec()
+            piece_data = requester_check_reply((i, begin, piece_data), i, 0, requester_piece_length(client_peer, i))
+            if piece_data is None:
+                # rejected, the piece goes back to the other requesters
+                update_peer_pieces_tracking_unavailable(peer_pieces_tracking, peer_pieces_tracking_lock, i)
+                continue
+            # the connection worked on the piece since the previous reply,
+            # or since the request when the pipeline ran dry in between
+            busy_since = requested_time if received_time is None else max(received_time, requested_time)
+            received_time = time.perf_counter()
+            is_valid, hashes = requester_verify(connection, client_peer, peer_pieces_tracking, peer_pieces_tracking_lock,
+                                                i, piece_data, requested_time, received_time - busy_since, server_peer)
+            if not is_valid:
+                if hashes is not None:
+                    # copied, the data is a view of the receive buffer
+                    bad_pieces.append((i, bytes(piece_data), hashes))
+                else:
+                    update_peer_pieces_tracking_unavailable(peer_pieces_tracking, peer_pieces_tracking_lock, i)
+
+        # the pipeline is drained, the replies to HASHES come next
+        while bad_pieces:
+            i, piece_data, hashes = bad_pieces[-1]
+            requester_bad_blocks(connection, client_peer, i, piece_data, hashes, None, server_peer)
+            bad_pieces.pop()
+            update_peer_pieces_tracking_unavailable(peer_pieces_tracking, peer_pieces_tracking_lock, i)
+    finally:
+        # the connection failed, the requested pieces go back to the other requesters
+        for i in in_flight:
+            PIECES_IN_FLIGHT.dec()
+            update_peer_pieces_tracking_unavailable(peer_pieces_tracking, peer_pieces_tracking_lock, i)
+        for i, _, _ in bad_pieces:
+            update_peer_pieces_tracking_unavailable(peer_pieces_tracking, peer_pieces_tracking_lock, i)
+
+
+def requester_having_interests(client_peer, connection, peer_pieces_tracking, client_peer_lock, peer_pieces_tracking_lock, server_peer,
+                               server_peers, server_peers_lock, connected_server_peers, connected_server_peers_lock):
+    last_pex_time = None
     while not is_download_completed(client_peer):
 
-        time.sleep(SimpleClient.HAVING_REQUEST_TIME)
+        if last_pex_time is None or time.monotonic() - last_pex_time >= SimpleClient.PEX_INTERVAL:
+            requester_pex(connection, client_peer, server_peers, server_peers_lock,
+                          connected_server_peers, connected_server_peers_lock)
+            last_pex_time = time.monotonic()
+
+        if client_peer.wait_for_state(lambda peer: peer.left == 0 or peer.stopped, SimpleClient.HAVING_REQUEST_TIME):
+            break
+
+        if client_peer.paused:
+            client_peer.wait_for_state(lambda peer: not peer.paused or peer.stopped)
+            continue
+
+        # a banned or replaced peer is left after the round
+        if client_peer.scores.should_disconnect(server_peer['peer_id']):
+            trace_event(client_peer, TRACE_CHOKE, server_peer['peer_id'])
+            break
+
+        # the HAVE round trip measures the latency to the server peer
+        requested_time = time.perf_counter()
+        server_peer_pieces = requester_having(connection, peer_pieces_tracking)
+        client_peer.scores.record_rtt(server_peer['peer_id'], time.perf_counter() - requested_time)
+        trace_event(client_peer, TRACE_BITFIELD, server_peer['peer_id'], length=len(server_peer_pieces))
+
+        requester_interests(client_peer, connection, peer_pieces_tracking, server_peer_pieces, client_peer_lock, peer_pieces_tracking_lock, server_peer)
 
-        server_peer_pieces_tracking = requester_having(peer_client_socket)
 
-        requester_interests(client_peer, peer_client_socket, peer_pieces_tracking, server_peer_pieces_tracking, client_peer_lock, peer_pieces_tracking_lock, server_peer)
+def requester_pex(connection, client_peer, server_peers, server_peers_lock, connected_server_peers, connected_server_peers_lock):
+    """
+    Send the 'PEX' request, the server peer replies with the peers
+    added/dropped since the previous PEX on this connection. The
+    new peers wake up the talker right away, without waiting
+    for the next re-announce. The dropped peers are forgotten,
+    unless this client peer is connected to them, and not passed on
+    :param connection: Connection to the server peer
+    :param client_peer: object represents the client peer
+    :param server_peers: list of dictionary represents the server peers
+    :param server_peers_lock: lock for changing the server_peers
+    :param connected_server_peers: set of connected server peers
+    :param connected_server_peers_lock: the lock for changing the connected_server_peers
+    :return: None
+    """
+    connection.send(PEX)
+    pex_message = connection.receive_json(PEX)
+    for peer in pex_message['added']:
+        client_peer.learn_peer(peer)
+    with connected_server_peers_lock:
+        dropped = set(pex_message['dropped']) - connected_server_peers
+    if dropped:
+        for peer_id in dropped:
+            client_peer.pex.forget(peer_id)
+        with server_peers_lock:
+            server_peers[:] = [peer for peer in server_peers if peer['peer_id'] not in dropped]
 
 
-def requester_done(peer_client_socket):
-    done_message = 'DONE\n'
-    peer_client_socket.send(done_message.encode('utf-8'))
-    done_message_received = peer_client_socket.recv(1024).decode('utf-8')
-    if done_message_received == 'DONE_OK':
-        peer_client_socket.close()
\ No newline at end of file
+def requester_done(connection):
+    connection.send(DONE)
+    connection.expect(DONE)
+    connection.sock.close()
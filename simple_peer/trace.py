@@ -0,0 +1,399 @@
+import collections
+import itertools
+import struct
+import threading
+import time
+
+
+# events of the transfer trace, the piece, begin and length
+# fields are 0 when they do not apply
+TRACE_DROPPED = 0       # length: records overwritten before being written to disk
+TRACE_CONNECT = 1
+TRACE_DISCONNECT = 2
+TRACE_BITFIELD = 3      # length: pieces available on the server peer
+TRACE_REQUEST = 4
+TRACE_BLOCK = 5
+TRACE_REJECT = 6
+TRACE_CANCEL = 7
+TRACE_HASH_OK = 8
+TRACE_HASH_FAIL = 9
+TRACE_WRITE_DONE = 10
+TRACE_CHOKE = 11        # the client peer stops using the server peer (banned or replaced)
+
+TRACE_NAMES = {
+    TRACE_DROPPED: 'DROPPED',
+    TRACE_CONNECT: 'CONNECT',
+    TRACE_DISCONNECT: 'DISCONNECT',
+    TRACE_BITFIELD: 'BITFIELD',
+    TRACE_REQUEST: 'REQUEST',
+    TRACE_BLOCK: 'BLOCK',
+    TRACE_REJECT: 'REJECT',
+    TRACE_CANCEL: 'CANCEL',
+    TRACE_HASH_OK: 'HASH_OK',
+    TRACE_HASH_FAIL: 'HASH_FAIL',
+    TRACE_WRITE_DONE: 'WRITE_DONE',
+    TRACE_CHOKE: 'CHOKE'
+}
+
+TRACE_MAGIC = b'SPTRACE1'
+# <magic><info_hash><wall clock at start><monotonic ns at start><record size>
+TRACE_HEADER = struct.Struct('<8s20sdQI')
+# <sequence><monotonic ns><event><peer_id><piece index><begin><length>
+TRACE_RECORD = struct.Struct('<QQB3x20sIII4x')
+SEQUENCE = struct.Struct('<Q')
+
+
+class EventTrace:
+    """
+    Binary trace of the transfer events of a torrent. Recording
+    packs a fixed-size record into a slot of a ring buffer claimed
+    from an atomic counter, without taking a lock, and a writer
+    thread appends the records to the file. A record carries its
+    sequence number, so the writer knows which slots are complete and
+    which ones were overwritten before being written (counted in a
+    DROPPED record).
+    """
+    # records held by the ring buffer
+    CAPACITY = 64 * 1024
+    # seconds between two writes to the file
+    FLUSH_INTERVAL = 0.2
+
+    def __init__(self, path, info_hash, capacity=CAPACITY):
+        """
+        :param path: path to the trace file, overwritten
+        :param info_hash: info_hash (bytes) of the torrent
+        :param capacity: records held by the ring buffer
+        """
+        self.capacity = capacity
+        self.ring = bytearray(capacity * TRACE_RECORD.size)
+        # next(count) is atomic, the slot of a record is its sequence modulo the capacity
+        self.sequence = itertools.count(1)
+        self.written = 1
+        self.dropped = 0
+        self.file = open(path, 'wb')
+        self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, info_hash, time.time(), time.monotonic_ns(), TRACE_RECORD.size))
+        self.closed = threading.Event()
+        self.writer_thread = None
+
+
+    def start(self):
+        self.writer_thread = threading.Thread(target=self.writer, daemon=True, name='trace-writer')
+        self.writer_thread.start()
+
+
+    def record(self, event, peer_id, piece=0, begin=0, length=0):
+        """
+        :param event: TRACE_* event
+        :param peer_id: peer_id (str) of the server peer
+        :return: None
+        """
+        sequence = next(self.sequence)
+        TRACE_RECORD.pack_into(self.ring, (sequence % self.capacity) * TRACE_RECORD.size, sequence,
+                               time.monotonic_ns(), event, peer_id.encode('utf-8'), piece, begin, length)
+
+
+    def writer(self):
+        while not self.closed.wait(EventTrace.FLUSH_INTERVAL):
+            self.drain()
+
+
+    def drain(self):
+        """
+        Write the complete records following the last one written
+        :return: None
+        """
+        chunks = []
+        while True:
+            offset = (self.written % self.capacity) * TRACE_RECORD.size
+            # copied before being checked, a producer may overwrite the slot meanwhile
+            record = bytes(self.ring[offset:offset + TRACE_RECORD.size])
+            sequence = SEQUENCE.unpack_from(record)[0]
+            if sequence < self.written:
+                # not recorded yet
+                break
+            if sequence > self.written:
+                # the producers lapped the writer, the older records are gone
+                oldest = sequence - self.capacity + 1
+                self.dropped += oldest - self.written
+                self.written = oldest
+                continue
+            chunks.append(record)
+            self.written += 1
+        if chunks:
+            self.file.write(b''.join(chunks))
+            self.file.flush()
+
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        if self.writer_thread is not None:
+            self.writer_thread.join()
+        self.drain()
+        if self.dropped:
+            self.file.write(TRACE_RECORD.pack(self.written, time.monotonic_ns(), TRACE_DROPPED, b'', 0, 0, self.dropped))
+        self.file.close()
+
+
+def trace_event(client_peer, event, peer_id, piece=0, begin=0, length=0):
+    # nothing is recorded unless the client peer is traced
+    if client_peer.trace is not None:
+        client_peer.trace.record(event, peer_id, piece, begin, length)
+
+
+def read_trace(path):
+    """
+    :param path: path to a trace file
+    :return: (header dictionary, list of (seconds since the start, event, peer_id, piece, begin, length))
+    :exception ValueError: not a trace file
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < TRACE_HEADER.size:
+        raise ValueError(f'{path} is not a trace file')
+    magic, info_hash, wall_time, start_ns, record_size = TRACE_HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC or record_size != TRACE_RECORD.size:
+        raise ValueError(f'{path} is not a trace file')
+    records = []
+    # a record cut by a crash is left out
+    end = len(data) - (len(data) - TRACE_HEADER.size) % record_size
+    for offset in range(TRACE_HEADER.size, end, record_size):
+        sequence, timestamp, event, peer_id, piece, begin, length = TRACE_RECORD.unpack_from(data, offset)
+        records.append((sequence, (timestamp - start_ns) / 1e9, event,
+                        peer_id.rstrip(b'\0').decode('utf-8', 'replace'), piece, begin, length))
+    # the records of one drain are in order, a DROPPED record comes last
+    records.sort()
+    header = {'info_hash': info_hash.hex(), 'start_time': wall_time}
+    return header, [record[1:] for record in records]
+
+
+def percentile(values, fraction):
+    """
+    :param values: sorted list
+    :return: the value at the fraction of the list, None for an empty list
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def peer_timeline(records, peer_id):
+    """
+    :param records: records from read_trace
+    :return: list of (seconds since the start, event name, piece, begin, length) of the server peer
+    """
+    return [(t, TRACE_NAMES[event], piece, begin, length)
+            for t, event, record_peer_id, piece, begin, length in records
+            if record_peer_id == peer_id and event != TRACE_DROPPED]
+
+
+class PeerTrace:
+    """
+    Counters and request pipeline of one server peer, the occupancy
+    (requests in flight) is integrated over the connected time
+    """
+    def __init__(self, peer_id):
+        self.peer_id = peer_id
+        self.connected_time = None
+        self.connected_seconds = 0.0
+        self.first_time = None
+        self.last_time = None
+        self.counts = collections.Counter()
+        self.bytes = 0
+        self.pieces_available = None
+        # (piece index, begin) -> time of the request
+        self.in_flight = {}
+        self.max_in_flight = 0
+        self.occupancy = 0.0
+        self.idle_seconds = 0.0
+        self.latencies = []
+
+
+    def advance(self, t):
+        if self.connected_time is not None:
+            elapsed = t - self.last_time
+            self.occupancy += len(self.in_flight) * elapsed
+            if not self.in_flight:
+                self.idle_seconds += elapsed
+        if self.first_time is None:
+            self.first_time = t
+        self.last_time = t
+
+
+    def add(self, t, event, piece, begin, length):
+        self.advance(t)
+        self.counts[event] += 1
+        if event == TRACE_CONNECT:
+            self.connected_time = t
+        elif event == TRACE_DISCONNECT:
+            if self.connected_time is not None:
+                self.connected_seconds += t - self.connected_time
+            self.connected_time = None
+            self.in_flight.clear()
+        elif event == TRACE_BITFIELD:
+            self.pieces_available = length
+        elif event == TRACE_REQUEST:
+            self.in_flight[(piece, begin)] = t
+            self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+        elif event in (TRACE_BLOCK, TRACE_REJECT):
+            requested_time = self.in_flight.pop((piece, begin), None)
+            if event == TRACE_BLOCK:
+                self.bytes += length
+                if requested_time is not None:
+                    self.latencies.append(t - requested_time)
+
+
+    def finish(self, t):
+        # a peer still connected at the end of the trace
+        self.advance(t)
+        if self.connected_time is not None:
+            self.connected_seconds += t - self.connected_time
+            self.connected_time = None
+
+
+    def to_dict(self):
+        latencies = sorted(self.latencies)
+        connected_seconds = self.connected_seconds or None
+        return {
+            'peer_id': self.peer_id,
+            'first': self.first_time,
+            'last': self.last_time,
+            'connected_seconds': self.connected_seconds,
+            'connects': self.counts[TRACE_CONNECT],
+            'chokes': self.counts[TRACE_CHOKE],
+            'pieces_available': self.pieces_available,
+            'requests': self.counts[TRACE_REQUEST],
+            'blocks': self.counts[TRACE_BLOCK],
+            'rejects': self.counts[TRACE_REJECT],
+            'cancels': self.counts[TRACE_CANCEL],
+            'hash_failures': self.counts[TRACE_HASH_FAIL],
+            'bytes': self.bytes,
+            'rate': self.bytes / connected_seconds if connected_seconds else None,
+            'latency': {
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+                'p50': percentile(latencies, 0.5),
+                'p90': percentile(latencies, 0.9),
+                'max': latencies[-1] if latencies else None
+            },
+            'pipeline': {
+                'mean': self.occupancy / connected_seconds if connected_seconds else None,
+                'max': self.max_in_flight,
+                'idle': self.idle_seconds / connected_seconds if connected_seconds else None
+            }
+        }
+
+
+class PieceTrace:
+    """
+    Stages of the download of one piece: requested (first and last
+    attempt), received, hash verified and written to the disk
+    """
+    def __init__(self, piece):
+        self.piece = piece
+        self.first_requested = None
+        self.last_requested = None
+        self.replied = False
+        self.received = None
+        self.hashed = None
+        self.written = None
+        self.peer_id = None
+        self.hash_failures = 0
+        self.rejects = 0
+
+
+    def add(self, t, event, peer_id):
+        if event == TRACE_REQUEST:
+            if self.first_requested is None:
+                self.first_requested = t
+            # the blocks of one attempt are all requested before the first reply
+            if self.last_requested is None or self.replied:
+                self.last_requested = t
+                self.replied = False
+        elif event == TRACE_BLOCK:
+            self.received = t
+            self.replied = True
+        elif event == TRACE_REJECT:
+            self.rejects += 1
+            self.replied = True
+        elif event == TRACE_HASH_FAIL:
+            self.hash_failures += 1
+        elif event == TRACE_HASH_OK:
+            self.hashed = t
+            self.peer_id = peer_id
+        elif event == TRACE_WRITE_DONE:
+            self.written = t
+
+
+    def to_dict(self):
+        return {
+            'piece': self.piece,
+            'peer_id': self.peer_id,
+            'written': self.written,
+            'total': self.written - self.first_requested,
+            # before the first request, the piece waited for a free pipeline slot or a peer having it
+            'queued': self.first_requested,
+            # failed attempts, rejected or wrong
+            'retries': self.last_requested - self.first_requested,
+            'transfer': self.received - self.last_requested,
+            'verify': self.hashed - self.received,
+            'write': self.written - self.hashed,
+            'hash_failures': self.hash_failures,
+            'rejects': self.rejects
+        }
+
+
+def analyze_trace(header, records, top=10):
+    """
+    Rebuild the per-peer timelines of a trace, the occupancy of the
+    request pipelines and the pieces on the critical path, the last
+    ones written and the slowest ones
+    :param header: header dictionary from read_trace
+    :param records: records from read_trace
+    :param top: pieces listed on the critical path
+    :return: dictionary of the analysis
+    """
+    peers = {}
+    pieces = {}
+    dropped = 0
+    end = records[-1][0] if records else 0.0
+    for t, event, peer_id, piece, begin, length in records:
+        if event == TRACE_DROPPED:
+            dropped += length
+            continue
+        if peer_id not in peers:
+            peers[peer_id] = PeerTrace(peer_id)
+        peers[peer_id].add(t, event, piece, begin, length)
+        if event in (TRACE_REQUEST, TRACE_BLOCK, TRACE_REJECT, TRACE_HASH_OK, TRACE_HASH_FAIL, TRACE_WRITE_DONE):
+            if piece not in pieces:
+                pieces[piece] = PieceTrace(piece)
+            pieces[piece].add(t, event, peer_id)
+    for peer in peers.values():
+        peer.finish(end)
+
+    # pieces missing stages lost their records or were written by a web seed
+    completed = [piece.to_dict() for piece in pieces.values()
+                 if None not in (piece.first_requested, piece.received, piece.hashed, piece.written)]
+    completed.sort(key=lambda piece: piece['written'])
+    stages = ('queued', 'retries', 'transfer', 'verify', 'write')
+    return {
+        'info_hash': header['info_hash'],
+        'start_time': header['start_time'],
+        'duration': end,
+        'events': len(records),
+        'dropped': dropped,
+        'peers': sorted((peer.to_dict() for peer in peers.values()), key=lambda peer: -peer['bytes']),
+        'pieces': {
+            'completed': len(completed),
+            'incomplete': len(pieces) - len(completed),
+            'p50_written': percentile([piece['written'] for piece in completed], 0.5),
+            'p90_written': percentile([piece['written'] for piece in completed], 0.9),
+            'last_written': completed[-1]['written'] if completed else None,
+            # mean seconds of each stage
+            'stages': {stage: sum(piece[stage] for piece in completed) / len(completed) if completed else None
+                       for stage in stages}
+        },
+        # the download ends with the last piece written
+        'critical_path': completed[-top:][::-1],
+        'slowest_pieces': sorted(completed, key=lambda piece: -piece['total'])[:top]
+    }
@@ -7,31 +7,144 @@ import sys
 import threading
 import time
 import bencodepy
-import requests
-from tqdm import tqdm
-
-
-def create_pieces_hash(file_path, piece_length):
+from simple_peer.announcer import TrackerAnnouncer, TrackerBusy
+from simple_peer.bencode import decode_file
+from simple_peer.pex import PeerExchange
+from simple_peer.peer_score import PeerScoreBoard
+from simple_peer.metrics import HASH_QUEUE_DEPTH, HASH_LATENCY, DISK_WRITE_LATENCY, DISK_READ_LATENCY
+from simple_peer.rate_limiter import TokenBucket, consume, global_bandwidth
+from simple_peer.merkle import BLOCK_SIZE, MerkleVerifier, file_merkle
+from simple_peer.priority import PiecePriorities
+from simple_peer.storage import FileLayout
+
+
+def create_pieces_hash(file_paths, piece_length, padded=False):
+    """
+    Hash the pieces of the files concatenated in order,
+    a piece may span the end of a file and the next ones
+    :param file_paths: list of paths to the files
+    :param piece_length: length of piece (byte)
+    :param padded: every file but the last is followed by zeros up to the next piece (padding files)
+    :return: bytes of the concatenated SHA1 of the pieces
+    """
     hashes = []
-    with open(file_path, 'rb') as f:
-        piece = f.read(piece_length)
-        while piece:
-            hashes.append(hashlib.sha1(piece).digest())
-            piece = f.read(piece_length)
+    piece = bytearray()
+    for k, file_path in enumerate(file_paths):
+        with open(file_path, 'rb') as f:
+            data = f.read(piece_length - len(piece))
+            while data:
+                piece += data
+                if len(piece) == piece_length:
+                    hashes.append(hashlib.sha1(piece).digest())
+                    piece = bytearray()
+                data = f.read(piece_length - len(piece))
+        if padded and piece and k < len(file_paths) - 1:
+            hashes.append(hashlib.sha1(piece + bytes(piece_length - len(piece))).digest())
+            piece = bytearray()
+    if piece:
+        hashes.append(hashlib.sha1(piece).digest())
     return b''.join(hashes)
 
 
-def create_torrent(file_path, ip, port, piece_length, destination_directory):
-    file_size = os.path.getsize(file_path)
-    file_name = os.path.basename(file_path)
-    piece_hashes = create_pieces_hash(file_path, piece_length)
+def get_directory_files(directory):
+    """
+    Files of a directory in the order of a multi-file torrent
+    :param directory: path to the directory
+    :return: list of (list of path components relative to the directory, path)
+    """
+    files = []
+    for root, directories, file_names in os.walk(directory):
+        directories.sort()
+        for file_name in sorted(file_names):
+            path = os.path.join(root, file_name)
+            files.append((os.path.relpath(path, directory).split(os.sep), path))
+    return files
+
+
+def create_v2_info(file_path, piece_length):
+    """
+    Hybrid v1/v2 info dictionary (BEP 52): the v1 files are aligned on
+    the pieces by padding files (BEP 47), and every file gets a SHA256
+    Merkle tree over its 16KB blocks for block-level verification
+    :param file_path: path to the file or directory
+    :param piece_length: length of piece (byte), a power of two of at least 16KB
+    :return: (info dictionary, piece layers dictionary)
+    :exception ValueError: the piece length is not valid for v2
+    """
+    if piece_length < BLOCK_SIZE or piece_length & (piece_length - 1):
+        raise ValueError('Piece length must be a power of two of at least 16KB for v2 torrents')
+    file_name = os.path.basename(os.path.normpath(file_path))
+    if os.path.isdir(file_path):
+        files = get_directory_files(file_path)
+    else:
+        files = [([file_name], file_path)]
+
+    file_tree = {}
+    piece_layers = {}
+    v1_files = []
+    for k, (components, path) in enumerate(files):
+        length = os.path.getsize(path)
+        node = {'length': length}
+        if length:
+            node['pieces root'], piece_layer = file_merkle(path, piece_length)
+            if piece_layer:
+                piece_layers[node['pieces root']] = piece_layer
+        directory = file_tree
+        for component in components:
+            directory = directory.setdefault(component, {})
+        directory[''] = node
+
+        v1_files.append({'length': length, 'path': components})
+        padding = -length % piece_length
+        if padding and k < len(files) - 1:
+            v1_files.append({'attr': 'p', 'length': padding, 'path': ['.pad', str(padding)]})
 
     info = {
         'name': file_name,
-        'length': file_size,
         'piece length': piece_length,
-        'pieces': piece_hashes
+        'pieces': create_pieces_hash([path for _, path in files], piece_length, padded=True),
+        'meta version': 2,
+        'file tree': file_tree
     }
+    if os.path.isdir(file_path):
+        info['files'] = v1_files
+    else:
+        info['length'] = v1_files[0]['length']
+    return info, piece_layers
+
+
+def check_piece_length(piece_length):
+    """
+    A whole piece travels in one PIECE frame, longer pieces can't be transferred
+    :exception ValueError: the piece length is above SimpleClient.MAX_PIECE_LENGTH
+    """
+    if piece_length > SimpleClient.MAX_PIECE_LENGTH:
+        raise ValueError(f'Piece length {piece_length} is above the maximum of {SimpleClient.MAX_PIECE_LENGTH} bytes')
+
+
+def create_torrent(file_path, ip, port, piece_length, destination_directory, web_seeds=None, v2=False, trackers=None):
+    check_piece_length(piece_length)
+    file_name = os.path.basename(os.path.normpath(file_path))
+
+    piece_layers = None
+    if v2:
+        info, piece_layers = create_v2_info(file_path, piece_length)
+    elif os.path.isdir(file_path):
+        # multi-file torrent, name is the directory of the files
+        files = get_directory_files(file_path)
+        info = {
+            'name': file_name,
+            'files': [{'length': os.path.getsize(path), 'path': components} for components, path in files],
+            'piece length': piece_length,
+            'pieces': create_pieces_hash([path for _, path in files], piece_length)
+        }
+    else:
+        info = {
+            'name': file_name,
+            'length': os.path.getsize(file_path),
+            'piece length': piece_length,
+            'pieces': create_pieces_hash([file_path], piece_length)
+        }
 
     torrent_dict = {
         'announce': f'http://{ip}:{port}/announce',
@@ -40,6 +153,16 @@ def create_torrent(file_path, ip, port, piece_length, destination_directory):
         'version': SimpleClient.VERSION,
         'info': info
     }
+    if trackers:
+        # the tracker of ip:port is the first tier, then a tier per
+        # entry, the trackers of a tier are separated by commas (BEP 12)
+        torrent_dict['announce-list'] = [[torrent_dict['announce']]] + [
+            [url.strip() for url in tier.split(',') if url.strip()] for tier in trackers]
+    if web_seeds:
+        # HTTP servers hosting the same files (BEP 19)
+        torrent_dict['url-list'] = list(web_seeds)
+    if piece_layers:
+        torrent_dict['piece layers'] = piece_layers
 
     torrent_data = bencodepy.encode(torrent_dict)
 
@@ -50,21 +173,55 @@ def create_torrent(file_path, ip, port, piece_length, destination_directory):
 
 
 def get_torrent_dic_from_torrent_dic_bytes(torrent_dict_bytes):
+    info_bytes = torrent_dict_bytes[b'info']
+    info = {
+        'name': info_bytes[b'name'].decode('utf-8'),
+        'piece length': info_bytes[b'piece length'],
+        'pieces': info_bytes[b'pieces']
+    }
+    if b'files' in info_bytes:
+        info['files'] = []
+        for file in info_bytes[b'files']:
+            torrent_file = {'length': file[b'length'], 'path': [component.decode('utf-8') for component in file[b'path']]}
+            if b'attr' in file:
+                torrent_file['attr'] = file[b'attr'].decode('utf-8')
+            info['files'].append(torrent_file)
+    else:
+        info['length'] = info_bytes[b'length']
+    if b'meta version' in info_bytes:
+        info['meta version'] = info_bytes[b'meta version']
+        info['file tree'] = decode_file_tree(info_bytes[b'file tree'])
     torrent_dic = {
         'announce': torrent_dict_bytes[b'announce'].decode('utf-8'),
         'created by': torrent_dict_bytes[b'created by'].decode('utf-8'),
         'creation date': torrent_dict_bytes[b'creation date'],
         'version': torrent_dict_bytes[b'version'].decode('utf-8'),
-        'info': {
-            'name': torrent_dict_bytes[b'info'][b'name'].decode('utf-8'),
-            'length': torrent_dict_bytes[b'info'][b'length'],
-            'piece length': torrent_dict_bytes[b'info'][b'piece length'],
-            'pieces': torrent_dict_bytes[b'info'][b'pieces']
-        }
+        'info': info
     }
+    if b'announce-list' in torrent_dict_bytes:
+        torrent_dic['announce-list'] = [[url.decode('utf-8') for url in tier] for tier in torrent_dict_bytes[b'announce-list']]
+    if b'url-list' in torrent_dict_bytes:
+        url_list = torrent_dict_bytes[b'url-list']
+        if isinstance(url_list, bytes):
+            url_list = [url_list]
+        torrent_dic['url-list'] = [url.decode('utf-8') for url in url_list]
+    if b'piece layers' in torrent_dict_bytes:
+        torrent_dic['piece layers'] = dict(torrent_dict_bytes[b'piece layers'])
     return torrent_dic
 
 
+def decode_file_tree(file_tree_bytes):
+    file_tree = {}
+    for name, node in file_tree_bytes.items():
+        if name == b'':
+            file_tree[''] = {'length': node[b'length']}
+            if b'pieces root' in node:
+                file_tree['']['pieces root'] = node[b'pieces root']
+        else:
+            file_tree[name.decode('utf-8')] = decode_file_tree(node)
+    return file_tree
+
+
 def generate_peer_id(client_prefix='PC000'):
     """
     Generates a valid peer_id for BitTorrent clients. The peer_id is 20 bytes long.
@@ -85,6 +242,34 @@ def generate_peer_id(client_prefix='PC000'):
     return client_prefix + random_suffix
 
 
+def allocate_files(torrent, file, priorities=None, overwrite=True):
+    """
+    Create the files of the torrent initialized with zero bytes,
+    with the directories of a multi-file torrent. With priorities,
+    the files without wanted pieces are not created and the files
+    only sharing a wanted piece at their boundary are created sparse
+    :param torrent: the torrent
+    :param file: path to the file, or to the directory of a multi-file torrent
+    :param priorities: PiecePriorities of the download, None for every piece
+    :param overwrite: False to keep the files already created
+    :return: None
+    """
+    layout = get_file_layout(torrent, file)
+    states = priorities.file_states() if priorities is not None else ['full'] * len(layout.paths)
+    for path, length, state in zip(layout.paths, layout.lengths, states):
+        if path is None or state == 'skip' or (not overwrite and os.path.exists(path)):
+            continue
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if state == 'full':
+            create_file(path, length)
+        else:
+            # only the bytes of the wanted pieces are ever written
+            with open(path, 'wb') as f:
+                f.truncate(length)
+
+
 def create_file(file, length):
     """
     Create a file with a specific total size, initialized with zero bytes.
@@ -111,12 +296,16 @@ def get_info_hash(file):
     :param file: the torrent file
     :return: info_hash of the torrent
     """
-    with open(file, 'rb') as f:
-        data = f.read()
-        torrent_dic_bytes = bencodepy.decode(data)
-        torrent_dic = get_torrent_dic_from_torrent_dic_bytes(torrent_dic_bytes)
-        info = torrent_dic['info']
-        info_hash = hashlib.sha1(bencodepy.encode(info)).digest()
+    return get_info_hash_from_torrent_dic(get_torrent_dic(file))
+
+
+def get_info_hash_from_torrent_dic(torrent_dic):
+    """
+    :param torrent_dic: torrent dictionary from get_torrent_dic
+    :return: info_hash of the torrent
+    """
+    info = torrent_dic['info']
+    info_hash = hashlib.sha1(bencodepy.encode(info)).digest()
     return info_hash
 
 
@@ -126,11 +315,25 @@ def get_torrent_dic(torrent):
     :param torrent: torrent file of the file
     :return: torrent dictionary
     """
-    with open(torrent, 'rb') as f:
-        data = f.read()
-        torrent_dic_bytes = bencodepy.decode(data)
-        torrent_dic = get_torrent_dic_from_torrent_dic_bytes(torrent_dic_bytes)
-        return torrent_dic
+    return get_torrent_dic_from_torrent_dic_bytes(decode_file(torrent))
+
+
+def get_torrent_meta(torrent):
+    """
+    The torrent dictionary without its piece hashes, for display.
+    The pieces are skipped and the piece layers are not copied, so
+    that only the metadata is read from a large torrent. The other
+    strings (urls, names) are copied whatever their length
+    :param torrent: torrent file of the file
+    :return: torrent dictionary, pieces and piece layers masked with '***'
+    """
+    torrent_dic_bytes = decode_file(torrent, lazy_length=SimpleClient.LAZY_STRING_LENGTH, skip_keys={b'pieces'},
+                                    lazy_keys={b'piece layers'})
+    torrent_dic = get_torrent_dic_from_torrent_dic_bytes(torrent_dic_bytes)
+    torrent_dic['info']['pieces'] = '***'
+    if 'piece layers' in torrent_dic:
+        torrent_dic['piece layers'] = '***'
+    return torrent_dic
 
 
 def get_piece_length(file):
@@ -142,12 +345,47 @@ def get_file_length(torrent):
     """
     Calculate the length of the file in bytes
     :param torrent: the torrent of the file
-    :return: length of the file extracted from the torrent
+    :return: length of the file extracted from the torrent,
+    the total length of the files for a multi-file torrent
     """
     torrent_dic = get_torrent_dic(torrent)
+    if 'files' in torrent_dic['info']:
+        return sum(file['length'] for file in torrent_dic['info']['files'])
     return torrent_dic['info']['length']
 
 
+def get_file_layout(torrent, file):
+    """
+    :param torrent: the torrent
+    :param file: path to the file, or to the directory of a multi-file torrent
+    :return: FileLayout mapping the pieces onto the files
+    :exception ValueError: a path of the torrent leaves the directory
+    """
+    return get_file_layout_from_torrent_dic(get_torrent_dic(torrent), file)
+
+
+def get_file_layout_from_torrent_dic(torrent_dic, file):
+    """
+    :param torrent_dic: torrent dictionary from get_torrent_dic
+    :param file: path to the file, or to the directory of a multi-file torrent
+    :return: FileLayout mapping the pieces onto the files
+    :exception ValueError: a path of the torrent leaves the directory
+    """
+    if 'files' not in torrent_dic['info']:
+        return FileLayout([(file, torrent_dic['info']['length'])], [torrent_dic['info']['name']])
+    files = []
+    names = []
+    for torrent_file in torrent_dic['info']['files']:
+        components = torrent_file['path']
+        if not components or any(component in ('', '.', '..') or os.sep in component for component in components):
+            raise ValueError(f'Invalid path {components} in torrent')
+        # padding files (BEP 47) are zeros never stored on disk
+        path = None if 'p' in torrent_file.get('attr', '') else os.path.join(file, *components)
+        files.append((path, torrent_file['length']))
+        names.append('/'.join(components))
+    return FileLayout(files, names, torrent_dic['info']['name'])
+
+
 def get_piece_number(file):
     length = get_file_length(file)
     piece_length = get_piece_length(file)
@@ -159,6 +397,26 @@ def get_announce(file):
     return torrent_dic['announce']
 
 
+def get_announce_tiers(torrent):
+    """
+    :return: tiers of announce urls, the announce-list (BEP 12) or the announce url alone
+    """
+    torrent_dic = get_torrent_dic(torrent)
+    return torrent_dic.get('announce-list') or [[torrent_dic['announce']]]
+
+
+def get_web_seeds(torrent):
+    torrent_dic = get_torrent_dic(torrent)
+    return torrent_dic.get('url-list', [])
+
+
+def get_merkle_verifier(torrent, layout):
+    torrent_dic = get_torrent_dic(torrent)
+    if torrent_dic['info'].get('meta version') != 2:
+        return None
+    return MerkleVerifier(torrent_dic, layout, torrent_dic['info']['piece length'])
+
+
 def get_piece_hash(piece_index, torrent):
     torrent_dic = get_torrent_dic(torrent)
     # byte object
@@ -168,6 +426,13 @@ def get_piece_hash(piece_index, torrent):
     return pieces_hash[start:start + 20]
 
 
+def get_pieces_hash(torrent):
+    """
+    :return: bytes of the concatenated SHA1 of the pieces, decoded once for all the pieces
+    """
+    return get_torrent_dic(torrent)['info']['pieces']
+
+
 def create_piece_hash(piece_data):
     """
     Calculates the piece hash of a piece_data.
@@ -177,51 +442,100 @@ def create_piece_hash(piece_data):
     return hashlib.sha1(piece_data).digest()
 
 
-def get_interest_piece_index(interest_request):
-    return int(interest_request.split()[1])
-
-
-def verify_piece(piece_data, piece_index, torrent):
+def verify_piece(piece_data, piece_index, torrent, pieces_hash=None):
+    """
+    :param pieces_hash: piece hashes from get_pieces_hash, None to decode them from the torrent
+    """
     calculated_piece_hash = create_piece_hash(piece_data)
-    torrent_piece_hash = get_piece_hash(piece_index, torrent)
+    if pieces_hash is None:
+        torrent_piece_hash = get_piece_hash(piece_index, torrent)
+    else:
+        torrent_piece_hash = pieces_hash[20 * piece_index:20 * piece_index + 20]
     return calculated_piece_hash == torrent_piece_hash
 
 
-def write_piece(piece_data, piece_index, torrent, file):
-    piece_length = get_piece_length(torrent)
+def write_piece(piece_data, piece_index, torrent, file, storage=None, layout=None, piece_length=None):
+    """
+    :param layout: FileLayout of the torrent, None to decode it from the torrent
+    :param piece_length: piece length of the torrent, None to decode it from the torrent
+    """
+    if piece_length is None:
+        piece_length = get_piece_length(torrent)
     offset = piece_index * piece_length
-    with open(file, 'r+b') as f:
-        f.seek(offset)
-        f.write(piece_data)
-        
-        
-def recv_exact_bytes(socket, expected_bytes):
+    if layout is None:
+        layout = get_file_layout(torrent, file)
+    if storage is not None:
+        storage.write_spans(layout, offset, piece_data)
+        return
+    view = memoryview(piece_data)
+    position = 0
+    for path, file_offset, span_length in layout.spans(offset, len(piece_data)):
+        if path is None:
+            position += span_length
+            continue
+        with open(path, 'r+b') as f:
+            f.seek(file_offset)
+            f.write(view[position:position + span_length])
+        position += span_length
+
+
+def read_piece(piece_index, torrent, file, storage=None, layout=None, piece_length=None):
     """
-    Receives exactly the specified number of bytes from the socket.
-
-    Args:
-        socket: The socket object to receive data from.
-        expected_bytes: The exact number of bytes to receive.
-
-    Returns:
-        A bytes object containing exactly `expected_bytes` bytes.
-
-    Raises:
-        ValueError: If the connection is closed before receiving the expected amount of data.
+    :param layout: FileLayout of the torrent, None to decode it from the torrent
+    :param piece_length: piece length of the torrent, None to decode it from the torrent
+    :return: the data of the piece, shorter for the last piece
     """
-    data = b''
-    # len of data is still less than expected_bytes
-    # continue to read as much as possible, expected_bytes - len(data)
-    while len(data) < expected_bytes:
-        chunk = socket.recv(expected_bytes - len(data))
-        if not chunk:
-            raise ValueError("Connection closed before receiving expected data")
-        data += chunk
-    return data
+    if piece_length is None:
+        piece_length = get_piece_length(torrent)
+    offset = piece_index * piece_length
+    if layout is None:
+        layout = get_file_layout(torrent, file)
+    return read_range(layout, offset, piece_length, storage)
 
 
-def leecher_init(torrent, file, ip, port):
-    peer = Peer(torrent, file, ip, port)
+def read_range(layout, offset, length, storage=None):
+    """
+    Read a byte range of the torrent from its files
+    :param layout: FileLayout of the torrent
+    :param offset: offset (byte) in the torrent
+    :param length: number of bytes to read
+    :param storage: shared Storage, None to open the files
+    :return: bytes read, shorter than length at the end of the torrent
+    """
+    if storage is not None:
+        return storage.read_spans(layout, offset, length)
+    data = []
+    for path, file_offset, span_length in layout.spans(offset, length):
+        if path is None:
+            data.append(bytes(span_length))
+            continue
+        with open(path, 'rb') as f:
+            f.seek(file_offset)
+            data.append(f.read(span_length))
+    return b''.join(data)
+
+
+def send_exact_bytes(socket, data, buckets=None):
+    """
+    Send all of data, block by block, each block charged
+    to the token buckets throttling the upload
+    :param socket: socket used to send
+    :param data: bytes to send
+    :param buckets: optional token buckets
+    :return: None
+    """
+    if not buckets:
+        socket.sendall(data)
+        return
+    view = memoryview(data)
+    for start in range(0, len(view), SimpleClient.BLOCK_LENGTH):
+        block = view[start:start + SimpleClient.BLOCK_LENGTH]
+        consume(buckets, len(block))
+        socket.sendall(block)
+
+
+def leecher_init(torrent, file, ip, port, storage=None, hash_pool=None):
+    peer = Peer(torrent, file, ip, port, storage, hash_pool)
     peer_pieces_tracking = {i: 'UNAVAILABLE' for i in range(get_piece_number(peer.torrent))}
     peer_lock = threading.Lock()
     peer_pieces_tracking_lock = threading.Lock()
@@ -229,8 +543,8 @@ def leecher_init(torrent, file, ip, port):
     return peer, peer_lock, peer_pieces_tracking, peer_pieces_tracking_lock
 
 
-def seeder_init(torrent, file, ip, port):
-    peer = Peer(torrent, file, ip, port)
+def seeder_init(torrent, file, ip, port, storage=None, hash_pool=None):
+    peer = Peer(torrent, file, ip, port, storage, hash_pool)
     peer_pieces_tracking = {i: 'AVAILABLE' for i in range(get_piece_number(peer.torrent))}
     peer_lock = threading.Lock()
     peer_pieces_tracking_lock = threading.Lock()
@@ -247,13 +561,19 @@ def started_announce(client_peer):
     :return: (interval, peers)
     """
     client_peer.set_started_event()
-    response = requests.get(get_announce(client_peer.torrent), params=client_peer.get_params())
-    if response.status_code == 200:
-        interval = response.json()['interval']
-        peers = response.json()['peers']
-        return interval, peers
-    else:
-        raise Exception("Failed to started announce to tracker.")
+    for attempt in range(SimpleClient.STARTED_ANNOUNCE_ATTEMPTS):
+        try:
+            interval, peers = client_peer.announcer.announce(client_peer.get_params())
+            break
+        except TrackerBusy as e:
+            # the trackers are overloaded, wait for the Retry-After they asked
+            if attempt + 1 == SimpleClient.STARTED_ANNOUNCE_ATTEMPTS:
+                raise Exception(f"Failed to started announce to tracker: {e}")
+            time.sleep(client_peer.announcer.retry_delay())
+        except Exception as e:
+            raise Exception(f"Failed to started announce to tracker: {e}")
+    client_peer.pex.merge(peers)
+    return interval, peers
 
 
 def stop_announce(client_peer):
@@ -264,9 +584,10 @@ def stop_announce(client_peer):
     :exception Exception: Failed to stopped announce to tracker.
     """
     client_peer.set_stopped_event()
-    response = requests.get(get_announce(client_peer.torrent), params=client_peer.get_params())
-    if response.status_code != 200:
-        raise Exception("Failed to stopped announce to tracker.")
+    try:
+        client_peer.announcer.announce(client_peer.get_params())
+    except Exception as e:
+        raise Exception(f"Failed to stopped announce to tracker: {e}")
 
 
 def is_download_completed(peer):
@@ -299,42 +620,87 @@ def is_download_completed(peer):
 
 
 def init_progress_bar(client_peer):
-    total_size = get_file_length(client_peer.torrent)
-    piece_length = get_piece_length(client_peer.torrent)
+    """
+    Display the download progress of the client peer. The bar is
+    driven by the byte counter of the peer and only wakes up when
+    the peer signals a state change, instead of polling.
+    :param client_peer: object represents the client peer
+    :return: None
+    """
+    # imported here, the commands without a progress bar start faster
+    from tqdm import tqdm
+    total_size = client_peer.priorities.wanted_length()
     with tqdm(total=total_size, unit='B', unit_scale=True, desc='Downloading') as progress_bar:
         downloaded_bytes = 0  # Track downloaded bytes
-        while client_peer.left > 0:
-            # Calculate how many bytes have been downloaded since the last update
-            new_downloaded_bytes = min(client_peer.downloaded * piece_length, total_size)
-            bytes_downloaded_since_last_update = new_downloaded_bytes - downloaded_bytes
+        while True:
+            # Block until a piece is written (or the download completes)
+            new_downloaded_bytes, left = client_peer.wait_for_progress(downloaded_bytes)
+            new_downloaded_bytes = min(new_downloaded_bytes, total_size)
 
             # Update the progress bar with the number of bytes downloaded since the last update
-            progress_bar.update(bytes_downloaded_since_last_update)
-
-            # Update downloaded_bytes to the current downloaded bytes
+            progress_bar.update(new_downloaded_bytes - downloaded_bytes)
             downloaded_bytes = new_downloaded_bytes
 
-            # Optional: to avoid too frequent updates, you can add a small sleep here
-            # time.sleep(0.1)
-
-        # After the download is complete, make sure the progress bar reaches 100%
-        if client_peer.left == 0:
-            progress_bar.update(total_size - downloaded_bytes)
+            if left == 0:
+                # After the download is complete, make sure the progress bar reaches 100%
+                progress_bar.update(total_size - downloaded_bytes)
+                return
 
 
 class Peer:
-    def __init__(self, torrent, file, ip, port):
+    def __init__(self, torrent, file, ip, port, storage=None, hash_pool=None):
         self.torrent = torrent
         self.file = file
+        # shared disk I/O layer and hashing pool, None for the
+        # single torrent commands (open the file per piece, hash inline)
+        self.storage = storage
+        self.hash_pool = hash_pool
+        # files of the torrent, file is their directory for a multi-file torrent
+        self.layout = get_file_layout(torrent, file)
+        # pieces to download and their order, every piece by default
+        self.priorities = PiecePriorities(self.layout, get_piece_length(torrent))
+        check_piece_length(self.priorities.piece_length)
+        # block-level verification of v2 torrents, None for v1 ones
+        self.merkle = get_merkle_verifier(torrent, self.layout)
+        # SHA1 of the pieces, the torrent is not decoded again per piece
+        self.pieces_hash = get_pieces_hash(torrent)
+        # piece index -> PartialPiece, the valid blocks of the pieces failing the verification
+        self.partial_pieces = {}
         self.info_hash = get_info_hash(torrent)
         self.peer_id = generate_peer_id()
+        # SuperSeeder when seeding in super-seeding mode
+        self.super_seeder = None
+        # trackers of the announce-list, announced concurrently
+        self.announcer = TrackerAnnouncer(get_announce_tiers(torrent))
+        # peers shared with the connected peers (PEX)
+        self.pex = PeerExchange(self.peer_id)
+        # measured speed and behavior of the server peers, picks the ones to connect to
+        self.scores = PeerScoreBoard()
+        # EventTrace recording the transfer events of the requesters, None when not traced
+        self.trace = None
+        # bumped when new peers are learned, wakes up the talker
+        self.peers_version = 0
         self.peer_ip = ip
         self.peer_port = port
+        # site tag sent to the tracker, which returns the peers of the same site first
+        self.site = None
         self.uploaded = 0
         self.downloaded = 0
+        self.uploaded_bytes = 0
+        self.downloaded_bytes = 0
         self.left = 0
         self.event = EVENT_LIST[0]
+        self.paused = False
+        self.stopped = False
+        # per-torrent limits, the process-wide and per-peer
+        # limits are kept by the bandwidth manager
+        self.bandwidth = global_bandwidth
+        self.upload_bucket = TokenBucket()
+        self.download_bucket = TokenBucket()
         self.lock = threading.Lock()
+        # Notified on every change of the download state, so
+        # waiters (progress bar, commands) don't need to poll
+        self.state_changed = threading.Condition(self.lock)
 
 
     def get_params(self):
@@ -348,6 +714,8 @@ class Peer:
             'left': self.left,
             'event': self.event
         }
+        if self.site:
+            params['site'] = self.site
         return params
 
 
@@ -355,16 +723,22 @@ class Peer:
         with self.lock:
             self.uploaded = 0
             self.downloaded = 0
+            self.uploaded_bytes = 0
+            self.downloaded_bytes = 0
             self.left = 0
             self.event = EVENT_LIST[0]
+            self.state_changed.notify_all()
 
 
     def init_leecher(self):
         with self.lock:
             self.uploaded = 0
             self.downloaded = 0
+            self.uploaded_bytes = 0
+            self.downloaded_bytes = 0
             self.left = get_piece_number(self.torrent)
             self.event = EVENT_LIST[0]
+            self.state_changed.notify_all()
 
 
     def set_started_event(self):
@@ -382,15 +756,187 @@ class Peer:
             self.event = EVENT_LIST[2]
 
 
-    def update_peer_available(self):
+    def update_peer_available(self, piece_bytes=0, piece_index=None):
+        if piece_index is not None:
+            # whatever source completed the piece, the blocks kept from a failed attempt are stale
+            self.partial_pieces.pop(piece_index, None)
         with self.lock:
             self.downloaded = self.downloaded + 1
-            self.left = self.left - 1
+            self.downloaded_bytes = self.downloaded_bytes + piece_bytes
+            # a piece skipped while it was downloading is not counted in left
+            if piece_index is None or self.priorities.is_wanted(piece_index):
+                self.left = self.left - 1
+            self.state_changed.notify_all()
+
+
+    def update_left(self, peer_pieces_tracking, peer_pieces_tracking_lock):
+        """
+        Count the wanted pieces not downloaded yet, after the priorities changed
+        :param peer_pieces_tracking: dictionary of pieces tracking of the peer
+        :param peer_pieces_tracking_lock: the lock for the peer_pieces_tracking
+        :return: None
+        """
+        with peer_pieces_tracking_lock:
+            with self.lock:
+                self.left = sum(1 for i, state in peer_pieces_tracking.items()
+                                if state != 'AVAILABLE' and self.priorities.is_wanted(i))
+                self.state_changed.notify_all()
+
+
+    def set_selections(self, selections, peer_pieces_tracking, peer_pieces_tracking_lock):
+        """
+        Change the pieces to download while the peer runs, the files
+        needed by the new selections are created
+        :param selections: list of selection strings, see parse_selection
+        :param peer_pieces_tracking: dictionary of pieces tracking of the peer
+        :param peer_pieces_tracking_lock: the lock for the peer_pieces_tracking
+        :return: None
+        :exception ValueError: a selection is invalid
+        """
+        self.priorities.select(selections)
+        allocate_files(self.torrent, self.file, self.priorities, overwrite=False)
+        self.update_left(peer_pieces_tracking, peer_pieces_tracking_lock)
+
+
+    def update_peer_uploaded(self, piece_bytes=0, pieces=1):
+        with self.lock:
+            self.uploaded = self.uploaded + pieces
+            self.uploaded_bytes = self.uploaded_bytes + piece_bytes
+
+
+    def wait_for_progress(self, last_downloaded_bytes, timeout=None):
+        """
+        Block until the downloaded bytes move past last_downloaded_bytes
+        or the download is completed.
+        :param last_downloaded_bytes: the byte counter already seen by the caller
+        :param timeout: maximum seconds to wait, None to wait forever
+        :return: (downloaded_bytes, left)
+        """
+        with self.state_changed:
+            self.state_changed.wait_for(lambda: self.downloaded_bytes != last_downloaded_bytes or self.left == 0,
+                                        timeout)
+            return self.downloaded_bytes, self.left
+
+
+    def wait_for_state(self, predicate, timeout=None):
+        """
+        Block until predicate(self) holds, re-checked on every state change.
+        :param predicate: function taking the peer, called with the lock held
+        :param timeout: maximum seconds to wait, None to wait forever
+        :return: the last value of predicate
+        """
+        with self.state_changed:
+            return self.state_changed.wait_for(lambda: predicate(self), timeout)
+
+
+    def wait_until_completed(self, timeout=None):
+        """
+        Block until every piece of the file is available.
+        :param timeout: maximum seconds to wait, None to wait forever
+        :return: True if the download is completed
+        """
+        return self.wait_for_state(lambda peer: peer.left == 0, timeout)
+
+
+    def wait_until_stopped(self, timeout=None):
+        return self.wait_for_state(lambda peer: peer.stopped, timeout)
+
+
+    def learn_peer(self, peer):
+        """
+        Add a peer learned from PEX or from an incoming connection,
+        the talker is woken up to connect to it
+        :param peer: dictionary with peer_id, peer_ip and peer_port
+        :return: True if the peer was not known
+        """
+        if self.pex.add(peer):
+            self.notify_peers_changed()
+            return True
+        return False
+
+
+    def notify_peers_changed(self):
+        with self.lock:
+            self.peers_version = self.peers_version + 1
+            self.state_changed.notify_all()
+
+
+    def pause(self):
+        with self.lock:
+            self.paused = True
+            self.state_changed.notify_all()
 
 
-    def update_peer_uploaded(self):
+    def resume(self):
         with self.lock:
-            self.uploaded = self.uploaded + 1
+            self.paused = False
+            self.state_changed.notify_all()
+
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.state_changed.notify_all()
+
+
+    def upload_buckets(self, remote_peer):
+        return self.bandwidth.upload, self.upload_bucket, self.bandwidth.peer_buckets(remote_peer)[0]
+
+
+    def download_buckets(self, remote_peer):
+        return self.bandwidth.download, self.download_bucket, self.bandwidth.peer_buckets(remote_peer)[1]
+
+
+    def set_limits(self, upload_rate=None, download_rate=None):
+        if upload_rate is not None:
+            self.upload_bucket.set_rate(upload_rate)
+        if download_rate is not None:
+            self.download_bucket.set_rate(download_rate)
+
+
+    def verify_piece(self, piece_data, piece_index):
+        if self.merkle is not None:
+            return self.verify_blocks(piece_data, piece_index)[0]
+        HASH_QUEUE_DEPTH.inc()
+        try:
+            with HASH_LATENCY.time():
+                if self.hash_pool is None:
+                    return verify_piece(piece_data, piece_index, self.torrent, self.pieces_hash)
+                return self.hash_pool.submit(verify_piece, piece_data, piece_index, self.torrent, self.pieces_hash).result()
+        finally:
+            HASH_QUEUE_DEPTH.dec()
+
+
+    def verify_blocks(self, piece_data, piece_index):
+        """
+        Verify a piece of a v2 torrent against its Merkle tree
+        :return: (True if the piece is valid, SHA256 of its blocks)
+        """
+        HASH_QUEUE_DEPTH.inc()
+        try:
+            with HASH_LATENCY.time():
+                if self.hash_pool is None:
+                    return self.merkle.verify(piece_data, piece_index)
+                return self.hash_pool.submit(self.merkle.verify, piece_data, piece_index).result()
+        finally:
+            HASH_QUEUE_DEPTH.dec()
+
+
+    def write_piece(self, piece_data, piece_index):
+        with DISK_WRITE_LATENCY.time():
+            write_piece(piece_data, piece_index, self.torrent, self.file, self.storage, self.layout,
+                        self.priorities.piece_length)
+
+
+    def read_piece(self, piece_index):
+        with DISK_READ_LATENCY.time():
+            return read_piece(piece_index, self.torrent, self.file, self.storage, self.layout,
+                              self.priorities.piece_length)
+
+
+    def read_range(self, offset, length):
+        with DISK_READ_LATENCY.time():
+            return read_range(self.layout, offset, length, self.storage)
 
 
 class SimpleClient:
@@ -398,6 +944,43 @@ class SimpleClient:
     VERSION = '1.0.0'
     TALKER_CHECKING = 40
     HAVING_REQUEST_TIME = 10
+    # threads of the hashing pool shared by the daemon's torrents, and of recheck
+    HASH_WORKERS = os.cpu_count() or 4
+    # bytes of consecutive pieces hashed by one task of recheck
+    RECHECK_CHUNK_LENGTH = 64 * 1024 * 1024
+    # granularity (byte) of the rate limiting on the wire
+    BLOCK_LENGTH = 16 * 1024
+    # longest piece, a whole piece is sent in one frame
+    MAX_PIECE_LENGTH = 16 * 1024 * 1024
+    DAEMON_CONTROL_PORT = 6880
+    # seconds between two PEX messages on a connection
+    PEX_INTERVAL = 30
+    # maximum number of added/dropped peers in a PEX message
+    PEX_MAX_PEERS = 50
+    # local service discovery (BEP 14) multicast group
+    LSD_GROUP = '239.192.152.143'
+    LSD_PORT = 6771
+    # seconds between two periodic announces of a torrent
+    LSD_INTERVAL = 5 * 60
+    # minimum seconds between two announces answering newcomers
+    LSD_MIN_INTERVAL = 5
+    # seconds after which a super-seeded piece that did not
+    # propagate is considered lost, the next one is revealed
+    SUPER_SEED_TIMEOUT = 60
+    # seconds between two JSON dumps of the metrics
+    METRICS_INTERVAL = 10
+    # bytes read at once by the streaming consumers
+    STREAM_CHUNK_LENGTH = 1024 * 1024
+    # requesters (pooled keep-alive connections) per web seed
+    WEB_SEED_CONNECTIONS = 2
+    WEB_SEED_TIMEOUT = 30
+    # seconds before retrying a failing web seed, doubled up to the maximum
+    WEB_SEED_BACKOFF = 1
+    WEB_SEED_MAX_BACKOFF = 60
+    # byte strings of a torrent from that length on are not copied by meta
+    LAZY_STRING_LENGTH = 1024
+    # STARTED announces deferred by overloaded trackers are retried that many times
+    STARTED_ANNOUNCE_ATTEMPTS = 3
 
 
 EVENT_LIST = [
@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+from urllib.parse import quote
+import requests
+from requests.adapters import HTTPAdapter
+from simple_peer.config import INFO
+from simple_peer.metrics import BYTES, PIECES, HASH_FAILURES, PIECE_LATENCY, CONNECTIONS, PIECES_IN_FLIGHT
+from simple_peer.rate_limiter import consume
+from simple_peer.util import get_web_seeds, is_download_completed, SimpleClient
+
+
+logger = logging.getLogger('web_seed')
+
+
+def get_web_seed_urls(url, layout):
+    """
+    URL of every file of the torrent on a web seed (BEP 19): a
+    single-file torrent is the url itself, or url + name when the url
+    ends with '/', a multi-file torrent is under url/name/
+    :param url: url of the web seed
+    :param layout: FileLayout of the torrent
+    :return: dictionary of path of the file -> url of the file
+    """
+    if layout.directory is None:
+        file_url = url + quote(layout.names[0]) if url.endswith('/') else url
+        return {layout.paths[0]: file_url}
+    base = url if url.endswith('/') else url + '/'
+    base += quote(layout.directory) + '/'
+    return {path: base + '/'.join(quote(component) for component in name.split('/'))
+            for path, name in zip(layout.paths, layout.names) if path is not None}
+
+
+def create_web_seed_session():
+    """
+    Keep-alive session shared by the requesters of a web seed,
+    one pooled connection per requester
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SimpleClient.WEB_SEED_CONNECTIONS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def web_seed_fetch(session, file_url, file_offset, length, buckets):
+    """
+    Fetch a byte range of a file with an HTTP Range request. A server
+    ignoring Range sends the whole file, the bytes before the range
+    are then read and skipped
+    :return: bytes of the range
+    :exception ValueError: the web seed did not return the range
+    """
+    headers = {'Range': f'bytes={file_offset}-{file_offset + length - 1}'}
+    with session.get(file_url, headers=headers, stream=True, timeout=SimpleClient.WEB_SEED_TIMEOUT) as response:
+        if response.status_code == 200:
+            # Range ignored, the range starts file_offset bytes into the body
+            skip = file_offset
+        elif response.status_code == 206:
+            skip = 0
+        else:
+            raise ValueError(f'Web seed returned {response.status_code} for {file_url}')
+        data = bytearray()
+        for chunk in response.iter_content(SimpleClient.BLOCK_LENGTH):
+            consume(buckets, len(chunk))
+            if skip >= len(chunk):
+                skip -= len(chunk)
+                continue
+            data += chunk[skip:skip + length - len(data)]
+            skip = 0
+            if len(data) == length:
+                break
+    if len(data) != length:
+        raise ValueError(f'Web seed returned {len(data)} bytes instead of {length} for {file_url}')
+    return data
+
+
+def web_seed_next_piece(client_peer, peer_pieces_tracking, peer_pieces_tracking_lock):
+    """
+    Take the first wanted piece nobody downloads, a web seed has every piece
+    :return: index of the piece marked DOWNLOADING, None if there is none
+    """
+    with peer_pieces_tracking_lock:
+        candidates = [i for i, state in peer_pieces_tracking.items() if state == 'UNAVAILABLE']
+        for i in client_peer.priorities.order(candidates):
+            peer_pieces_tracking[i] = 'DOWNLOADING'
+            return i
+    return None
+
+
+def web_seed_requester(client_peer, url, session, file_urls, peer_pieces_tracking, peer_pieces_tracking_lock):
+    """
+    Download pieces from a web seed with HTTP Range requests
+    until the download completes, alongside the peer requesters.
+    Failures back off exponentially up to WEB_SEED_MAX_BACKOFF
+    :param client_peer: object represents the client peer
+    :param url: url of the web seed, used as its peer_id in the metrics and the limits
+    :param session: requests session shared by the requesters of the web seed
+    :param file_urls: dictionary of path of the file -> url of the file
+    :param peer_pieces_tracking: dictionary of pieces tracking of the client peer
+    :param peer_pieces_tracking_lock: the lock for changing the peer_pieces_tracking
+    :return: None
+    """
+    piece_length = client_peer.priorities.piece_length
+    backoff = SimpleClient.WEB_SEED_BACKOFF
+    CONNECTIONS.inc(('web_seed',))
+    try:
+        while not is_download_completed(client_peer) and not client_peer.stopped:
+            if client_peer.paused:
+                client_peer.wait_for_state(lambda peer: not peer.paused or peer.stopped)
+                continue
+            i = web_seed_next_piece(client_peer, peer_pieces_tracking, peer_pieces_tracking_lock)
+            if i is None:
+                # the remaining pieces are downloading, wait for a change
+                client_peer.wait_for_state(lambda peer: peer.left == 0 or peer.stopped, SimpleClient.HAVING_REQUEST_TIME)
+                continue
+
+            PIECES_IN_FLIGHT.inc()
+            requested_time = time.perf_counter()
+            state = 'UNAVAILABLE'
+            try:
+                buckets = client_peer.download_buckets(url)
+                # padding files are not hosted, they are zeros
+                piece_data = b''.join(web_seed_fetch(session, file_urls[path], file_offset, span_length, buckets)
+                                      if path is not None else bytes(span_length)
+                                      for path, file_offset, span_length
+                                      in client_peer.layout.spans(i * piece_length, piece_length))
+                BYTES.inc(('in', url), len(piece_data))
+                if client_peer.verify_piece(piece_data, i):
+                    PIECE_LATENCY.observe(time.perf_counter() - requested_time)
+                    PIECES.inc(('in',))
+                    client_peer.write_piece(piece_data, i)
+                    state = 'AVAILABLE'
+                    backoff = SimpleClient.WEB_SEED_BACKOFF
+                    if INFO:
+                        logger.info(f'Downloaded piece [{i}] from [{url}]')
+                else:
+                    HASH_FAILURES.inc((url,))
+                    raise ValueError(f'Piece [{i}] from [{url}] is wrong')
+            except Exception as e:
+                if INFO:
+                    logger.info(f'{e}, retrying [{url}] in {backoff} seconds')
+                client_peer.wait_for_state(lambda peer: peer.stopped, backoff)
+                backoff = min(backoff * 2, SimpleClient.WEB_SEED_MAX_BACKOFF)
+            finally:
+                PIECES_IN_FLIGHT.dec()
+                with peer_pieces_tracking_lock:
+                    peer_pieces_tracking[i] = state
+                if state == 'AVAILABLE':
+                    client_peer.update_peer_available(len(piece_data), i)
+    finally:
+        CONNECTIONS.dec(('web_seed',))
+
+
+def start_web_seeds(client_peer, peer_pieces_tracking, peer_pieces_tracking_lock):
+    """
+    Start WEB_SEED_CONNECTIONS requesters per web seed of the torrent
+    :param client_peer: object represents the client peer
+    :param peer_pieces_tracking: dictionary of pieces tracking of the client peer
+    :param peer_pieces_tracking_lock: the lock for changing the peer_pieces_tracking
+    :return: None
+    """
+    for url in get_web_seeds(client_peer.torrent):
+        session = create_web_seed_session()
+        file_urls = get_web_seed_urls(url, client_peer.layout)
+        for _ in range(SimpleClient.WEB_SEED_CONNECTIONS):
+            web_seed_thread = threading.Thread(target=web_seed_requester, args=(client_peer, url, session, file_urls,
+                                                                                peer_pieces_tracking, peer_pieces_tracking_lock),
+                                               daemon=True)
+            web_seed_thread.start()
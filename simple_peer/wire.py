@@ -0,0 +1,237 @@
+import json
+import struct
+from simple_peer.rate_limiter import consume
+from simple_peer.util import send_exact_bytes, SimpleClient
+
+
+# version of the peer wire protocol, sent in the HANDSHAKE
+PROTOCOL_VERSION = 1
+
+# frame: <length: 4 bytes><message id: 1 byte><payload>, the length
+# counts the message id and the payload, a frame of length 0 is a KEEPALIVE
+KEEPALIVE = None
+HANDSHAKE = 0
+HAVE = 1
+REQUEST = 2
+PIECE = 3
+CANCEL = 4
+REJECT = 5
+HASHES = 6
+PEX = 7
+DONE = 8
+ERROR = 9
+
+MESSAGE_NAMES = {
+    HANDSHAKE: 'HANDSHAKE',
+    HAVE: 'HAVE',
+    REQUEST: 'REQUEST',
+    PIECE: 'PIECE',
+    CANCEL: 'CANCEL',
+    REJECT: 'REJECT',
+    HASHES: 'HASHES',
+    PEX: 'PEX',
+    DONE: 'DONE',
+    ERROR: 'ERROR'
+}
+
+FRAME_HEADER = struct.Struct('!IB')
+LENGTH_HEADER = struct.Struct('!I')
+# <version><info_hash><port>, followed by the peer_id
+HANDSHAKE_HEADER = struct.Struct('!B20sH')
+# <piece index><begin><length> of REQUEST, CANCEL and REJECT
+BLOCK_REQUEST = struct.Struct('!III')
+# <piece index><begin> of PIECE, followed by the data
+PIECE_HEADER = struct.Struct('!II')
+PIECE_INDEX = struct.Struct('!I')
+
+# largest frame accepted, the longest piece and its header
+MAX_FRAME_LENGTH = SimpleClient.MAX_PIECE_LENGTH + 64
+
+
+class ProtocolError(ValueError):
+    """
+    The remote peer sent an invalid frame, or an ERROR message
+    """
+
+
+def encode_frame_header(message_id, payload_length):
+    return FRAME_HEADER.pack(payload_length + 1, message_id)
+
+
+def encode_bitfield(pieces, piece_number):
+    """
+    :param pieces: indexes of the available pieces
+    :param piece_number: number of pieces of the torrent
+    :return: bytes of the bitfield, the most significant bit of the first byte is piece 0
+    """
+    bitfield = bytearray((piece_number + 7) // 8)
+    for i in pieces:
+        bitfield[i // 8] |= 0x80 >> (i % 8)
+    return bytes(bitfield)
+
+
+def decode_bitfield(bitfield):
+    """
+    :param bitfield: bytes of the bitfield
+    :return: set of the available piece indexes
+    """
+    return {i * 8 + bit for i, byte in enumerate(bitfield) if byte for bit in range(8) if byte & (0x80 >> bit)}
+
+
+class Connection:
+    """
+    Framed messages over a socket. Frames are received into one
+    reusable buffer and parsed incrementally, a payload is a
+    memoryview of the buffer valid until the next receive. The
+    buffer grows to the largest frame seen (a piece) and is reused
+    for every frame after.
+    """
+    # initial size of the receive buffer
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray(Connection.BUFFER_SIZE)
+        # received bytes not parsed yet are buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+
+    def send(self, message_id, payload=b'', data=None, buckets=None):
+        """
+        Send a frame, the data (a piece) is sent after the payload
+        without being copied, charged to the token buckets
+        :param message_id: id of the message
+        :param payload: bytes of the fixed part of the message
+        :param data: optional bytes following the payload
+        :param buckets: optional token buckets throttling the upload
+        :return: None
+        """
+        data_length = len(data) if data is not None else 0
+        self.sock.sendall(encode_frame_header(message_id, len(payload) + data_length) + payload)
+        if data is not None:
+            send_exact_bytes(self.sock, data, buckets)
+
+
+    def send_keepalive(self):
+        self.sock.sendall(LENGTH_HEADER.pack(0))
+
+
+    def send_json(self, message_id, message):
+        self.send(message_id, json.dumps(message).encode('utf-8'))
+
+
+    def send_error(self, message):
+        self.send(ERROR, str(message).encode('utf-8'))
+
+
+    def fill(self, needed=1, buckets=None):
+        """
+        Receive into the buffer, making room for needed unparsed bytes
+        :param needed: number of unparsed bytes the next frame needs
+        :param buckets: optional token buckets throttling the download
+        :return: number of bytes received, 0 when the connection is closed
+        """
+        pending = self.end - self.start
+        if self.start + needed > len(self.buffer):
+            if needed > len(self.buffer):
+                # a new buffer, the payloads handed out keep the previous one
+                buffer = bytearray(max(needed, 2 * len(self.buffer)))
+                buffer[:pending] = self.buffer[self.start:self.end]
+                self.buffer = buffer
+            else:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        elif self.start == self.end:
+            self.start = self.end = 0
+
+        view = memoryview(self.buffer)[self.end:]
+        if buckets:
+            view = view[:SimpleClient.BLOCK_LENGTH]
+        received = self.sock.recv_into(view)
+        if received and buckets:
+            consume(buckets, received)
+        self.end += received
+        return received
+
+
+    def next_message(self):
+        """
+        Parse the next frame of the buffer
+        :return: (message id, payload) or None when the frame is incomplete
+        :exception ProtocolError: the frame is invalid
+        """
+        pending = self.end - self.start
+        if pending < LENGTH_HEADER.size:
+            return None
+        length = LENGTH_HEADER.unpack_from(self.buffer, self.start)[0]
+        if length > MAX_FRAME_LENGTH:
+            raise ProtocolError(f'Frame of {length} bytes is too long')
+        if pending < LENGTH_HEADER.size + length:
+            return None
+        frame_start = self.start + LENGTH_HEADER.size
+        self.start = frame_start + length
+        if length == 0:
+            return KEEPALIVE, memoryview(b'')
+        message_id = self.buffer[frame_start]
+        if message_id not in MESSAGE_NAMES:
+            raise ProtocolError(f'Unknown message id {message_id}')
+        return message_id, memoryview(self.buffer)[frame_start + 1:self.start]
+
+
+    def needed(self):
+        """
+        :return: unparsed bytes of the frame at the head of the buffer once complete
+        """
+        pending = self.end - self.start
+        if pending < LENGTH_HEADER.size:
+            return LENGTH_HEADER.size
+        return LENGTH_HEADER.size + LENGTH_HEADER.unpack_from(self.buffer, self.start)[0]
+
+
+    def messages(self):
+        """
+        Parse every complete frame of the buffer
+        :return: generator of (message id, payload)
+        """
+        message = self.next_message()
+        while message is not None:
+            yield message
+            message = self.next_message()
+
+
+    def receive(self, buckets=None):
+        """
+        Block until the next message, keepalives are skipped
+        :param buckets: optional token buckets throttling the download
+        :return: (message id, payload)
+        :exception ProtocolError: the frame is invalid or the message is an ERROR
+        :exception ConnectionError: the connection is closed
+        """
+        while True:
+            message = self.next_message()
+            if message is None:
+                if not self.fill(self.needed(), buckets):
+                    raise ConnectionError('Connection closed before receiving expected data')
+                continue
+            message_id, payload = message
+            if message_id is KEEPALIVE:
+                continue
+            if message_id == ERROR:
+                raise ProtocolError(bytes(payload).decode('utf-8', 'replace'))
+            return message_id, payload
+
+
+    def expect(self, message_id, buckets=None):
+        """
+        :return: payload of the next message
+        :exception ProtocolError: the next message is of another type
+        """
+        received_id, payload = self.receive(buckets)
+        if received_id != message_id:
+            raise ProtocolError(f'Expected {MESSAGE_NAMES[message_id]}, received {MESSAGE_NAMES[received_id]}')
+        return payload
+
+
+    def receive_json(self, message_id):
+        return json.loads(bytes(self.expect(message_id)).decode('utf-8'))
@@ -1,35 +1,51 @@
 import time
 import logging
+from simple_tracker.metrics import CLEANER_PASS, CLEANED_PEERS
 from simple_tracker.util import SimpleTracker
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("cleaner")
 
 
-def is_over_threshold(peer):
-    if int(time.time()) - peer.last_announce_time >= SimpleTracker.THRESHOLD:
+def is_over_threshold(peer, now):
+    # the threshold follows the interval issued to the peer
+    if now - peer.last_announce_time >= peer.interval * SimpleTracker.THRESHOLD_RATIO:
         return True
     return False
 
 
-def cleaner(peers_db, peers_db_lock):
+def checking_time(site_index, load_controller):
+    """
+    :return: seconds between two passes, a fraction of the shortest interval issued
+    """
+    return max(SimpleTracker.CHECKING_TIME,
+               load_controller.base_interval(site_index.peer_number) * SimpleTracker.CHECKING_RATIO)
+
+
+def cleaner(peers_db, peers_db_lock, site_index, load_controller):
     try:
         while True:
             logger.info("Periodic cleaning...")
-            time.sleep(SimpleTracker.CHECKING_TIME)
+            time.sleep(checking_time(site_index, load_controller))
             # For each of the swarm
-            with peers_db_lock:
+            with CLEANER_PASS.time(), peers_db_lock:
+                now = int(time.time())
                 # iterate over the copy of dictionary
                 for info_hash, swarm in list(peers_db.items()):
                     # For each of the peer in the swarm
-                    for peer in swarm:
-                        if is_over_threshold(peer):
-                            # Exclude that peer from the swarm
-                            logger.info('Clean ' + peer.peer_id)
-                            peers_db[peer.info_hash] = [peer_mem for peer_mem in peers_db[peer.info_hash] if
-                                                        peer_mem.peer_id != peer.peer_id]
-                            # After excluding, if the swarm is empty
-                            if not peers_db[peer.info_hash]:
-                                # Delete that entry of the swarm
-                                del peers_db[peer.info_hash]
+                    expired = [peer for peer in swarm if is_over_threshold(peer, now)]
+                    if not expired:
+                        continue
+                    for peer in expired:
+                        # Exclude that peer from the swarm
+                        logger.info('Clean ' + peer.peer_id)
+                        CLEANED_PEERS.inc()
+                        site_index.remove(info_hash, peer.peer_id)
+                    # rebuild the swarm once, not once per expired peer
+                    expired_ids = {peer.peer_id for peer in expired}
+                    peers_db[info_hash] = [peer_mem for peer_mem in swarm if peer_mem.peer_id not in expired_ids]
+                    # After excluding, if the swarm is empty
+                    if not peers_db[info_hash]:
+                        # Delete that entry of the swarm
+                        del peers_db[info_hash]
     except Exception as e:
-        logger.info(SimpleTracker.APP_NAME +': ' + str(e))
\ No newline at end of file
+        logger.info(SimpleTracker.APP_NAME +': ' + str(e))
@@ -0,0 +1,123 @@
+import math
+import random
+import threading
+import time
+from simple_tracker.util import SimpleTracker
+
+
+class RateMeter:
+    """
+    Events per second over a sliding window of one-second buckets
+    """
+    def __init__(self, window=10):
+        self.window = window
+        # second -> events, for the last window seconds
+        self.buckets = [0] * window
+        self.seconds = [0] * window
+        self.lock = threading.Lock()
+
+
+    def mark(self):
+        """
+        :return: events of the current second, this one included
+        """
+        second = int(time.monotonic())
+        with self.lock:
+            i = second % self.window
+            if self.seconds[i] != second:
+                self.seconds[i] = second
+                self.buckets[i] = 0
+            self.buckets[i] += 1
+            return self.buckets[i]
+
+
+    def rate(self):
+        # the current second is partial, the window ends at the previous one
+        second = int(time.monotonic())
+        with self.lock:
+            return sum(events for events, bucket_second in zip(self.buckets, self.seconds)
+                       if second - self.window <= bucket_second < second) / self.window
+
+
+class LoadController:
+    """
+    Announce intervals and admission of the tracker. The interval
+    grows with the size of the swarm, with the number of peers
+    the tracker serves and with the measured announce rate, so that
+    the announces stay around target_rate per second. Announces
+    beyond max_in_flight, or beyond max_rate in the current second,
+    are not queued on peers_db_lock or in the server threads but
+    answered at once with a 503 and a Retry-After, RE_ANNOUNCE
+    first, then STARTED. STOPPED is never refused.
+    """
+    # the interval of a small swarm on an idle tracker is SimpleTracker.INTERVAL
+    MAX_INTERVAL = 30 * 60
+    # interval of a swarm of SWARM_SIZE peers, grows by SimpleTracker.INTERVAL per ten times more peers
+    SWARM_SIZE = 100
+    # 'min interval' returned, fraction of the interval
+    MIN_INTERVAL_RATIO = 0.5
+    # announces per second the intervals aim at
+    TARGET_RATE = 500
+    # announces handled at once and per second, RE_ANNOUNCE are refused from SHED_RATIO of them
+    MAX_IN_FLIGHT = 64
+    MAX_RATE = 4 * TARGET_RATE
+    SHED_RATIO = 0.5
+    # seconds a refused peer waits, jittered down to half
+    RETRY_AFTER = 15
+
+    def __init__(self, target_rate=TARGET_RATE, max_in_flight=MAX_IN_FLIGHT, max_rate=MAX_RATE):
+        self.target_rate = target_rate
+        self.max_in_flight = max_in_flight
+        self.max_rate = max_rate
+        self.in_flight = 0
+        self.rate_meter = RateMeter()
+        self.lock = threading.Lock()
+
+
+    def admit(self, event):
+        """
+        :param event: event of the announce
+        :return: None if the announce is handled, else the seconds after which the peer retries
+        """
+        events = self.rate_meter.mark()
+        with self.lock:
+            if event == SimpleTracker.EVENT_LIST[1]:
+                share = math.inf
+            elif event == SimpleTracker.EVENT_LIST[2]:
+                share = LoadController.SHED_RATIO
+            else:
+                share = 1
+            if self.in_flight >= self.max_in_flight * share or events > self.max_rate * share:
+                return round(random.uniform(LoadController.RETRY_AFTER / 2, LoadController.RETRY_AFTER))
+            self.in_flight += 1
+            return None
+
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+
+    def interval(self, swarm_size, peer_number):
+        """
+        :param swarm_size: peers of the swarm of the announce
+        :param peer_number: peers of every swarm
+        :return: seconds until the next announce of the peer
+        """
+        swarm_interval = SimpleTracker.INTERVAL * (1 + math.log10(max(1.0, swarm_size / LoadController.SWARM_SIZE)))
+        # every peer announcing once per interval makes peer_number / interval announces per second
+        interval = max(swarm_interval, peer_number / self.target_rate)
+        # a burst above the target spreads the next announces of the peers served
+        interval *= max(1.0, self.rate_meter.rate() / self.target_rate)
+        return int(min(interval, LoadController.MAX_INTERVAL))
+
+
+    def min_interval(self, interval):
+        return int(interval * LoadController.MIN_INTERVAL_RATIO)
+
+
+    def base_interval(self, peer_number):
+        """
+        :return: the shortest interval currently returned, the one of a single peer swarm
+        """
+        return self.interval(1, peer_number)
@@ -0,0 +1,203 @@
+import bisect
+import ipaddress
+import json
+import random
+
+
+# separates the levels of a site name, 'eu-west/dc1/rack4'
+SITE_SEPARATOR = '/'
+
+
+class SiteMap:
+    """
+    Maps the IP address of a peer to its site. A site tag sent by
+    the peer wins, then the longest CIDR of the map containing the
+    address, then the subnet of the address (/24 for IPv4, /64 for
+    IPv6) so that peers of one LAN are always neighbours.
+    """
+    IPV4_SUBNET = 24
+    IPV6_SUBNET = 64
+
+    def __init__(self, networks=None):
+        """
+        :param networks: dictionary of CIDR -> site name
+        """
+        # prefix length -> {network: site}, longest prefix first
+        self.networks = {}
+        for cidr, site in (networks or {}).items():
+            network = ipaddress.ip_network(cidr, strict=False)
+            self.networks.setdefault(network.prefixlen, {})[network] = site
+        self.prefix_lengths = sorted(self.networks, reverse=True)
+
+
+    def site_of(self, peer_ip, site_tag=None):
+        """
+        :param peer_ip: IP address announced by the peer
+        :param site_tag: site sent by the peer, optional
+        :return: name of the site of the peer
+        """
+        if site_tag:
+            return site_tag
+        try:
+            address = ipaddress.ip_address(peer_ip)
+        except ValueError:
+            # a host name, its own site
+            return f'host-{peer_ip}'
+        # one dictionary lookup per prefix length of the map
+        for prefix_length in self.prefix_lengths:
+            if prefix_length > address.max_prefixlen:
+                continue
+            network = ipaddress.ip_network((address, prefix_length), strict=False)
+            site = self.networks[prefix_length].get(network)
+            if site is not None:
+                return site
+        subnet = SiteMap.IPV4_SUBNET if address.version == 4 else SiteMap.IPV6_SUBNET
+        return f'subnet-{ipaddress.ip_network((address, subnet), strict=False).network_address}'
+
+
+def load_site_map(path):
+    """
+    :param path: JSON file of {"<CIDR>": "<site>"}, None for no map
+    :return: SiteMap
+    """
+    if path is None:
+        return SiteMap()
+    with open(path, 'r') as f:
+        return SiteMap(json.load(f))
+
+
+def site_closeness(site, other_site):
+    """
+    :return: number of leading levels the two sites share, 'eu/dc1/rack4'
+    and 'eu/dc1/rack7' share 2
+    """
+    closeness = 0
+    for level, other_level in zip(site.split(SITE_SEPARATOR), other_site.split(SITE_SEPARATOR)):
+        if level != other_level:
+            break
+        closeness += 1
+    return closeness
+
+
+class SiteIndex:
+    """
+    Peers of every swarm grouped by site. A site keeps its peers in
+    a list with the position of each peer, so that adding, removing
+    and sampling k peers cost O(1), O(1) and O(k) whatever the size
+    of the swarm. Guarded by peers_db_lock.
+    """
+    def __init__(self, site_map=None):
+        self.site_map = site_map or SiteMap()
+        # info_hash -> site -> list of peers
+        self.sites = {}
+        # info_hash -> peer_id -> (site, position in the list of the site)
+        self.positions = {}
+        # peers of every swarm
+        self.peer_number = 0
+
+
+    def add(self, peer):
+        """
+        Index a peer, or move it when its site changed
+        :return: None
+        """
+        site = self.site_map.site_of(peer.peer_ip, peer.site_tag)
+        positions = self.positions.setdefault(peer.info_hash, {})
+        if peer.peer_id in positions:
+            indexed_site, position = positions[peer.peer_id]
+            if indexed_site == site:
+                # the re-announce updated the peer in place
+                peer.site = site
+                return
+            self.remove(peer.info_hash, peer.peer_id)
+            positions = self.positions.setdefault(peer.info_hash, {})
+        peer.site = site
+        site_peers = self.sites.setdefault(peer.info_hash, {}).setdefault(site, [])
+        positions[peer.peer_id] = (site, len(site_peers))
+        site_peers.append(peer)
+        self.peer_number += 1
+
+
+    def remove(self, info_hash, peer_id):
+        positions = self.positions.get(info_hash)
+        if positions is None or peer_id not in positions:
+            return
+        site, position = positions.pop(peer_id)
+        self.peer_number -= 1
+        site_peers = self.sites[info_hash][site]
+        # the last peer of the site takes the place of the removed one
+        last_peer = site_peers.pop()
+        if position < len(site_peers):
+            site_peers[position] = last_peer
+            positions[last_peer.peer_id] = (site, position)
+        if not site_peers:
+            del self.sites[info_hash][site]
+        if not positions:
+            del self.positions[info_hash]
+            del self.sites[info_hash]
+
+
+    def get(self, info_hash, peer_id):
+        """
+        :return: the indexed peer, None if it is not
+        """
+        positions = self.positions.get(info_hash)
+        if positions is None or peer_id not in positions:
+            return None
+        site, position = positions[peer_id]
+        return self.sites[info_hash][site][position]
+
+
+    def swarm_size(self, info_hash):
+        return len(self.positions.get(info_hash, ()))
+
+
+    def select(self, client_peer, number):
+        """
+        Peers of the swarm closest to the client peer: its own site
+        first, then the sites sharing the most levels of its name,
+        sampled at random within a level
+        :param client_peer: the announcing peer, indexed already
+        :param number: peers returned at most
+        :return: list of (peer, locality), locality is 'site', 'nearby'
+        (some levels shared) or 'remote', the client peer excluded
+        """
+        swarm_sites = self.sites.get(client_peer.info_hash, {})
+        site = client_peer.site or self.site_map.site_of(client_peer.peer_ip, client_peer.site_tag)
+        same_site = len(site.split(SITE_SEPARATOR)) + 1
+        levels = {}
+        for other_site, site_peers in swarm_sites.items():
+            closeness = same_site if other_site == site else site_closeness(site, other_site)
+            levels.setdefault(closeness, []).append(site_peers)
+
+        selected = []
+        for closeness in sorted(levels, reverse=True):
+            remaining = number - len(selected)
+            if remaining <= 0:
+                break
+            locality = 'site' if closeness == same_site else 'nearby' if closeness else 'remote'
+            # one more, the client peer may be sampled
+            for peer in sample_sites(levels[closeness], remaining + 1):
+                if peer.peer_id != client_peer.peer_id and len(selected) < number:
+                    selected.append((peer, locality))
+        return selected
+
+
+def sample_sites(site_lists, number):
+    """
+    :param site_lists: lists of peers of the sites of one level
+    :param number: peers sampled at most
+    :return: peers sampled uniformly from the concatenation of the lists, without copying them
+    """
+    ends = []
+    total = 0
+    for site_peers in site_lists:
+        total += len(site_peers)
+        ends.append(total)
+    if total <= number:
+        return [peer for site_peers in site_lists for peer in site_peers]
+    sampled = []
+    for i in random.sample(range(total), number):
+        site = bisect.bisect_right(ends, i)
+        sampled.append(site_lists[site][i - (ends[site - 1] if site else 0)])
+    return sampled
@@ -0,0 +1,55 @@
+from simple_metrics.metrics import Registry, LOCK_BUCKETS
+
+
+# every instrument of the tracker, exported by /metrics
+registry = Registry()
+
+ANNOUNCES = registry.counter('tracker_announces_total', 'Announces received', ('event',))
+ANNOUNCE_LATENCY = registry.histogram('tracker_announce_seconds', 'Time to handle an announce', ('event',))
+RETURNED_PEERS = registry.counter('tracker_returned_peers_total', 'Peers returned by announces, per locality to the announcing peer',
+                                  ('locality',))
+SHED_ANNOUNCES = registry.counter('tracker_shed_announces_total', 'Announces refused with a 503 under overload', ('event',))
+ANNOUNCE_INTERVAL = registry.histogram('tracker_announce_interval_seconds', 'Intervals issued to the peers',
+                                       buckets=(30, 60, 90, 120, 180, 300, 600, 1200, 1800))
+CLEANER_PASS = registry.histogram('tracker_cleaner_pass_seconds', 'Duration of a cleaner pass')
+CLEANED_PEERS = registry.counter('tracker_cleaned_peers_total', 'Peers removed by the cleaner')
+LOCK_WAIT = registry.histogram('tracker_lock_wait_seconds', 'Time spent waiting for peers_db_lock', buckets=LOCK_BUCKETS)
+LOCK_HOLD = registry.histogram('tracker_lock_hold_seconds', 'Time peers_db_lock is held', buckets=LOCK_BUCKETS)
+
+
+def register_swarm_gauges(peers_db, peers_db_lock):
+    """
+    Gauges computed from the peers database on every export
+    :param peers_db: dictionary of info_hash -> list of peers
+    :param peers_db_lock: lock for peers_db
+    :return: None
+    """
+    def swarm_sizes():
+        with peers_db_lock:
+            return {(info_hash,): len(swarm) for info_hash, swarm in peers_db.items()}
+
+    def swarms():
+        with peers_db_lock:
+            return len(peers_db)
+
+    def peers():
+        with peers_db_lock:
+            return sum(len(swarm) for swarm in peers_db.values())
+
+    registry.gauge('tracker_swarms', 'Number of swarms', callback=swarms)
+    registry.gauge('tracker_peers', 'Number of peers in every swarm', callback=peers)
+    registry.gauge('tracker_swarm_peers', 'Number of peers per swarm', ('info_hash',), callback=swarm_sizes)
+
+
+def register_load_gauges(load_controller, site_index):
+    """
+    Gauges of the load of the tracker
+    :param load_controller: LoadController of the tracker
+    :param site_index: SiteIndex of the tracker
+    :return: None
+    """
+    registry.gauge('tracker_announce_rate', 'Announces per second over the last 10 seconds',
+                   callback=load_controller.rate_meter.rate)
+    registry.gauge('tracker_announces_in_flight', 'Announces being handled', callback=lambda: load_controller.in_flight)
+    registry.gauge('tracker_base_interval_seconds', 'Interval issued to a single peer swarm',
+                   callback=lambda: load_controller.base_interval(site_index.peer_number))
@@ -1,5 +1,6 @@
 import time
 from flask import request
+from simple_tracker.metrics import RETURNED_PEERS, ANNOUNCE_INTERVAL
 
 
 def announce_parse_request():
@@ -14,7 +15,8 @@ def announce_parse_request():
                 request.args.get('uploaded', type=int),
                 request.args.get('downloaded', type=int),
                 request.args.get('left', type=int),
-                request.args.get('event', type=str))
+                request.args.get('event', type=str),
+                request.args.get('site', type=str))
 
 
 def announce_handler_lack_info(client_peer):
@@ -25,58 +27,77 @@ def announce_handler_lack_info(client_peer):
         return "Announce unsuccessfully", 400
 
 
-def announce_handler_stopped_event(peers_db, peers_db_lock, client_peer):
+def announce_handler_stopped_event(peers_db, peers_db_lock, site_index, client_peer):
     with peers_db_lock:
+        # the cleaner may have removed the swarm already
+        if client_peer.info_hash not in peers_db:
+            return
         peers_db[client_peer.info_hash] = [peer_mem for peer_mem in peers_db[client_peer.info_hash] if peer_mem.peer_id != client_peer.peer_id]
+        site_index.remove(client_peer.info_hash, client_peer.peer_id)
         if not peers_db[client_peer.info_hash]:
             del peers_db[client_peer.info_hash]
 
 
-def announce_handler_started_event(peers_db, peers_db_lock, client_peer):
+def announce_upsert_peer(peers_db, site_index, client_peer):
+    """
+    Add the client peer to its swarm, or update the peer announced
+    with the same peer_id, in peers_db and in the site index alike.
+    Called with peers_db_lock held
+    :return: None
+    """
+    peer_mem = site_index.get(client_peer.info_hash, client_peer.peer_id)
+    if peer_mem is not None:
+        # update the peer information, along with the last_announce_time
+        peer_mem.update(client_peer)
+        # moved to its new site if its address or tag changed
+        site_index.add(peer_mem)
+        client_peer.site = peer_mem.site
+        return
+    # a new peer, or one the cleaner removed meanwhile (with its swarm when it was the only peer)
+    peers_db.setdefault(client_peer.info_hash, []).append(client_peer)
+    site_index.add(client_peer)
+
+
+def announce_handler_started_event(peers_db, peers_db_lock, site_index, client_peer):
     with peers_db_lock:
-        if client_peer.info_hash not in peers_db:
-            # Create an empty list of Peer object
-            peers_db[client_peer.info_hash] = []
-        peers_db[client_peer.info_hash].append(client_peer)
+        # a peer restarting with the same peer_id is updated, not listed twice
+        announce_upsert_peer(peers_db, site_index, client_peer)
 
 
-def announce_handler_re_announce_event(peers_db, peers_db_lock, client_peer):
+def announce_handler_re_announce_event(peers_db, peers_db_lock, site_index, client_peer):
     with peers_db_lock:
-        # case when cleaner cleans the only peer in the
-        # swarm, delete the info_hash entry in the database
-        if client_peer.info_hash not in peers_db:
-            with peers_db_lock:
-                peers_db[client_peer.info_hash] = []
-                peers_db[client_peer.info_hash].append(client_peer)
-                return
-        for peer_mem in peers_db[client_peer.info_hash]:
-            if peer_mem.peer_id == client_peer.peer_id:
-                # update the peer information, along with the
-                # last_announce_time, return a refreshed
-                # list of peer
-                peer_mem.update(client_peer)
-                return
-        # in the case, tracker don't find any peer_mem
-        # in the swarm, tracker's cleaner deleted it out
-        # of the peer, but there is still the swarm's entry
-        # re-append the client_peer
-        peers_db[client_peer.info_hash].append(client_peer)
-
-
-def announce_handler_swarm_response(client_peer, peers_db, peers_db_lock):
+        announce_upsert_peer(peers_db, site_index, client_peer)
+
+
+def announce_handler_swarm_response(client_peer, peers_db_lock, site_index, load_controller):
+    """
+    At most MAX_PEERS peers of the swarm, the closest to the client
+    peer first (same site, then the sites sharing a prefix), and the
+    interval of the next announce for the size of the swarm and the
+    load of the tracker
+    """
     with peers_db_lock:
-        swarm = peers_db.get(client_peer.info_hash, [])
-    # Convert to a list of dictionary
-    swarm = [peer_mem.to_dict() for peer_mem in swarm]
+        interval = load_controller.interval(site_index.swarm_size(client_peer.info_hash), site_index.peer_number)
+        peer_mem = site_index.get(client_peer.info_hash, client_peer.peer_id)
+        if peer_mem is not None:
+            # the cleaner waits for the interval issued to the peer
+            peer_mem.interval = interval
+        selected = site_index.select(client_peer, SimpleTracker.MAX_PEERS)
+        # Convert to a list of dictionary
+        swarm = [peer_mem.to_dict() for peer_mem, _ in selected]
+    for _, locality in selected:
+        RETURNED_PEERS.inc((locality,))
+    ANNOUNCE_INTERVAL.observe(interval)
     swarm_response = {
-        'interval': SimpleTracker.INTERVAL,
+        'interval': interval,
+        'min interval': load_controller.min_interval(interval),
         'peers': swarm
     }
     return swarm_response
 
 
 class Peer:
-    def __init__(self, info_hash, peer_id, peer_ip, peer_port, uploaded, downloaded, left, event):
+    def __init__(self, info_hash, peer_id, peer_ip, peer_port, uploaded, downloaded, left, event, site_tag=None):
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.peer_ip = peer_ip
@@ -85,6 +106,12 @@ class Peer:
         self.downloaded = downloaded
         self.left = left
         self.event = event
+        # site sent by the peer, optional
+        self.site_tag = site_tag
+        # site resolved by the SiteIndex
+        self.site = None
+        # interval of the next announce issued to the peer
+        self.interval = SimpleTracker.INTERVAL
         # Represent the last announce time
         # Used for scheduled clean-up service
         self.last_announce_time = int(time.time())
@@ -99,6 +126,7 @@ class Peer:
         self.downloaded = peer.downloaded
         self.left = peer.left
         self.event = peer.event
+        self.site_tag = peer.site_tag
         # Update the last_announce_time
         self.last_announce_time = int(time.time())
 
@@ -112,19 +140,26 @@ class Peer:
             'uploaded': self.uploaded,
             'downloaded': self.downloaded,
             'left': self.left,
-            'event': self.event
+            'event': self.event,
+            'site': self.site
         }
 
 
 class SimpleTracker:
     APP_NAME= 'Simple Bittorrent Tracker'
     VERSION='1.0.0'
-    # 1 minutes
+    # 1 minutes, the interval of a small swarm on an
+    # idle tracker, see LoadController.interval
     INTERVAL=1*60
-    # for every 10 seconds
-    # running the clean-up
+    # peers returned by an announce at most
+    MAX_PEERS=50
+    # running the clean-up every sixth of the
+    # shortest interval, every 10 seconds at least
     CHECKING_TIME=10
-    THRESHOLD=1*60+30
+    CHECKING_RATIO=1/6
+    # a peer is cleaned once 1.5 times the interval
+    # issued to it passed without an announce
+    THRESHOLD_RATIO=1.5
     EVENT_LIST = ['STARTED',        # 0
                   'STOPPED',        # 1
                   'RE_ANNOUNCE']    # 2
\ No newline at end of file